@@ -0,0 +1,77 @@
+#!/usr/bin/env python3.6
+"""
+Measure the latency of inserting an action as a conversation grows, the action_inserted trigger should cost
+the same whatever the number of messages and participants in the conversation.
+
+Data is created inside a transaction which is rolled back, run with:
+
+    python benchmarks/action_insert.py
+
+the database is configured using the normal EM2_PG_* environment variables.
+"""
+import asyncio
+import sys
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+import asyncpg
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from em2 import Settings  # noqa: E402
+
+SIZES = 10, 1_000, 10_000, 50_000
+INSERTS = 200
+
+create_conv_sql = """
+WITH recip AS (
+  INSERT INTO recipients (address) VALUES ('testing@example.com')
+  ON CONFLICT (address) DO UPDATE SET address=EXCLUDED.address RETURNING id
+)
+INSERT INTO conversations (key, creator, subject, published)
+SELECT 'benchmark-action-insert', recip.id, 'benchmark', TRUE FROM recip RETURNING id, creator
+"""
+grow_sql = """
+WITH new_recips AS (
+  INSERT INTO recipients (address)
+  SELECT 'prt-' || i || '@example.com' FROM generate_series($2, $3 - 1) AS i
+  ON CONFLICT (address) DO UPDATE SET address=EXCLUDED.address RETURNING id
+), prts AS (
+  INSERT INTO participants (conv, recipient) SELECT $1, id FROM new_recips
+)
+INSERT INTO messages (conv, key, body)
+SELECT $1, lpad(i::text, 20, 'm'), 'this is message ' || i FROM generate_series($2, $3 - 1) AS i
+"""
+insert_action_sql = """
+INSERT INTO actions (key, conv, verb, component, actor)
+VALUES ($1, $2, 'modify', 'subject', $3)
+"""
+
+
+async def main():
+    settings = Settings()
+    conn = await asyncpg.connect(dsn=settings.pg_dsn)
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        conv_id, actor = await conn.fetchrow(create_conv_sql)
+        stmt = await conn.prepare(insert_action_sql)
+        current_size = 0
+        for size in SIZES:
+            await conn.execute(grow_sql, conv_id, current_size, size)
+            current_size = size
+
+            times = []
+            for i in range(INSERTS):
+                start = perf_counter()
+                await stmt.fetch(f'{size:0>10}{i:0>10}', conv_id, actor)
+                times.append(perf_counter() - start)
+            print(f'{size:>8,} messages and participants: median action insert {median(times) * 1000:0.3f}ms')
+    finally:
+        await tr.rollback()
+        await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
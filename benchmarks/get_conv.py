@@ -0,0 +1,116 @@
+#!/usr/bin/env python3.6
+"""
+Compare building the conversation document with one statement (GetConv) against the previous approach of
+running a query for each part and joining the results in python.
+
+Conversations are created inside a transaction which is rolled back, run with:
+
+    python benchmarks/get_conv.py
+
+the database is configured using the normal EM2_PG_* environment variables.
+"""
+import asyncio
+import json
+import sys
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+import asyncpg
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from em2 import Settings  # noqa: E402
+from em2.core import GetConv  # noqa: E402
+
+SIZES = 10, 1_000, 50_000
+REPEATS = 20
+ADDRESS = 'testing@example.com'
+
+create_conv_sql = """
+WITH recip AS (
+  INSERT INTO recipients (address) VALUES ($1)
+  ON CONFLICT (address) DO UPDATE SET address=EXCLUDED.address RETURNING id
+), conv AS (
+  INSERT INTO conversations (key, creator, subject, published)
+  SELECT $2, recip.id, 'benchmark', TRUE FROM recip RETURNING id, creator
+), prt AS (
+  INSERT INTO participants (conv, recipient) SELECT conv.id, conv.creator FROM conv
+)
+SELECT id, creator FROM conv
+"""
+create_messages_sql = """
+INSERT INTO messages (conv, key, body)
+SELECT $1, lpad(i::text, 20, 'm'), 'this is message ' || i FROM generate_series(1, $2) AS i
+"""
+create_actions_sql = """
+INSERT INTO actions (key, conv, verb, component, actor, message, body)
+SELECT lpad(m.id::text, 20, 'a'), $1, 'add', 'message', $2, m.id, m.body
+FROM messages AS m WHERE m.conv = $1
+"""
+
+
+def multi_query_parts():
+    """
+    Each part of the document as its own statement as they were before being combined.
+    """
+    wrap = 'SELECT ({}) FROM (SELECT $1::INT AS id) AS conv'.format
+    return [
+        ('details', wrap(GetConv._details_part)),
+        ('messages', wrap(GetConv._messages_part)),
+        ('participants', wrap(GetConv._participants_part)),
+        ('actions', wrap(GetConv._actions_part)),
+    ]
+
+
+async def run_multi_query(conn, conv_key, conv_id_sql, parts):
+    conv_id = await conn.fetchval(conv_id_sql, ADDRESS, conv_key)
+    fields = [(k, await conn.fetchval(sql, conv_id)) for k, sql in parts]
+    return '{' + ','.join(f'"{k}":{"null" if v is None else v}' for k, v in fields) + '}'
+
+
+async def run_single_query(conn, conv_key):
+    return await GetConv(conn).run(conv_key, ADDRESS)
+
+
+async def time_it(func, *args):
+    times = []
+    result = None
+    for _ in range(REPEATS):
+        start = perf_counter()
+        result = await func(*args)
+        times.append(perf_counter() - start)
+    return median(times) * 1000, result
+
+
+async def benchmark(conn, size):
+    conv_key = f'benchmark{size:0>10}'
+    conv_id, actor = await conn.fetchrow(create_conv_sql, ADDRESS, conv_key)
+    await conn.execute(create_messages_sql, conv_id, size)
+    await conn.execute(create_actions_sql, conv_id, actor)
+
+    # statements are kept in asyncpg's statement cache so planning is only included in the first run,
+    # median times are used to exclude it
+    multi_time, multi_result = await time_it(run_multi_query, conn, conv_key, GetConv._conv_id_part,
+                                             multi_query_parts())
+    single_time, single_result = await time_it(run_single_query, conn, conv_key)
+    assert json.loads(multi_result) == json.loads(single_result)
+    print(f'{size:>8,} actions: multi query {multi_time:8.2f}ms, single query {single_time:8.2f}ms, '
+          f'{multi_time / single_time:0.2f}x')
+
+
+async def main():
+    settings = Settings()
+    conn = await asyncpg.connect(dsn=settings.pg_dsn)
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        for size in SIZES:
+            await benchmark(conn, size)
+    finally:
+        await tr.rollback()
+        await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
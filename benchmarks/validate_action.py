@@ -0,0 +1,53 @@
+#!/usr/bin/env python3.6
+"""
+Compare the number of actions validated per second with pydantic (ApplyAction.Data) against the fast path
+used by ApplyAction.validate_data, no database is required, run with:
+
+    python benchmarks/validate_action.py
+"""
+import sys
+from pathlib import Path
+from time import perf_counter
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from em2.core import ApplyAction  # noqa: E402
+
+ACTIONS = 100_000
+
+local_action = dict(
+    action_key='a' * 20,
+    conv=123,
+    verb='modify',
+    component='message',
+    actor=456,
+    item='m' * 20,
+    parent='p' * 20,
+    body='this is the new message body',
+)
+remote_action = dict(
+    local_action,
+    verb='add',
+    timestamp='2032-06-01T12:00:00.000000',
+    relationship='sibling',
+    msg_format='markdown',
+)
+
+
+def per_second(func, data):
+    start = perf_counter()
+    for _ in range(ACTIONS):
+        func(data)
+    return ACTIONS / (perf_counter() - start)
+
+
+def main():
+    for name, data in (('local', local_action), ('remote', remote_action)):
+        assert ApplyAction.validate_data(data) == ApplyAction.Data(**data)
+        slow = per_second(lambda d: ApplyAction.Data(**d), data)
+        fast = per_second(ApplyAction.validate_data, data)
+        print(f'{name:>6} actions: pydantic {slow:10,.0f}/s, fast path {fast:10,.0f}/s, {fast / slow:0.2f}x')
+
+
+if __name__ == '__main__':
+    main()
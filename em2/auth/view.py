@@ -1,6 +1,7 @@
 import logging
 from secrets import compare_digest
 from time import time
+from typing import List
 from urllib.parse import urlencode
 
 import bcrypt
@@ -263,15 +264,42 @@ class CheckUserNodeView(View):
         domain: str
 
     async def call(self, request):
-        auth_header = request.headers.get('Authorization', '')
+        self.check_node_auth()
+        m = self.NodeModel(**await self.request_json())
+        local = bool(await self.conn.fetchval(self.GET_USER_SQL, m.address, m.domain))
+        return json_response(local=local or self.local_domain(m.address))
+
+    def check_node_auth(self):
+        auth_header = self.request.headers.get('Authorization', '')
         if not compare_digest(self.settings.auth_node_secret, auth_header):
             logger.warning('invalid auth header: "%s"', auth_header)
             raise JsonError.HTTPForbidden(error='invalid auth header')
 
-        m = self.NodeModel(**await self.request_json())
-        local = bool(await self.conn.fetchval(self.GET_USER_SQL, m.address, m.domain))
-
+    def local_domain(self, address):
         # FIXME this is a temporary fix to avoid sending to "local" users
         # probably want a way of saying "we know the domain but this user doesn't exist"
-        local = local or get_domain(m.address) in self.settings.auth_local_domains
-        return json_response(local=local)
+        return get_domain(address) in self.settings.auth_local_domains
+
+
+class CheckUserNodesView(CheckUserNodeView):
+    """
+    Bulk version of CheckUserNodeView, finds which of many addresses are "local" to a node with one query.
+    """
+    GET_USERS_SQL = """
+    SELECT u.address FROM auth_users as u
+    JOIN auth_nodes AS n ON u.node = n.id
+    WHERE u.address = any($1) AND n.domain = $2
+    """
+
+    class NodesModel(WebModel):
+        addresses: List[str]
+        domain: str
+
+    async def call(self, request):
+        self.check_node_auth()
+        m = self.NodesModel(**await self.request_json())
+        if len(m.addresses) > self.settings.auth_check_nodes_max_addresses:
+            raise JsonError.HTTPBadRequest(error=f'at most {self.settings.auth_check_nodes_max_addresses} addresses '
+                                                 f'may be checked at once')
+        local = {r[0] for r in await self.conn.fetch(self.GET_USERS_SQL, m.addresses, m.domain)}
+        return json_response(local={a: a in local or self.local_domain(a) for a in m.addresses})
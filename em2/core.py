@@ -4,7 +4,7 @@ import logging
 import os
 from datetime import datetime
 from enum import Enum, unique
-from typing import List, NamedTuple, Optional
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
 import asyncpg
 from aiohttp.web import HTTPBadRequest, HTTPConflict
@@ -12,13 +12,25 @@ from asyncpg.pool import Pool  # noqa
 from pydantic import BaseModel, EmailStr, NoneStr, ValidationError, constr
 
 from . import Settings
+from .settings import Mode
 from .utils import to_utc_naive
+from .utils.cache import LRUCache
+from .utils.database import Connection, statements
 from .utils.encoding import to_unix_ms
+from .utils.validation import REQUIRED, FastValidator, datetime_value, enum_member, optional, str_length, strict
 from .utils.web import FetchOr404Mixin, WebModel
 
 logger = logging.getLogger('em2.core')
 
 
+# conversation keys are sha256 hex digests
+CONV_KEY_LENGTH = 64
+# Match conversation keys starting with a prefix, unlike "LIKE $1 || '%'" these operators can use the
+# text_pattern_ops index on conversations.key with a parameter. Keys are lowercase alphanumeric so all keys
+# starting with the prefix sort between the prefix and the prefix followed by "~".
+KEY_PREFIX_MATCH = "c.key ~>=~ {0}::TEXT AND c.key ~<~ ({0}::TEXT || '~')"
+
+
 def generate_conv_key(creator, ts, subject):
     to_hash = creator, to_unix_ms(ts), subject
     to_hash = '_'.join(map(str, to_hash)).encode()
@@ -96,12 +108,18 @@ class Database:
             min_size=self._settings.pg_pool_minsize,
             max_size=self._settings.pg_pool_maxsize,
             loop=self._loop,
+            connection_class=Connection,
+            # the registered statements all apply to the main database
+            init=statements.prepare if self._settings.mode == Mode.main else None,
         )
 
     def acquire(self, *, timeout=None):
         return self._pool.acquire(timeout=timeout)
 
     async def close(self):
+        statements.log_stats(logger.info)
+        logger.info('recipient cache: %s', recipient_cache.stats())
+        logger.info('conversation cache: %s', conv_cache.stats())
         return await self._pool.close()
 
 
@@ -121,41 +139,228 @@ class Action(NamedTuple):
     item: str
 
 
-GET_RECIPIENT_ID_SQL = 'SELECT id FROM recipients WHERE address = $1'
+class RecipientCache:
+    """
+    Cache of recipient address -> id, held in a bounded LRU in each process and optionally in a redis hash.
+
+    The mapping never changes once a recipient is created so entries are never invalidated, however the
+    transaction creating them might be rolled back so ids found in a transaction are held back until it commits,
+    that transaction must be started with "async with recipient_cache.transaction(conn):" for them to be added.
+    """
+    redis_key = b'recipient-ids'
+
+    def __init__(self, max_size=10_000):
+        self.local = LRUCache(max_size)
+        self.redis = None
+        # connection -> stack of ids found in each level of transaction (or savepoint) started via transaction()
+        self.pending: Dict[Connection, List[Dict[str, int]]] = {}
+
+    def configure(self, settings: Settings, redis=None):
+        self.local.max_size = settings.recipient_cache_size
+        self.redis = redis if settings.recipient_cache_redis else None
+
+    async def get_many(self, addresses) -> Tuple[Dict[str, int], Set[str]]:
+        """
+        :return: tuple (dict of cached address -> id, set of addresses not found)
+        """
+        found, missing = {}, set()
+        for address in addresses:
+            recipient_id = self.local.get(address)
+            if recipient_id is None:
+                missing.add(address)
+            else:
+                found[address] = recipient_id
+
+        if missing and self.redis:
+            missing_list = list(missing)
+            with await self.redis as redis:
+                values = await redis.hmget(self.redis_key, *missing_list)
+            for address, v in zip(missing_list, values):
+                if v is not None:
+                    found[address] = int(v)
+                    self.local.set(address, found[address])
+                    missing.remove(address)
+        return found, missing
+
+    async def set_many(self, conn, recipients: Dict[str, int]):
+        if not recipients:
+            return
+        if conn.is_in_transaction():
+            stack = self.pending.get(conn)
+            if stack:
+                stack[-1].update(recipients)
+            return
+        for address, recipient_id in recipients.items():
+            self.local.set(address, recipient_id)
+        if self.redis:
+            with await self.redis as redis:
+                await redis.hmset_dict(self.redis_key, {a: str(v) for a, v in recipients.items()})
+
+    def transaction(self, conn) -> '_RecipientCacheTransaction':
+        """
+        Start a transaction on conn, recipients found within it are added to the cache once it's committed.
+        """
+        return _RecipientCacheTransaction(self, conn)
+
+    def close(self):
+        # the redis pool is closed with the app or worker which configured the cache
+        self.redis = None
+
+    def stats(self):
+        return self.local.stats()
+
+
+class _RecipientCacheTransaction:
+    def __init__(self, cache: RecipientCache, conn):
+        self.cache = cache
+        self.conn = conn
+        self.transaction = conn.transaction()
+
+    async def __aenter__(self):
+        await self.transaction.__aenter__()
+        self.cache.pending.setdefault(self.conn, []).append({})
+
+    async def __aexit__(self, exc_type, exc, tb):
+        stack = self.cache.pending[self.conn]
+        recipients = stack.pop()
+        if not stack:
+            del self.cache.pending[self.conn]
+        await self.transaction.__aexit__(exc_type, exc, tb)
+        if exc_type is None:
+            if stack:
+                # a savepoint, ids are only safe to use once the outer transaction commits
+                stack[-1].update(recipients)
+            else:
+                await self.cache.set_many(self.conn, recipients)
+
+
+recipient_cache = RecipientCache()
+
+GET_RECIPIENT_ID_SQL = statements.add('get_recipient_id', 'SELECT id FROM recipients WHERE address = $1')
 # pointless update here should happen very rarely
-SET_RECIPIENT_ID_SQL = """
+SET_RECIPIENT_ID_SQL = statements.add('set_recipient_id', """
 INSERT INTO recipients (address) VALUES ($1)
 ON CONFLICT (address) DO UPDATE SET address=EXCLUDED.address RETURNING id
-"""
+""")
 
 
 async def get_create_recipient(conn, address):
-    recipient_id = await conn.fetchval(GET_RECIPIENT_ID_SQL, address)
+    found, _ = await recipient_cache.get_many([address])
+    recipient_id = found.get(address)
     if recipient_id is None:
-        recipient_id = await conn.fetchval(SET_RECIPIENT_ID_SQL, address)
+        recipient_id = await conn.fetchval(GET_RECIPIENT_ID_SQL, address)
+        if recipient_id is None:
+            recipient_id = await conn.fetchval(SET_RECIPIENT_ID_SQL, address)
+        await recipient_cache.set_many(conn, {address: recipient_id})
     return recipient_id
 
 
-GET_EXISTING_RECIPS_SQL = 'SELECT address, id FROM recipients WHERE address = any($1)'
-SET_MISSING_RECIPS_SQL = """
+GET_EXISTING_RECIPS_SQL = statements.add('get_existing_recips',
+                                         'SELECT address, id FROM recipients WHERE address = any($1)')
+SET_MISSING_RECIPS_SQL = statements.add('set_missing_recips', """
 INSERT INTO recipients (address) (SELECT unnest ($1::VARCHAR(255)[]))
 ON CONFLICT (address) DO UPDATE SET address=EXCLUDED.address
 RETURNING address, id
-"""
+""")
 
 
 async def create_missing_recipients(conn, addresses):
-    part_addresses = set(addresses)
-    recips = {}
+    recips, part_addresses = await recipient_cache.get_many(set(addresses))
+    if not part_addresses:
+        return recips
+
+    new_recips = {}
     for address, id in await conn.fetch(GET_EXISTING_RECIPS_SQL, part_addresses):
-        recips[address] = id
+        new_recips[address] = id
         part_addresses.remove(address)
 
     if part_addresses:
-        recips.update(dict(await conn.fetch(SET_MISSING_RECIPS_SQL, part_addresses)))
+        new_recips.update(dict(await conn.fetch(SET_MISSING_RECIPS_SQL, part_addresses)))
+    await recipient_cache.set_many(conn, new_recips)
+    recips.update(new_recips)
     return recips
 
 
+class ConvCache:
+    """
+    Cache of serialised conversations keyed by conversation id and the id of the conversation's latest action,
+    held in a size bounded LRU in each process and optionally in redis.
+
+    Every change to a conversation creates an action so entries never become stale for their key, old entries
+    are dropped from the local cache when actions are applied and expire from redis.
+    """
+    redis_prefix = b'cd:'
+
+    def __init__(self):
+        self.local: LRUCache = None
+        self.redis = None
+        self.redis_ttl = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.local is not None
+
+    def configure(self, settings: Settings, redis=None):
+        if settings.conv_cache_size:
+            self.local = LRUCache(settings.conv_cache_size, size_func=lambda v: len(v[1]))
+        self.redis_ttl = settings.conv_cache_redis_ttl
+        self.redis = redis if self.redis_ttl else None
+
+    def close(self):
+        self.redis = None
+
+    async def get(self, conv_id: int, action_id: int, variant: str) -> Optional[str]:
+        if not self.enabled or action_id is None:
+            return
+        v = self.local.get((conv_id, variant))
+        if v and v[0] == action_id:
+            self.hits += 1
+            return v[1]
+
+        if self.redis:
+            with await self.redis as redis:
+                json_str = await redis.get(self._redis_key(conv_id, action_id, variant), encoding='utf8')
+            if json_str is not None:
+                self.hits += 1
+                self.local.set((conv_id, variant), (action_id, json_str))
+                return json_str
+        self.misses += 1
+
+    async def set(self, conv_id: int, action_id: int, variant: str, json_str: str):
+        if not self.enabled or action_id is None or json_str is None:
+            return
+        self.local.set((conv_id, variant), (action_id, json_str))
+        if self.redis:
+            with await self.redis as redis:
+                await redis.setex(self._redis_key(conv_id, action_id, variant), self.redis_ttl, json_str)
+
+    def advance(self, conv_id: int):
+        """
+        Drop local entries for a conversation, called once new actions have been applied.
+        """
+        if self.enabled:
+            for variant in ConvCacheVariants:
+                self.local.pop((conv_id, variant))
+
+    def _redis_key(self, conv_id, action_id, variant):
+        return self.redis_prefix + f'{conv_id}:{action_id}:{variant.value}'.encode()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=self.local and self.local.stats()['size'])
+
+
+@unique
+class ConvCacheVariants(str, Enum):
+    conv = 'conv'
+    conv_inc_summary = 'conv-summary'
+    ui_actions = 'ui-actions'
+
+
+conv_cache = ConvCache()
+
+
 class ApplyAction(FetchOr404Mixin):
     class Data(WebModel):
         action_key: constr(min_length=20, max_length=20)
@@ -181,62 +386,164 @@ class ApplyAction(FetchOr404Mixin):
     create_action_auto_ts_sql = """
     INSERT INTO actions (key, conv, verb, component, actor, parent, recipient, message, body)
     VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-    RETURNING id, to_json(timestamp)
+    RETURNING id, timestamp, to_json(timestamp)
     """
 
+    # checks matching the fields of Data, used to skip pydantic validation for simple valid actions
+    _validate_fast = FastValidator(Data, {
+        'action_key': (str_length(20, 20), REQUIRED),
+        'conv': (strict(int), REQUIRED),
+        'verb': (enum_member(Verbs), REQUIRED),
+        'component': (enum_member(Components), REQUIRED),
+        'actor': (strict(int), REQUIRED),
+        'published': (strict(bool), True),
+        'timestamp': (optional(datetime_value), None),
+        'item': (optional(str_length(max_length=255)), None),
+        'parent': (optional(str_length(20, 20)), None),
+        'body': (optional(str_length()), None),
+        'relationship': (optional(enum_member(Relationships)), None),
+        'msg_format': (optional(enum_member(MsgFormat)), MsgFormat.markdown),
+    })
+
     def __init__(self, conn, remote_action: bool, **data):
         self.conn = conn
         self._remote_action = remote_action
-        self.data = self.Data(**data)
+        self.data = self.validate_data(data)
         self.item_key = None
         self.action_id = None
         self.action_timestamp = None
+        self.timestamp = None
+        self.parent_id = None
+        # relationship and format of the action's message, see Action
+        self.msg_relationship = None
+        self.msg_format = None
         self.body = None
+        # whether the action had already been applied, eg. because the node sending it retried the request
+        self.duplicate = False
 
     async def run(self):
-        # TODO replace with method validation on Data
-        if self.data.component not in {Components.SUBJECT}:
-            if self.data.verb == Verbs.MODIFY and not self.data.item:
+        self.check()
+        if self._remote_action:
+            await self.find_duplicates(self.conn, [self])
+            if self.duplicate:
+                return
+        try:
+            async with recipient_cache.transaction(self.conn):
+                await self.apply()
+        except asyncpg.UniqueViolationError:
+            if not self._remote_action:
+                raise
+            # the same action may have been applied concurrently, check again now the transaction has finished
+            await self.find_duplicates(self.conn, [self])
+            if not self.duplicate:
+                raise
+            return
+        conv_cache.advance(self.data.conv)
+
+    # one probe on the (conv, key) unique index for remote actions which might already have been applied
+    _existing_actions_sql = """
+    SELECT a.key, a.id, a.verb, a.component, a.actor, a.timestamp, parent.key, coalesce(m.key, r.address), a.body
+    FROM actions AS a
+    LEFT JOIN actions AS parent ON a.parent = parent.id
+    LEFT JOIN messages AS m ON a.message = m.id
+    LEFT JOIN recipients AS r ON a.recipient = r.id
+    WHERE a.conv = $1 AND a.key = any($2)
+    """
+
+    @classmethod
+    async def find_duplicates(cls, conn, apply_actions: List['ApplyAction']):
+        """
+        Find actions which have already been applied, they get the existing action's id and are marked as
+        duplicates so they're not applied again. Raises HTTPConflict if an action with the same key but different
+        content exists.
+        """
+        by_key = {apply_action.data.action_key: apply_action for apply_action in apply_actions}
+        rows = await conn.fetch(cls._existing_actions_sql, apply_actions[0].data.conv, list(by_key))
+        for key, action_id, *values in rows:
+            apply_action = by_key[key]
+            if not apply_action._same_action(*values):
+                raise HTTPConflict(text=f'action "{key}" already exists with different content')
+            apply_action.action_id = action_id
+            apply_action.duplicate = True
+
+    def _same_action(self, verb, component, actor, timestamp, parent_key, item_key, body):
+        d = self.data
+        return (
+            (verb, component, actor) == (d.verb, d.component, d.actor)
+            and d.timestamp is not None and timestamp == to_utc_naive(d.timestamp)
+            # parent, item and body are only saved for some actions
+            and parent_key in {None, d.parent}
+            and item_key in {None, d.item}
+            and body in {None, d.body}
+        )
+
+    @classmethod
+    def validate_data(cls, data: dict) -> Data:
+        # full validation is only required to generate errors or coerce unusual values
+        m = cls._validate_fast(data)
+        return cls.Data(**data) if m is None else m
+
+    def check(self):
+        """
+        Checks which don't require the database, called before the transaction is started.
+        """
+        if self.data.component not in self._item_optional_components:
+            if self.data.verb is Verbs.MODIFY and not self.data.item:
                 raise HTTPBadRequest(text=f'item may not be null for modify actions')
             if self._remote_action and not self.data.item:
                 raise HTTPBadRequest(text=f'item may not be null for remote actions')
 
-        self.item_key, recipient_id, message_id, parent_id = None, None, None, None
-        async with self.conn.transaction():
-            if self.data.component is Components.MESSAGE:
-                if self.data.verb is Verbs.ADD:
-                    self.item_key, message_id, parent_id = await self._add_message()
-                else:
-                    self.item_key, message_id, parent_id = await self._mod_message()
-            elif self.data.component is Components.PARTICIPANT:
-                if self.data.verb is Verbs.ADD:
-                    self.item_key, recipient_id = await self._add_participant()
-                else:
-                    self.item_key, recipient_id = await self._mod_participant()
-            elif self.data.component is Components.SUBJECT:
-                parent_id = await self._mod_subject()
+    async def apply(self):
+        """
+        Apply the action, must be called inside a transaction.
+        """
+        try:
+            apply_method = self._apply_dispatch[(self.data.component, self.data.verb)]
+        except KeyError:
+            raise NotImplementedError()
+        self.item_key, recipient_id, message_id, self.parent_id = await apply_method(self)
 
-            else:
-                raise NotImplementedError()
-
-            args = (
-                self.data.action_key,
-                self.data.conv,
-                self.data.verb,
-                self.data.component,
-                self.data.actor,
-                parent_id,
-                recipient_id,
-                message_id,
-                self.body,
+        args = (
+            self.data.action_key,
+            self.data.conv,
+            self.data.verb,
+            self.data.component,
+            self.data.actor,
+            self.parent_id,
+            recipient_id,
+            message_id,
+            self.body,
+        )
+        if self._remote_action:
+            self.timestamp = to_utc_naive(self.data.timestamp)
+            self.action_id = await self.conn.fetchval(self.create_action_sql, *args, self.timestamp)
+        else:
+            self.action_id, self.timestamp, action_timestamp = await self.conn.fetchrow(
+                self.create_action_auto_ts_sql, *args
             )
-            if self._remote_action:
-                args += to_utc_naive(self.data.timestamp),
-                self.action_id = await self.conn.fetchval(self.create_action_sql, *args)
-            else:
-                self.action_id, action_timestamp = await self.conn.fetchrow(self.create_action_auto_ts_sql, *args)
-                # remove quotes added by to_json
-                self.action_timestamp = action_timestamp[1:-1]
+            # remove quotes added by to_json
+            self.action_timestamp = action_timestamp[1:-1]
+
+    def action(self, conv_key: str, actor_address: str) -> Action:
+        """
+        The applied action as Pusher would read it with action_detail_sql, so it can be pushed without
+        reading it back from the database.
+        """
+        return Action(
+            self.action_id,
+            self.data.action_key,
+            conv_key,
+            self.data.conv,
+            self.data.verb,
+            self.data.component,
+            actor_address,
+            self.timestamp,
+            self.data.parent if self.parent_id else None,
+            self.body,
+            self.msg_relationship,
+            self.msg_format,
+            self.item_key,
+        )
 
     _find_msg_by_action_sql = """
     SELECT m.id, m.deleted, m.position, a.id
@@ -274,6 +581,7 @@ class ApplyAction(FetchOr404Mixin):
         else:
             message_key = gen_random('msg')
         relationship = self.data.relationship or Relationships.SIBLING
+        self.msg_relationship, self.msg_format = relationship, self.data.msg_format
         if relationship == Relationships.SIBLING:
             position[-1] += 1
         else:
@@ -281,10 +589,10 @@ class ApplyAction(FetchOr404Mixin):
             position.append(1)
         args = message_key, self.data.conv, after_id, relationship, position, self.body, self.data.msg_format
         message_id = await self.conn.fetchval(self._add_message_sql, *args)
-        return message_key, message_id, parent_id
+        return message_key, None, message_id, parent_id
 
     _find_message_by_key_sql = """
-    SELECT m.id
+    SELECT m.id, m.relationship, m.format
     FROM messages AS m
     WHERE m.conv = $1 AND m.key = $2
     """
@@ -300,7 +608,9 @@ class ApplyAction(FetchOr404Mixin):
 
     async def _mod_message(self):
         message_key = self.data.item
-        message_id = await self.fetchval404(self._find_message_by_key_sql, self.data.conv, message_key)
+        message_id, self.msg_relationship, self.msg_format = await self.fetchrow404(
+            self._find_message_by_key_sql, self.data.conv, message_key
+        )
 
         r = await self.conn.fetchrow(
             self._latest_message_action_sql,
@@ -335,6 +645,7 @@ class ApplyAction(FetchOr404Mixin):
             if not self.data.msg_format:
                 raise HTTPBadRequest(text='msg-format may not be null when modifying a message')
             self.body = self.data.body
+            self.msg_format = self.data.msg_format
             await self.conn.execute(self._modify_message_sql, self.body, self.data.msg_format, message_id)
         elif self.data.verb in (Verbs.LOCK, Verbs.UNLOCK):
             if parent_verb == self.data.verb:
@@ -344,7 +655,7 @@ class ApplyAction(FetchOr404Mixin):
             # change permissions etc. when they're implemented
             raise NotImplementedError()
         # lock and unlock don't change the message
-        return message_key, message_id, parent_id
+        return message_key, None, message_id, parent_id
 
     _add_participant_sql = """
     INSERT INTO participants (conv, recipient) VALUES ($1, $2)
@@ -361,7 +672,7 @@ class ApplyAction(FetchOr404Mixin):
         prt_id = await self.conn.fetchval(self._add_participant_sql, self.data.conv, recipient_id)
         if prt_id is None:
             raise HTTPConflict(text='participant already exists on the conversation')
-        return address, recipient_id
+        return address, recipient_id, None, None
 
     _find_participant_sql = """
     SELECT p.id, r.id FROM participants AS p
@@ -381,17 +692,18 @@ class ApplyAction(FetchOr404Mixin):
             raise NotImplementedError()
         else:
             raise HTTPBadRequest(text=f'Invalid verb for participants, can only add, delete, recover or modify')
-        return address, recipient_id
+        return address, recipient_id, None, None
 
+    # each branch is a single probe on the action_conv_component_verb_id index
     _latest_subject_action_sql = """
-    SELECT id, key
-    FROM actions
-    WHERE conv = $1 AND
-      (
-        (component IS NULL AND verb IN ('publish', 'create'))
-        OR
-        (component='subject' AND verb='modify')
-      )
+    SELECT id, key FROM (
+      (SELECT id, key FROM actions WHERE conv = $1 AND component IS NULL AND verb = 'publish' ORDER BY id DESC LIMIT 1)
+      UNION ALL
+      (SELECT id, key FROM actions WHERE conv = $1 AND component IS NULL AND verb = 'create' ORDER BY id DESC LIMIT 1)
+      UNION ALL
+      (SELECT id, key FROM actions WHERE conv = $1 AND component = 'subject' AND verb = 'modify'
+       ORDER BY id DESC LIMIT 1)
+    ) AS t
     ORDER BY id DESC
     LIMIT 1
     """
@@ -407,64 +719,129 @@ class ApplyAction(FetchOr404Mixin):
 
         self.body = self.data.body
         await self.conn.execute(self._mod_subject_sql, self.body, self.data.conv)
-        return parent_id
+        return None, None, None, parent_id
 
+    # (component, verb) -> method applying the action, each returns (item_key, recipient_id, message_id, parent_id),
+    # verbs which aren't valid for a component are rejected by the method so the error explains why
+    _apply_dispatch = {
+        **dict.fromkeys([(Components.MESSAGE, v) for v in Verbs], _mod_message),
+        (Components.MESSAGE, Verbs.ADD): _add_message,
+        **dict.fromkeys([(Components.PARTICIPANT, v) for v in Verbs], _mod_participant),
+        (Components.PARTICIPANT, Verbs.ADD): _add_participant,
+        **dict.fromkeys([(Components.SUBJECT, v) for v in Verbs], _mod_subject),
+    }
+    _item_optional_components = frozenset({Components.SUBJECT})
 
-class GetConv(FetchOr404Mixin):
-    get_conv_id_sql = """
-    SELECT c.id FROM conversations AS c
-    JOIN participants AS p ON c.id = p.conv
-    JOIN recipients AS r ON p.recipient = r.id
-    WHERE r.address = $1 AND c.key LIKE $2
-    ORDER BY c.created_ts, c.id DESC
-    LIMIT 1
+
+class ApplyActionBatch:
+    """
+    Apply an ordered list of actions to one conversation in a single transaction.
+
+    Actions may use earlier actions in the batch as their parent, the chain of parents within the batch
+    is checked once before any database work is done.
     """
+    def __init__(self, conn, remote_action: bool, actions: List[dict], **shared):
+        self.conn = conn
+        self.remote_action = remote_action
+        # shared values take precedence so eg. the actor can't be overridden by individual actions
+        self.actions = [ApplyAction(conn, remote_action, **{**action, **shared}) for action in actions]
+
+    def check(self):
+        if not self.actions:
+            raise HTTPBadRequest(text='no actions to apply')
+
+        positions = {}
+        for i, apply_action in enumerate(self.actions):
+            apply_action.check()
+            action_key = apply_action.data.action_key
+            if action_key in positions:
+                raise HTTPBadRequest(text=f'action key "{action_key}" repeated in batch')
+            positions[action_key] = i
+
+        for i, apply_action in enumerate(self.actions):
+            parent_position = positions.get(apply_action.data.parent)
+            if parent_position is not None and parent_position >= i:
+                raise HTTPBadRequest(text=f'parent "{apply_action.data.parent}" must come before its child in batch')
+
+    async def run(self):
+        self.check()
+        if self.remote_action:
+            # actions from batches which were resent are skipped, the rest of the batch is still applied
+            await ApplyAction.find_duplicates(self.conn, self.actions)
+        try:
+            await self._apply_new()
+        except asyncpg.UniqueViolationError:
+            if not self.remote_action:
+                raise
+            # some actions may have been applied concurrently, check again and apply the rest if any were found
+            duplicates = sum(apply_action.duplicate for apply_action in self.actions)
+            await ApplyAction.find_duplicates(self.conn, self.actions)
+            if sum(apply_action.duplicate for apply_action in self.actions) == duplicates:
+                raise
+            await self._apply_new()
+
+    async def _apply_new(self):
+        new_actions = [apply_action for apply_action in self.actions if not apply_action.duplicate]
+        if new_actions:
+            async with recipient_cache.transaction(self.conn):
+                for apply_action in new_actions:
+                    await apply_action.apply()
+            conv_cache.advance(self.actions[0].data.conv)
+
+    @property
+    def action_ids(self) -> List[int]:
+        return [apply_action.action_id for apply_action in self.actions]
 
-    conv_details_sql = """
+
+class GetConv(FetchOr404Mixin):
+    """
+    Build the full conversation document in a single statement, each part is a sub query on "conv.id".
+    """
+    _details_part = """
     SELECT row_to_json(t)
     FROM (
       SELECT c.key AS key, c.subject AS subject, c.created_ts AS created_ts, r.address AS creator,
         c.published AS published
       FROM conversations AS c
       JOIN recipients AS r ON c.creator = r.id
-      WHERE c.id = $1
-    ) t;
+      WHERE c.id = conv.id
+    ) t
     """
 
-    conv_details_inc_summary_sql = """
+    _details_inc_summary_part = """
     SELECT row_to_json(t)
     FROM (
       SELECT c.key AS key, c.subject AS subject, c.created_ts AS created_ts, c.updated_ts as updated_ts,
         r.address AS creator, c.published AS published, c.snippet AS snippet
       FROM conversations AS c
       JOIN recipients AS r ON c.creator = r.id
-      WHERE c.id = $1
-    ) t;
+      WHERE c.id = conv.id
+    ) t
     """
 
-    messages_sql = """
+    _messages_part = """
     SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
     FROM (
       SELECT m1.key AS key, m2.key AS after, m1.relationship AS relationship, m1.body AS body, m1.format AS format,
         m1.deleted AS deleted
       FROM messages AS m1
       LEFT JOIN messages AS m2 ON m1.after = m2.id
-      WHERE m1.conv = $1
+      WHERE m1.conv = conv.id
       ORDER BY m1.position, m1.id
-    ) t;
+    ) t
     """
 
-    participants_sql = """
+    _participants_part = """
     SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
     FROM (
       SELECT r.address AS address
       FROM participants AS p
       JOIN recipients AS r ON p.recipient = r.id
-      WHERE p.conv = $1
-    ) t;
+      WHERE p.conv = conv.id
+    ) t
     """
 
-    actions_sql = """
+    _actions_part_template = """
     SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
     FROM (
       SELECT a.key AS key, a.verb AS verb, a.component AS component, a.body AS body, a.timestamp AS timestamp,
@@ -480,44 +857,184 @@ class GetConv(FetchOr404Mixin):
       JOIN recipients AS actor_recipient ON a.actor = actor_recipient.id
 
       LEFT JOIN recipients AS prt_recipient ON a.recipient = prt_recipient.id
-      WHERE a.conv = $1
+      WHERE {where}
       ORDER BY a.id
-    ) t;
+    ) t
     """
+    _actions_part = _actions_part_template.format(where='a.conv = conv.id')
 
-    action_states_sql = """
+    _action_states_part = """
     SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
     FROM (
       SELECT a.key AS action, s.ref AS ref, s.status AS status, s.node AS node, s.errors AS errors
       FROM action_states AS s
       JOIN actions AS a ON s.action = a.id
-      WHERE a.conv = $1
+      WHERE a.conv = conv.id
       ORDER BY a.id
-    ) t;
+    ) t
+    """
+
+    _conv_id_part = """
+    SELECT c.id FROM conversations AS c
+    JOIN participants AS p ON c.id = p.conv
+    JOIN recipients AS r ON p.recipient = r.id
+    WHERE r.address = $1 AND {key_match}
+    ORDER BY c.created_ts, c.id DESC
+    LIMIT 1
+    """.format(key_match=KEY_PREFIX_MATCH.format('$2'))
+
+    _conv_template = """
+    WITH conv AS ({conv_id})
+    SELECT json_build_object(
+      'details', ({details}),
+      'messages', ({messages}),
+      'participants', ({participants}),
+      'actions', ({actions}){extra}
+    )::text
+    FROM conv
+    """
+    _states_extra = f",\n      'action_states', ({_action_states_part})"
+
+    _common_parts = dict(
+        conv_id=_conv_id_part, messages=_messages_part, participants=_participants_part, actions=_actions_part
+    )
+    # fixed variants so each can be prepared
+    conv_sql = _conv_template.format(details=_details_part, extra='', **_common_parts)
+    conv_inc_states_sql = _conv_template.format(details=_details_part, extra=_states_extra, **_common_parts)
+    conv_inc_summary_sql = _conv_template.format(details=_details_inc_summary_part, extra='', **_common_parts)
+    conv_inc_summary_states_sql = _conv_template.format(
+        details=_details_inc_summary_part, extra=_states_extra, **_common_parts
+    )
+
+    # used with the conversation cache: find the conversation and its latest action, then build it by id on a miss
+    conv_last_action_sql = f"""
+    SELECT conv.id, (SELECT max(a.id) FROM actions AS a WHERE a.conv = conv.id)
+    FROM ({_conv_id_part}) AS conv
+    """
+    _by_id_parts = {**_common_parts, 'conv_id': 'SELECT $1::INT AS id'}
+    conv_by_id_sql = _conv_template.format(details=_details_part, extra='', **_by_id_parts)
+    conv_by_id_inc_summary_sql = _conv_template.format(details=_details_inc_summary_part, extra='', **_by_id_parts)
+
+    # the conversation's latest snapshot (see ConvSnapshots) and the actions since it
+    _conv_snapshot_template = """
+    WITH conv AS (
+      SELECT conv.id, s.id AS snapshot, coalesce(s.action, 0) AS snapshot_action
+      FROM ({conv_id}) AS conv
+      LEFT JOIN LATERAL (
+        SELECT s.id, s.action FROM conv_snapshots AS s WHERE s.conv = conv.id ORDER BY s.action DESC LIMIT 1
+      ) AS s ON TRUE
+    )
+    SELECT json_build_object(
+      'details', ({details}),
+      'snapshot', ({snapshot}),
+      'actions', ({actions})
+    )::text
+    FROM conv
+    """
+    _snapshot_part = """
+    SELECT json_build_object('action', a.key, 'state', s.data)
+    FROM conv_snapshots AS s
+    JOIN actions AS a ON s.action = a.id
+    WHERE s.id = conv.snapshot
     """
+    _snapshot_parts = dict(
+        conv_id=_conv_id_part,
+        snapshot=_snapshot_part,
+        actions=_actions_part_template.format(where='a.conv = conv.id AND a.id > conv.snapshot_action'),
+    )
+    conv_snapshot_sql = _conv_snapshot_template.format(details=_details_part, **_snapshot_parts)
+    conv_snapshot_inc_summary_sql = _conv_snapshot_template.format(details=_details_inc_summary_part, **_snapshot_parts)
 
     def __init__(self, conn):
         self.conn = conn
 
-    async def run(self, conv_key, participant_address, inc_summary=False, inc_states=False):
-        conv_id = await self.fetchval404(
-            self.get_conv_id_sql,
+    async def run(self, conv_key, participant_address, inc_summary=False, inc_states=False, snapshot=False):
+        """
+        :param snapshot: whether to return the conversation's latest snapshot and actions since it rather than
+          all actions, messages and participants
+        """
+        if snapshot:
+            sql = self.conv_snapshot_inc_summary_sql if inc_summary else self.conv_snapshot_sql
+            return await self.fetchval404(sql, participant_address, conv_key, msg=f'conversation {conv_key} not found')
+
+        if inc_states or not conv_cache.enabled:
+            # action states can change without a new action so are never cached
+            if inc_summary:
+                sql = self.conv_inc_summary_states_sql if inc_states else self.conv_inc_summary_sql
+            else:
+                sql = self.conv_inc_states_sql if inc_states else self.conv_sql
+            return await self.fetchval404(sql, participant_address, conv_key, msg=f'conversation {conv_key} not found')
+
+        conv_id, last_action_id = await self.fetchrow404(
+            self.conv_last_action_sql,
             participant_address,
-            conv_key + '%',
+            conv_key,
             msg=f'conversation {conv_key} not found'
         )
-        conv_details_sql = self.conv_details_inc_summary_sql if inc_summary else self.conv_details_sql
-        fields = [
-            ('details', await self.conn.fetchval(conv_details_sql, conv_id)),
-            ('messages', await self.conn.fetchval(self.messages_sql, conv_id)),
-            ('participants', await self.conn.fetchval(self.participants_sql, conv_id)),
-            ('actions', await self.conn.fetchval(self.actions_sql, conv_id)),
-        ]
-        if inc_states:
-            fields.append(
-                ('action_states', await self.conn.fetchval(self.action_states_sql, conv_id))
-            )
-        return '{' + ','.join(f'"{k}":{"null" if v is None else v}' for k, v in fields) + '}'
+        variant = ConvCacheVariants.conv_inc_summary if inc_summary else ConvCacheVariants.conv
+        json_str = await conv_cache.get(conv_id, last_action_id, variant)
+        if json_str is None:
+            sql = self.conv_by_id_inc_summary_sql if inc_summary else self.conv_by_id_sql
+            json_str = await self.conn.fetchval(sql, conv_id)
+            await conv_cache.set(conv_id, last_action_id, variant, json_str)
+        return json_str
+
+
+class ConvSnapshots:
+    """
+    Materialised snapshots of conversations' subject, messages and participants as of an action so
+    conversations can be read as their latest snapshot plus the actions since it.
+
+    Run periodically to snapshot recently updated conversations with enough actions since their last snapshot,
+    older snapshots are then deleted.
+    """
+    find_convs_sql = """
+    SELECT c.id FROM conversations AS c
+    WHERE c.published AND c.updated_ts > CURRENT_TIMESTAMP - $3::INTERVAL AND (
+      SELECT count(*) FROM (
+        SELECT 1 FROM actions AS a
+        WHERE a.conv = c.id AND a.id > coalesce((SELECT max(s.action) FROM conv_snapshots AS s WHERE s.conv = c.id), 0)
+        LIMIT $1
+      ) AS t
+    ) >= $1
+    LIMIT $2
+    """
+    create_snapshot_sql = f"""
+    INSERT INTO conv_snapshots (conv, action, data)
+    SELECT conv.id, (SELECT max(a.id) FROM actions AS a WHERE a.conv = conv.id), json_build_object(
+      'subject', conv.subject,
+      'messages', ({GetConv._messages_part}),
+      'participants', ({GetConv._participants_part})
+    )
+    FROM conversations AS conv
+    WHERE conv.id = $1
+    ON CONFLICT (conv, action) DO NOTHING
+    RETURNING action
+    """
+    prune_snapshots_sql = 'DELETE FROM conv_snapshots WHERE conv = $1 AND action < $2'
+
+    def __init__(self, conn, settings: Settings):
+        self.conn = conn
+        self.settings = settings
+
+    async def run(self) -> int:
+        """
+        :return: number of conversations snapshotted
+        """
+        conv_ids = await self.conn.fetch(
+            self.find_convs_sql,
+            self.settings.snapshot_min_actions,
+            self.settings.snapshot_batch_size,
+            self.settings.snapshot_max_age,
+        )
+        count = 0
+        for conv_id, in conv_ids:
+            async with self.conn.transaction():
+                action_id = await self.conn.fetchval(self.create_snapshot_sql, conv_id)
+                if action_id:
+                    await self.conn.execute(self.prune_snapshots_sql, conv_id, action_id)
+                    count += 1
+        return count
 
 
 class _ConvDetails(BaseModel):
@@ -560,20 +1077,23 @@ class FullConv(BaseModel):
 
 
 class CreateForeignConv:
+    """
+    Create a conversation from a foreign platform with a constant number of queries: ids for messages and actions
+    are allocated up front so "after" and "parent" can be resolved before rows are copied into their tables.
+    """
     create_conv_sql = """
     INSERT INTO conversations (key, creator, subject, created_ts, published)
     VALUES ($1, $2, $3, $4, TRUE) RETURNING id
     """
-    add_participants_sql = 'INSERT INTO participants (conv, recipient) VALUES ($1, $2)'
-    add_message_sql = """
-    INSERT INTO messages (conv, key, body, deleted, after, relationship)
-    VALUES ($1, $2, $3, $4, $5, $6) RETURNING id
-    """
-    create_action_sql = """
-    INSERT INTO actions (key, conv, verb, component, actor, parent, recipient, message, body, timestamp)
-    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-    RETURNING id
+    allocate_ids_sql = """
+    SELECT
+      (SELECT array_agg(nextval('messages_id_seq')) FROM generate_series(1, $1)),
+      (SELECT array_agg(nextval('actions_id_seq')) FROM generate_series(1, $2))
     """
+    participant_columns = 'conv', 'recipient'
+    message_columns = 'id', 'conv', 'key', 'body', 'deleted', 'after', 'relationship'
+    action_columns = 'id', 'key', 'conv', 'verb', 'component', 'actor', 'parent', 'recipient', 'message', 'body', \
+        'timestamp'
 
     def __init__(self, conn):
         self.conn = conn
@@ -585,7 +1105,7 @@ class CreateForeignConv:
             logger.warning('invalid conversation data:\n%s', e)
         else:
             if any(a.key == trigger_action_key for a in conv.actions):
-                async with self.conn.transaction():
+                async with recipient_cache.transaction(self.conn):
                     return await self._trans(conv, trigger_action_key)
             else:
                 logger.warning('invalid conversation no listed action matches trigger action: %s', trigger_action_key)
@@ -593,34 +1113,42 @@ class CreateForeignConv:
     async def _trans(self, conv: FullConv, trigger_action_key: str):
         deets = conv.details
 
-        creator_recip_id = await get_create_recipient(self.conn, deets.creator)
-        conv_id = await self.conn.fetchval(self.create_conv_sql, deets.key, creator_recip_id, deets.subject, deets.ts)
+        addresses = {deets.creator}
+        addresses.update(p.address for p in conv.participants)
+        addresses.update(a.actor for a in conv.actions or [])
+        addresses.update(a.participant for a in conv.actions or [] if a.participant)
+        recip_lookup = await create_missing_recipients(self.conn, addresses)
 
-        recip_lookup = await create_missing_recipients(self.conn, [p.address for p in conv.participants])
-        await self.conn.executemany(
-            self.add_participants_sql,
-            {(conv_id, recip_lookup[p.address]) for p in conv.participants}
+        conv_id = await self.conn.fetchval(
+            self.create_conv_sql, deets.key, recip_lookup[deets.creator], deets.subject, deets.ts
         )
+        await self.conn.copy_records_to_table(
+            'participants',
+            records={(conv_id, recip_lookup[p.address]) for p in conv.participants},
+            columns=self.participant_columns,
+        )
+
+        action_count = len(conv.actions) if conv.actions is not None else 0
+        msg_ids, action_ids = await self.conn.fetchrow(self.allocate_ids_sql, len(conv.messages), action_count)
 
         msg_lookup = {}
-        for msg in conv.messages:
-            after_id = None
-            if msg.after:
-                # TODO deal with KeyError
-                after_id = msg_lookup[msg.after]
-            msg_lookup[msg.key] = await self.conn.fetchval(
-                self.add_message_sql,
-                conv_id, msg.key, msg.body, msg.deleted, after_id, msg.relationship
-            )
+        msg_records = []
+        for msg, msg_id in zip(conv.messages, msg_ids or []):
+            # TODO deal with KeyError
+            after_id = msg.after and msg_lookup[msg.after]
+            msg_lookup[msg.key] = msg_id
+            msg_records.append((msg_id, conv_id, msg.key, msg.body, msg.deleted, after_id, msg.relationship))
+        if msg_records:
+            await self.conn.copy_records_to_table('messages', records=msg_records, columns=self.message_columns)
 
         if conv.actions is None:
             return
 
-        recip_lookup[deets.creator] = creator_recip_id
         action_lookup = {}
-        for action in conv.actions:
-            action_lookup[action.key] = await self.conn.fetchval(
-                self.create_action_sql,
+        action_records = []
+        for action, action_id in zip(conv.actions, action_ids):
+            action_records.append((
+                action_id,
                 action.key,
                 conv_id,
                 action.verb,
@@ -631,5 +1159,10 @@ class CreateForeignConv:
                 action.message and msg_lookup[action.message],
                 action.body if action.component == Components.MESSAGE else None,
                 action.ts,
-            )
+            ))
+            action_lookup[action.key] = action_id
+        await self.conn.copy_records_to_table('actions', records=action_records, columns=self.action_columns)
         return conv_id, action_lookup[trigger_action_key]
+
+
+statements.register(ApplyAction, GetConv, ConvSnapshots, CreateForeignConv)
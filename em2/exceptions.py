@@ -25,4 +25,9 @@ class FallbackPushError(Em2Exception):
 
 
 class Em2ConnectionError(Em2Exception):
-    pass
+    def __init__(self, msg, *, temporary=True, status=None):
+        super().__init__(msg)
+        # whether the request might succeed if tried later, eg. connection errors and 5xx responses
+        self.temporary = temporary
+        # status of the response, None if no response was received
+        self.status = status
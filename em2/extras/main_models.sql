@@ -17,9 +17,15 @@ CREATE TABLE conversations (
   created_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   updated_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   subject VARCHAR(255) NOT NULL,
-  snippet JSONB
+  snippet JSONB,
+  -- maintained by triggers on participants and messages, used to build the snippet
+  prt_count INT NOT NULL DEFAULT 0,
+  msg_count INT NOT NULL DEFAULT 0,
+  last_msg INT
   -- TODO expiry, ref?
 );
+-- used to find conversations by key prefix, see core.KEY_PREFIX_MATCH
+CREATE INDEX conversation_key_pattern ON conversations USING btree (key text_pattern_ops);
 
 CREATE TABLE participants (
   id SERIAL PRIMARY KEY,
@@ -29,6 +35,20 @@ CREATE TABLE participants (
   UNIQUE (conv, recipient)
 );
 
+CREATE OR REPLACE FUNCTION participant_changed() RETURNS trigger AS $$
+  BEGIN
+    IF TG_OP = 'INSERT' THEN
+      UPDATE conversations SET prt_count=prt_count + 1 WHERE id=NEW.conv;
+    ELSE
+      UPDATE conversations SET prt_count=prt_count - 1 WHERE id=OLD.conv;
+    END IF;
+    RETURN NULL;
+  END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER participant_change AFTER INSERT OR DELETE ON participants
+  FOR EACH ROW EXECUTE PROCEDURE participant_changed();
+
 -- see core.Relationships enum which matches this
 CREATE TYPE RELATIONSHIP AS ENUM ('sibling', 'child');
 CREATE TYPE MSG_FORMAT AS ENUM ('markdown', 'plain', 'html');
@@ -47,6 +67,25 @@ CREATE TABLE messages (
 );
 CREATE INDEX message_key ON messages USING btree (key);
 
+CREATE OR REPLACE FUNCTION message_changed() RETURNS trigger AS $$
+  BEGIN
+    IF TG_OP = 'INSERT' THEN
+      UPDATE conversations SET msg_count=msg_count + 1, last_msg=greatest(last_msg, NEW.id) WHERE id=NEW.conv;
+    ELSE
+      UPDATE conversations SET msg_count=msg_count - 1, last_msg=CASE WHEN last_msg=OLD.id THEN
+        (SELECT max(id) FROM messages WHERE conv=OLD.conv)
+      ELSE
+        last_msg
+      END
+      WHERE id=OLD.conv;
+    END IF;
+    RETURN NULL;
+  END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER message_change AFTER INSERT OR DELETE ON messages
+  FOR EACH ROW EXECUTE PROCEDURE message_changed();
+
 -- see core.Verbs enum which matches this
 CREATE TYPE VERB AS ENUM ('create', 'publish', 'add', 'modify', 'delete', 'recover', 'lock', 'unlock');
 -- see core.Components enum which matches this
@@ -69,13 +108,20 @@ CREATE TABLE actions (
   UNIQUE (conv, key)
 );
 CREATE INDEX action_key ON actions USING btree (key);
+-- per conversation access patterns: all actions in order, latest action for a message and latest action
+-- of a given component and verb eg. ApplyAction._latest_message_action_sql and _latest_subject_action_sql
+CREATE INDEX action_conv_id ON actions USING btree (conv, id);
+CREATE INDEX action_conv_message_id ON actions USING btree (conv, message, id DESC);
+CREATE INDEX action_conv_component_verb_id ON actions USING btree (conv, component, verb, id DESC);
 
 -- this could be run on every "migration"
 CREATE OR REPLACE FUNCTION action_inserted() RETURNS trigger AS $$
   -- could replace all this with plv8
-  DECLARE
+  BEGIN
+    -- update the conversation timestamp and snippet on new actions, counts come from the conversation's counters
+    -- so the cost doesn't grow with the size of the conversation
     -- TODO add actor name when we have it, could add attachment count etc. here too
-    snippet_ JSONB = json_build_object(
+    UPDATE conversations AS c SET updated_ts=NEW.timestamp, snippet=jsonb_build_object(
       'comp', NEW.component,
       'verb', NEW.verb,
       'addr', (SELECT address FROM recipients WHERE id=NEW.actor),
@@ -83,21 +129,31 @@ CREATE OR REPLACE FUNCTION action_inserted() RETURNS trigger AS $$
           CASE WHEN NEW.component='message' AND NEW.body IS NOT NULL THEN
             NEW.body
           ELSE
-            (SELECT body FROM messages WHERE conv=NEW.conv ORDER BY id DESC LIMIT 1)
+            (SELECT body FROM messages WHERE id=c.last_msg)
           END, 100
       ),
-      'prts', (SELECT COUNT(*) FROM participants WHERE conv=NEW.conv),
-      'msgs', (SELECT COUNT(*) FROM messages WHERE conv=NEW.conv)
-    );
-  BEGIN
-    -- update the conversation timestamp and snippet on new actions
-    UPDATE conversations SET updated_ts=NEW.timestamp, snippet=snippet_ WHERE id=NEW.conv;
+      'prts', c.prt_count,
+      'msgs', c.msg_count
+    )
+    WHERE c.id=NEW.conv;
     RETURN NULL;
   END;
 $$ LANGUAGE plpgsql;
 
 CREATE TRIGGER action_insert AFTER INSERT ON actions FOR EACH ROW EXECUTE PROCEDURE action_inserted();
 
+-- see core.ConvSnapshots
+CREATE TABLE conv_snapshots (
+  id SERIAL PRIMARY KEY,
+  conv INT NOT NULL REFERENCES conversations ON DELETE CASCADE,
+  -- the snapshot is the state of the conversation as of this action
+  action INT NOT NULL REFERENCES actions ON DELETE CASCADE,
+  created_ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  data JSONB NOT NULL,
+  UNIQUE (conv, action)
+);
+CREATE INDEX conversation_updated_ts ON conversations USING btree (updated_ts);
+
 -- see core.ActionStatuses enum which matches this
 CREATE TYPE ACTION_STATUS AS ENUM ('temporary_failure', 'failed', 'successful');
 
@@ -107,9 +163,13 @@ CREATE TABLE action_states (
   status ACTION_STATUS NOT NULL,
   node VARCHAR(255),  -- null for fallback TODO rename to node
   errors JSONB[],
+  address VARCHAR(255),  -- participant the action was pushed as, used when retrying
+  attempts INT NOT NULL DEFAULT 1,
+  retry_ts TIMESTAMP,  -- when to next try pushing, only set for temporary_failure
   UNIQUE (action, node)
 );
 CREATE INDEX action_state_ref ON action_states USING btree (ref);
+CREATE INDEX action_state_retry ON action_states USING btree (retry_ts) WHERE status = 'temporary_failure';
 -- might need index on platform
 
 -- TODO attachments
@@ -4,8 +4,10 @@ import logging
 from aiohttp.web import Application, Response
 
 from em2 import VERSION
+from em2.core import conv_cache, recipient_cache
+from em2.utils.compression import accept_encoding
 from em2.utils.web import JSON_CONTENT_TYPE, db_conn_middleware
-from .views import Act, Authenticate, Create, FallbackWebhook, Get
+from .views import Act, ActBatch, Authenticate, Create, FallbackWebhook, Get
 
 logger = logging.getLogger('em2.protocol')
 
@@ -37,19 +39,29 @@ async def app_startup(app):
     await db.startup()
     await fallback.startup()
     await pusher.log_redis_info(logger.debug)
+    recipient_cache.configure(settings, pusher.redis)
+    conv_cache.configure(settings, pusher.redis)
 
 
 async def app_cleanup(app):
     await app['fallback'].shutdown()
     await app['db'].close()
     await app['authenticator'].close()
+    recipient_cache.close()
+    conv_cache.close()
     await app['pusher'].close()
 
 
+async def prepare_add_accept_encoding(request, response):
+    # tell other nodes which codings they may use to compress request bodies, RFC 7694
+    response.headers.setdefault('Accept-Encoding', accept_encoding())
+
+
 def create_protocol_app(settings):
     app = Application(middlewares=(db_conn_middleware,))
     app['settings'] = settings
 
+    app.on_response_prepare.append(prepare_add_accept_encoding)
     app.on_startup.append(app_startup)
     app.on_cleanup.append(app_cleanup)
 
@@ -57,6 +69,7 @@ def create_protocol_app(settings):
     app.router.add_get('/get/{conv:[a-z0-9]{8,}}/', Get.view(), name='get')  # TODO remove this and replace with actions
     app.router.add_post('/create/{conv:[a-z0-9]+}/', Create.view(), name='create')
     app.router.add_post('/fallback-webhook/', FallbackWebhook.view(), name='fallback-webhook')
+    app.router.add_post('/batch/{conv:[a-z0-9]+}/', ActBatch.view(), name='act-batch')
     app.router.add_post('/{conv:[a-z0-9]+}/{component:[a-z]+}/{verb:[a-z]+}/{item:.*}', Act.view(), name='act')
     app.router.add_get('/', index, name='index')
     return app
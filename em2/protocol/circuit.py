@@ -0,0 +1,152 @@
+"""
+Circuit breakers for other nodes, shared between processes in redis so a node which is down isn't repeatedly
+contacted by every push.
+
+closed: requests are made as normal, COMMS_CIRCUIT_FAILURES failures (connection errors, responses with status
+    over 500 or responses slower than COMMS_CIRCUIT_SLOW_REQUEST) within COMMS_CIRCUIT_WINDOW seconds open the circuit.
+open: no requests are made for COMMS_CIRCUIT_OPEN_TIME seconds, then the circuit is half open.
+half_open: one probe request is allowed at a time, if it succeeds the circuit is closed, if it fails the circuit
+    is opened again.
+"""
+import logging
+from enum import Enum
+from time import time
+from typing import Dict, Optional
+
+from .. import Settings
+from ..utils.redis import RedisScript
+
+logger = logging.getLogger('em2.push.circuit')
+
+
+class CircuitStates(str, Enum):
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half_open'
+
+
+class CircuitBreaker:
+    # prefix for hashes of each node's breaker state
+    prefix = b'cb:'
+    # breakers for nodes which haven't been contacted for a day are forgotten
+    expiry = 86_400
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+
+    # KEYS: breaker hash
+    # ARGV: now, open time
+    # Returns 1 if a request may be made, half open circuits allow another probe if the last one hasn't reported
+    # back within the open time.
+    allow_script = RedisScript("""
+local key, now, open_time = KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])
+local state, opened_at, probe_at = unpack(redis.call('HMGET', key, 'state', 'opened_at', 'probe_at'))
+if state == 'open' then
+  if now < tonumber(opened_at) + open_time then
+    return 0
+  end
+  redis.call('HMSET', key, 'state', 'half_open', 'probe_at', now)
+elseif state == 'half_open' then
+  if now < tonumber(probe_at) + open_time then
+    return 0
+  end
+  redis.call('HSET', key, 'probe_at', now)
+end
+return 1
+""")
+
+    # KEYS: breaker hash
+    # ARGV: now, 1 if the request succeeded else 0, latency, failures to open, failure window, expiry
+    # Returns the previous and new states.
+    record_script = RedisScript("""
+local key, now, ok, latency = KEYS[1], tonumber(ARGV[1]), ARGV[2] == '1', tonumber(ARGV[3])
+local state, failures, window_start, avg = unpack(
+  redis.call('HMGET', key, 'state', 'failures', 'window_start', 'latency')
+)
+state = state or 'closed'
+avg = tonumber(avg)
+local new_state = state
+if ok then
+  if state == 'half_open' then
+    new_state = 'closed'
+    redis.call('HMSET', key, 'failures', 0, 'window_start', now)
+  end
+else
+  failures, window_start = tonumber(failures) or 0, tonumber(window_start) or now
+  if now - window_start > tonumber(ARGV[5]) then
+    failures, window_start = 0, now
+  end
+  failures = failures + 1
+  redis.call('HMSET', key, 'failures', failures, 'window_start', window_start)
+  if state == 'half_open' or (state == 'closed' and failures >= tonumber(ARGV[4])) then
+    new_state = 'open'
+    redis.call('HSET', key, 'opened_at', now)
+  end
+end
+-- moving average of latency
+avg = avg and avg * 0.8 + latency * 0.2 or latency
+redis.call('HMSET', key, 'state', new_state, 'latency', avg, 'updated', now)
+redis.call('EXPIRE', key, ARGV[6])
+return {state, new_state}
+""")
+
+    def key(self, node: str) -> bytes:
+        return self.prefix + node.encode()
+
+    async def allow(self, redis, node: str) -> bool:
+        """
+        Check whether a request may be made to a node, this takes the probe if the circuit is half open so it
+        should only be called immediately before making requests.
+        """
+        allowed = await self.allow_script(redis, keys=[self.key(node)],
+                                          args=[time(), self.settings.COMMS_CIRCUIT_OPEN_TIME])
+        return bool(allowed)
+
+    async def record(self, redis, node: str, ok: bool, latency: float) -> CircuitStates:
+        """
+        Record the outcome of a request to a node.
+
+        :return: the node's new state
+        """
+        ok = ok and latency < self.settings.COMMS_CIRCUIT_SLOW_REQUEST
+        old_state, new_state = await self.record_script(redis, keys=[self.key(node)], args=[
+            time(),
+            int(ok),
+            latency,
+            self.settings.COMMS_CIRCUIT_FAILURES,
+            self.settings.COMMS_CIRCUIT_WINDOW,
+            self.expiry,
+        ])
+        old_state, new_state = CircuitStates(old_state.decode()), CircuitStates(new_state.decode())
+        if new_state != old_state:
+            log = logger.info if new_state == CircuitStates.closed else logger.warning
+            log('circuit for %s %s -> %s', node, old_state.value, new_state.value)
+        return new_state
+
+    async def state(self, redis, node: str) -> Optional[dict]:
+        """
+        Get the state of a node's breaker, None if there have been no requests to the node recently.
+        """
+        data = await redis.hgetall(self.key(node), encoding='utf8')
+        return self._parse(data) if data else None
+
+    async def states(self, redis) -> Dict[str, dict]:
+        """
+        Get the state of breakers for all nodes which have been contacted recently.
+        """
+        states = {}
+        async for key in redis.iscan(match=self.prefix + b'*'):
+            data = await redis.hgetall(key, encoding='utf8')
+            if data:
+                states[key[len(self.prefix):].decode()] = self._parse(data)
+        return states
+
+    @staticmethod
+    def _parse(data: Dict[str, str]) -> dict:
+        return {
+            'state': CircuitStates(data['state']),
+            'failures': int(data.get('failures', 0)),
+            'latency': float(data['latency']),
+            'opened_at': data.get('opened_at') and float(data['opened_at']),
+            'updated': float(data['updated']),
+        }
@@ -13,6 +13,7 @@ from ... import Settings
 from ...core import (Action, ApplyAction, Components, CreateForeignConv, Verbs, Relationships,
                      create_missing_recipients, gen_random, generate_conv_key, MsgFormat)
 from ...utils import to_utc_naive
+from ...utils.database import statements
 from ...utils.markdown import markdown
 
 logger = logging.getLogger('em2.fallback')
@@ -117,7 +118,7 @@ class FallbackHandler:
                 body = f'removing {action.item} from the conversation'
             else:
                 raise NotImplementedError()
-        addresses = {r['address'] for r in participants}
+        addresses = {address for _, address in participants}
         e_from, to, bcc = self.get_from_to_bcc(action, addresses)
 
         e_msg = EmailMessage()
@@ -273,3 +274,6 @@ class FallbackHandler:
 class LogFallbackHandler(FallbackHandler):
     async def send_message(self, *, e_from: str, to: List[str], bcc: List[str], email_msg: EmailMessage):
         logger.info('%s > %s\n%s', e_from, to, email_msg['Subject'], indent(email_msg.as_string(), '  '))
+
+
+statements.register(FallbackHandler)
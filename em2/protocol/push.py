@@ -2,25 +2,36 @@ import asyncio
 import base64
 import json
 import logging
+import random
+from collections import Counter, defaultdict
 from datetime import datetime
 from enum import IntEnum
-from typing import Dict, Optional, Set, Tuple, Union
+from functools import lru_cache
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import urlparse
 
-from aiohttp import ClientConnectionError, ClientError, ClientSession, ClientTimeout, DefaultResolver, TCPConnector
+from aiohttp import (ClientConnectionError, ClientError, ClientResponse, ClientSession, ClientTimeout, DefaultResolver,
+                     TCPConnector, hdrs)
 from aiohttp.hdrs import METH_GET, METH_POST
 from aiohttp.web_response import Response
 from arq import Actor, concurrent, cron
 from arq.jobs import DatetimeJob
-from asyncpg.connection import Connection as PGConnection
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 
 from .. import Settings
-from ..core import Action, ActionStatuses, CreateForeignConv, Verbs, gen_random
+from ..core import (Action, ActionStatuses, Components, ConvSnapshots, CreateForeignConv, Verbs, gen_random,
+                    recipient_cache)
 from ..exceptions import Em2ConnectionError, FailedInboundAuthentication
 from ..utils import get_domain
-from ..utils.encoding import msg_encode, to_unix_ms
+from ..utils.compression import UnsupportedEncoding, accept_encoding, choose_codec, decode_body
+from ..utils.database import statements
+from ..utils.encoding import msg_decode, msg_encode, to_unix_ms
+from ..utils.redis import RedisScript
+from .circuit import CircuitBreaker, CircuitStates
 from .dns import DNSResolver
 from .fallback import FallbackHandler
 
@@ -32,6 +43,29 @@ class ReadMethod(IntEnum):
     json = 2
 
 
+@lru_cache()
+def load_private_key(key_file: str):
+    """
+    Read and parse the private domain key once per process.
+    """
+    return RSA.importKey(Path(key_file).read_text())
+
+
+def sign_message(key_file: str, msg: str) -> str:
+    signer = PKCS1_v1_5.new(load_private_key(key_file))
+    return base64.urlsafe_b64encode(signer.sign(SHA256.new(msg.encode()))).decode()
+
+
+class PushBuffer:
+    """
+    Actions waiting to be pushed together to one node for one conversation.
+    """
+    def __init__(self, loop):
+        self.actions: List[Tuple[Action, str]] = []
+        self.sent = loop.create_future()
+        self.handle: asyncio.Handle = None
+
+
 class Pusher(Actor):
     """
     Pushers are responsible for distributing data to other platforms and also for prompting the distribution of
@@ -42,13 +76,14 @@ class Pusher(Actor):
     """
     job_class = DatetimeJob
     LOCAL = 'L'
-    B_LOCAL = LOCAL.encode()
     FALLBACK = 'F'
 
     # prefix for hashes of address -> node (platform) domain
     address_prefix = b'an:'
     # prefix for strings containing auth tokens foreach node
     auth_token_prefix = b'ak:'
+    # prefix for locks held while requesting an auth token from a node
+    auth_lock_prefix = b'al:'
 
     def __init__(self, settings: Settings, loop=None, **kwargs):
         self.settings = settings
@@ -58,10 +93,27 @@ class Pusher(Actor):
         self.session = None
         self.fallback: FallbackHandler = None
         self.dns = DNSResolver(self.settings, self.loop)
+        self.circuit = CircuitBreaker(self.settings)
+        self._discovery_semaphore = asyncio.Semaphore(self.settings.COMMS_NODE_DISCOVERY_CONCURRENCY, loop=self.loop)
+        # domain -> future of node discovery for lookups which are currently running
+        self._domain_lookups: Dict[str, asyncio.Future] = {}
+        # (node, conversation key) -> actions waiting to be pushed
+        self._push_buffers: Dict[Tuple[str, str], PushBuffer] = {}
+        # node domain -> future of token requests which are currently running
+        self._token_requests: Dict[str, asyncio.Future] = {}
+        # host -> Accept-Encoding from its last response, used to choose how to compress requests to the host
+        self._host_encodings: Dict[str, str] = {}
+        # host -> bytes on the wire and before compression, sent and received
+        self.wire_stats: Dict[str, Counter] = defaultdict(Counter)
+        # (timestamp, signature) used to authenticate with other nodes and future of signing if it's running
+        self._auth_signature: Tuple[int, str] = None
+        self._auth_signing: asyncio.Future = None
+        # reuse signatures for half the time other nodes will accept them
+        self._signature_max_age = -self.settings.COMMS_AUTHENTICATION_TS_LENIENCY[0] // 2
         kwargs['redis_settings'] = self.settings.redis
         super().__init__(**kwargs)
         logger.debug('initialising pusher %s', self)
-        self.auth_check_url = settings.auth_server_sys_url + '/check-user-node/'
+        self.auth_check_url = settings.auth_server_sys_url + '/check-user-nodes/'
         self.auth_check_headers = {'Authorization': settings.auth_node_secret}
 
     async def startup(self):
@@ -70,26 +122,34 @@ class Pusher(Actor):
 
         resolver = self._get_http_resolver()
         connector = TCPConnector(resolver=resolver, verify_ssl=self.settings.COMMS_VERIFY_SSL)
-        self.session = ClientSession(loop=self.loop, connector=connector, timeout=ClientTimeout(total=10))
+        # responses are decoded in _read_response so any registered codec can be used
+        self.session = ClientSession(loop=self.loop, connector=connector, timeout=ClientTimeout(total=10),
+                                     auto_decompress=False, headers={hdrs.ACCEPT_ENCODING: accept_encoding()})
 
         self.fallback = self.settings.fallback_cls(settings=self.settings, loop=self.loop, db=self.db)
         await self.db.startup()
         await self.fallback.startup()
+        recipient_cache.configure(self.settings, await self.get_redis())
 
     @classmethod
     def _get_http_resolver(cls):
         return DefaultResolver()
 
     async def shutdown(self):
+        for host, stats in self.wire_stats.items():
+            logger.info('%s: %d requests, sent %d bytes (%d uncompressed), received %d bytes (%d uncompressed)',
+                        host, stats['requests'], stats['sent'], stats['sent_raw'], stats['received'],
+                        stats['received_raw'])
         if self.db:
+            recipient_cache.close()
             await self.db.close()
             await self.fallback.shutdown()
             await self.session.close()
 
     # see core.Action for order of returned values
     action_detail_sql = """
-    SELECT a.key, c.key, c.id, a.verb, a.component, actor_r.address, a.timestamp, parent.key, a.body, m.relationship,
-    m.format, m.key, prt_r.address
+    SELECT a.id, a.key, c.key, c.id, a.verb, a.component, actor_r.address, a.timestamp, parent.key, a.body,
+    m.relationship, m.format, m.key, prt_r.address
     FROM actions AS a
     JOIN conversations AS c ON a.conv = c.id
 
@@ -101,10 +161,11 @@ class Pusher(Actor):
 
     LEFT JOIN recipients AS prt_r ON a.recipient = prt_r.id
 
-    WHERE a.id = $1
+    WHERE a.id = any($1)
+    ORDER BY a.id
     """
 
-    action_recipient_id_sql = 'SELECT actor FROM actions WHERE id = $1'
+    action_recipient_ids_sql = 'SELECT id, actor FROM actions WHERE id = any($1)'
 
     prts_sql = """
     SELECT r.id, r.address
@@ -113,86 +174,305 @@ class Pusher(Actor):
     WHERE p.conv = $1
     """
 
-    @concurrent
+    @concurrent(Actor.HIGH_QUEUE)
     async def push(self, action_id, transmit=True, actor_only=False):
+        await self._push([action_id], transmit, actor_only)
+
+    @concurrent(Actor.HIGH_QUEUE)
+    async def push_batch(self, action_ids, transmit=True, actor_only=False):
+        """
+        Push multiple actions on the same conversation, participants are only looked up and categorised once.
+        """
+        await self._push(action_ids, transmit, actor_only)
+
+    async def _get_actions(self, conn, action_ids) -> List[Action]:
+        # TODO perhaps need to add other fields required to understand the action
+        return [
+            Action(*args, message_key or prt_address)
+            for *args, message_key, prt_address in await conn.fetch(self.action_detail_sql, action_ids)
+        ]
+
+    async def _push(self, action_ids, transmit, actor_only):
+        """
+        Push actions to recipients known to be local, this runs on the high priority queue so local delivery isn't
+        delayed by pushes to other nodes. Other participants are left to push_remote.
+        """
         async with self.db.acquire() as conn:
-            *args, message_key, prt_address = await conn.fetchrow(self.action_detail_sql, action_id)
-            # TODO perhaps need to add other fields required to understand the action
-            action = Action(action_id, *args, message_key or prt_address)
+            actions = await self._get_actions(conn, action_ids)
 
             if actor_only:
-                actor_recipient_id = await conn.fetchval(self.action_recipient_id_sql, action_id)
-                await self.internal_push({actor_recipient_id}, action)
+                actor_recipient_ids = dict(await conn.fetch(self.action_recipient_ids_sql, action_ids))
+                for action in actions:
+                    await self.internal_push({actor_recipient_ids[action.id]}, action)
                 return
 
-            prts = set(await conn.fetch(self.prts_sql, action.conv_id))  # TODO more info e.g. bcc etc.
-            prts_count = len(prts)
-
-            # get known local recipients and push to them first to avoid delay during DSN queries and em2 auth
-            # in categorise_addresses
-            known_local = set()
-            for recipient_id, address in prts:
-                redis = await self.get_redis()
-                node_b = await redis.get(self.address_prefix + address.encode())
-                if node_b == self.B_LOCAL:
-                    known_local.add((recipient_id, address))
-
-            # TODO add test for known local still being passed to fallback
-            if known_local:
-                prts2 = prts.difference(known_local)
-                await self.internal_push({rid for rid, _ in known_local}, action)
+            prts = await conn.fetch(self.prts_sql, actions[0].conv_id)
+
+        await self._push_known_local(actions, prts, transmit)
+
+    async def push_applied(self, conn, actions: List[Action], *, actor_id: int = None, transmit=True,
+                           actor_only=False):
+        """
+        Push actions which have just been applied, unless push_snapshots is disabled the actions and participants
+        are encoded in the job so push_snapshot doesn't need to read them from the database.
+
+        :param actor_id: recipient id of the actor, required with actor_only
+        """
+        if not self.settings.push_snapshots:
+            await self.push_batch([action.id for action in actions], transmit=transmit, actor_only=actor_only)
+            return
+        if actor_only:
+            prts = [(actor_id, actions[0].actor)]
+        else:
+            prts = await conn.fetch(self.prts_sql, actions[0].conv_id)
+        snapshot = msg_encode([[list(action) for action in actions], [list(prt) for prt in prts]])
+        await self.push_snapshot(snapshot, transmit=transmit, actor_only=actor_only)
+
+    @staticmethod
+    def decode_snapshot(snapshot: bytes) -> Tuple[List[Action], Set[Tuple[int, str]]]:
+        actions, prts = msg_decode(snapshot)
+        return [Action(*action) for action in actions], {tuple(prt) for prt in prts}
+
+    @concurrent(Actor.HIGH_QUEUE)
+    async def push_snapshot(self, snapshot: bytes, transmit=True, actor_only=False):
+        """
+        Like push_batch but the actions and participants come from a snapshot created by push_applied.
+        """
+        actions, prts = self.decode_snapshot(snapshot)
+        if actor_only:
+            for action in actions:
+                await self.internal_push({rid for rid, _ in prts}, action)
+        else:
+            await self._push_known_local(actions, prts, transmit, snapshot)
+
+    async def _push_known_local(self, actions: List[Action], prts, transmit, snapshot: bytes = None):
+        cached_nodes = await self.cached_nodes(prts)
+        known_local = {rid for rid, address in prts if cached_nodes[address] == self.LOCAL}
+        if known_local:
+            for action in actions:
+                await self.internal_push(known_local, action)
+
+        if len(known_local) < len(prts):
+            await self.push_remote([action.id for action in actions], transmit, snapshot)
+
+    @concurrent
+    async def push_remote(self, action_ids, transmit=True, snapshot: bytes = None):
+        """
+        Push actions to participants whose node wasn't known to be local, this involves finding their nodes which
+        may require DNS queries and authentication with other nodes.
+
+        If a snapshot from push_applied is passed the database is only used to save the state of pushes.
+        """
+        async with self.db.acquire() as conn:
+            if snapshot:
+                actions, prts = self.decode_snapshot(snapshot)
             else:
-                prts2 = prts
+                actions = await self._get_actions(conn, action_ids)
+                prts = set(await conn.fetch(self.prts_sql, actions[0].conv_id))  # TODO more info e.g. bcc etc.
 
-            remote_nodes, local_recipients, fallback_addresses = await self.categorise_addresses(prts2)
+            # one MGET for all participants, shared by the known local check and categorise_addresses
+            cached_nodes = await self.cached_nodes(prts)
+            known_local = {(rid, address) for rid, address in prts if cached_nodes[address] == self.LOCAL}
+            remote_nodes, local_recipients, fallback_addresses = await self.categorise_addresses(
+                prts - known_local, cached_nodes
+            )
 
             loc_count = len(known_local) + len(local_recipients)
-            logger.info('%s.%s %.6s to %d participants: %d em2 nodes, local %d, fallback %d',
-                        action.component or 'conv', action.verb, action.conv_key,
-                        prts_count, len(remote_nodes), loc_count, len(fallback_addresses))
+            for action in actions:
+                logger.info('%s.%s %.6s to %d participants: %d em2 nodes, local %d, fallback %d',
+                            action.component or 'conv', action.verb, action.conv_key,
+                            len(prts), len(remote_nodes), loc_count, len(fallback_addresses))
+
+                if local_recipients:
+                    await self.internal_push(local_recipients, action)
 
-            if local_recipients:
-                await self.internal_push(local_recipients, action)
+        if transmit and remote_nodes:
+            # outside the connection block, sending buffered pushes takes a connection so holding one here while
+            # waiting for them could exhaust the pool
+            await self.external_push(remote_nodes, actions)
+        # TODO save actions_status
 
-            if transmit:
-                if remote_nodes:
-                    await self.external_push(remote_nodes, action, conn)
+        if transmit and fallback_addresses:
+            await self.push_fallback(action_ids, snapshot)
 
-                if fallback_addresses:
-                    await self.fallback.push(action, prts, conn)
-            # TODO save actions_status
+    @concurrent(Actor.LOW_QUEUE)
+    async def push_fallback(self, action_ids, snapshot: bytes = None):
+        """
+        Push actions to participants who don't use em2, eg. by SMTP.
+        """
+        async with self.db.acquire() as conn:
+            if snapshot:
+                actions, prts = self.decode_snapshot(snapshot)
+            else:
+                actions = await self._get_actions(conn, action_ids)
+                # TODO add test for known local still being passed to fallback
+                prts = set(await conn.fetch(self.prts_sql, actions[0].conv_id))
+            for action in actions:
+                await self.fallback.push(action, prts, conn)
+
+    async def cached_nodes(self, prts: Set[Tuple[int, str]]) -> Dict[str, Optional[str]]:
+        """
+        Find cached nodes for participants with a single MGET.
+
+        :return: dict of address -> node or None if the node for that address isn't cached
+        """
+        if not prts:
+            return {}
+        addresses = [address for _, address in prts]
+        with await self.redis as redis:
+            nodes = await redis.mget(*(self.address_prefix + a.encode() for a in addresses), encoding='utf8')
+        return dict(zip(addresses, nodes))
+
+    # Push a job to every live frontend with recipients in the action's recipient ids.
+    # KEYS: frontend registry, temporary recipient ids set
+    # ARGV: heartbeat cutoff, recipients key prefix, jobs key prefix, msgpack encoded action, *recipient ids
+    # The job is a msgpack map of {recipients: [...], action: ...}, the action is already encoded so it's
+    # concatenated rather than being decoded and packed again. Returns the number of frontends pushed to.
+    fan_out_script = RedisScript("""
+local registry, ids_key = KEYS[1], KEYS[2]
+local recipients_base, jobs_base, action = ARGV[2], ARGV[3], ARGV[4]
+redis.call('ZREMRANGEBYSCORE', registry, '-inf', '(' .. ARGV[1])
+for i = 5, #ARGV, 1000 do
+  redis.call('SADD', ids_key, unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+local pushed = 0
+for _, name in ipairs(redis.call('ZRANGE', registry, 0, -1)) do
+  local matching = redis.call('SINTER', ids_key, recipients_base .. name)
+  if #matching > 0 then
+    for j, id in ipairs(matching) do
+      matching[j] = tonumber(id)
+    end
+    local job = '\\130' .. cmsgpack.pack('recipients') .. cmsgpack.pack(matching) .. cmsgpack.pack('action') .. action
+    redis.call('RPUSH', jobs_base .. name, job)
+    pushed = pushed + 1
+  end
+end
+redis.call('DEL', ids_key)
+return pushed
+""")
 
     async def internal_push(self, recipient_ids: Set[int], action: Action):
+        action_dict = action._asdict()
+        action_dict.pop('conv_id')
         with await self.redis as redis:
-            recipient_ids_key = gen_random('rid')
-            await asyncio.gather(
-                redis.sadd(recipient_ids_key, *recipient_ids),
-                redis.expire(recipient_ids_key, 60),
+            pushed = await self.fan_out_script(
+                redis,
+                keys=[self.settings.FRONTEND_REGISTRY, gen_random('rid')],
+                args=[
+                    time() - self.settings.FRONTEND_HEARTBEAT_TIMEOUT,
+                    self.settings.FRONTEND_RECIPIENTS_BASE.format(''),
+                    self.settings.FRONTEND_JOBS_BASE.format(''),
+                    msg_encode(action_dict),
+                    *recipient_ids,
+                ],
             )
-            action_dict = action._asdict()
-            action_dict.pop('conv_id')
-            frontends = await redis.keys(self.settings.FRONTEND_RECIPIENTS_BASE.format('*'), encoding='utf8')
-            logger.info('%s.%s %.6s front ends: running: %s', action.component, action.verb, action.conv_key, frontends)
-            for frontend in frontends:
-                matching_recipient_ids = await redis.sinter(recipient_ids_key, frontend)
-                _, name = frontend.rsplit(':', 1)
-                if not matching_recipient_ids:
-                    logger.info('%s.%s %.6s frontend %s: no matching recipients',
-                                action.component, action.verb, action.conv_key, name)
-                    continue
-                logger.info('%s.%s %.6s frontend %s: %d matching recipients, pushing job',
-                            action.component, action.verb, action.conv_key, name, len(matching_recipient_ids))
-                job_name = self.settings.FRONTEND_JOBS_BASE.format(name)
-                job_data = {
-                    'recipients': [int(rid) for rid in matching_recipient_ids],
-                    'action': action_dict,
-                }
-                await redis.rpush(job_name, msg_encode(job_data))
-
-    async def external_push(self, node_lookup: Dict[str, Set[str]], action: Action, conn: PGConnection):
-        """
-        Push action to participants on remote nodes.
+        logger.info('%s.%s %.6s %d recipients, pushed to %d frontends',
+                    action.component, action.verb, action.conv_key, len(recipient_ids), pushed)
+
+    async def external_push(self, node_lookup: Dict[str, Set[str]], actions: List[Action]):
+        """
+        Push actions to participants on remote nodes, circuits are checked first so actions are added to push
+        buffers in the order they were applied.
+
+        This must be called without holding a database connection, sends each take their own connection.
+        """
+        nodes = []
+        async with self.db.acquire() as conn:
+            for node, addresses in node_lookup.items():
+                address = next(iter(addresses))
+                if not await self._circuit_open(node, address, actions, conn):
+                    nodes.append((node, address))
+
+        cos = []
+        for action in actions:
+            for node, address in nodes:
+                if action.verb == Verbs.PUBLISH:
+                    cos.append(self._send_push_buffer(node, [(action, address)]))
+                else:
+                    # other actions wait briefly so actions on the same conversation can be sent to each node together
+                    cos.append(asyncio.shield(self._coalesce_push(node, address, action), loop=self.loop))
+        # TODO better error checks
+        await asyncio.gather(*cos, loop=self.loop)
+
+    async def _circuit_open(self, node_domain, address, actions: List[Action], conn, attempt=1) -> bool:
+        """
+        Check the node's circuit breaker, if the circuit is open record a temporary failure for each action without
+        making any requests so the pushes are retried later.
         """
+        with await self.redis as redis:
+            if await self.circuit.allow(redis, node_domain):
+                return False
+        logger.info('circuit for %s open, skipping %d pushes', node_domain, len(actions))
+        exc = Em2ConnectionError('circuit open')
+        for action in actions:
+            await self._record_failure(conn, exc, 'circuit', node_domain, address, action, attempt)
+        return True
+
+    async def circuit_states(self) -> Dict[str, dict]:
+        """
+        Get the circuit breaker state of each node contacted recently.
+        """
+        with await self.redis as redis:
+            return await self.circuit.states(redis)
+
+    def _coalesce_push(self, node_domain: str, address: str, action: Action) -> asyncio.Future:
+        """
+        Add an action to the buffer for its node and conversation, the buffer is sent after COMMS_PUSH_COALESCE_WINDOW
+        or once it reaches max_batch_actions.
+
+        :return: future which completes when the buffer has been sent
+        """
+        key = node_domain, action.conv_key
+        buffer = self._push_buffers.get(key)
+        if buffer is None:
+            buffer = self._push_buffers[key] = PushBuffer(self.loop)
+            buffer.handle = self.loop.call_later(self.settings.COMMS_PUSH_COALESCE_WINDOW, self._flush_push, key)
+        buffer.actions.append((action, address))
+        if len(buffer.actions) >= self.settings.max_batch_actions:
+            buffer.handle.cancel()
+            self._flush_push(key)
+        return buffer.sent
+
+    def _flush_push(self, key: Tuple[str, str]):
+        buffer = self._push_buffers.pop(key)
+        task = asyncio.ensure_future(self._send_push_buffer(key[0], buffer.actions), loop=self.loop)
+
+        def set_sent(t):
+            if t.cancelled():
+                buffer.sent.cancel()
+            elif t.exception():
+                buffer.sent.set_exception(t.exception())
+            else:
+                buffer.sent.set_result(None)
+        task.add_done_callback(set_sent)
+
+    async def _send_push_buffer(self, node_domain: str, actions: List[Tuple[Action, str]]):
+        """
+        Send buffered actions in order. Adding a participant may introduce the conversation to the node, so those
+        actions are sent alone with the participant's address, the node can then fetch the conversation; runs of
+        other actions are sent together.
+        """
+        async with self.db.acquire() as conn:
+            run = []
+            for action, address in actions:
+                if action.component == Components.PARTICIPANT and action.verb == Verbs.ADD:
+                    await self._send_actions(node_domain, run, conn)
+                    await self._send_actions(node_domain, [(action, address)], conn)
+                    run = []
+                else:
+                    run.append((action, address))
+            await self._send_actions(node_domain, run, conn)
+
+    async def _send_actions(self, node_domain: str, actions: List[Tuple[Action, str]], conn):
+        if len(actions) == 1:
+            action, address = actions[0]
+            path, universal_headers, data = self._push_request(action)
+            await self._post(node_domain, address, path, universal_headers, data, action, conn)
+        elif actions:
+            await self._post_batch(node_domain, actions, conn)
+
+    @staticmethod
+    def _push_request(action: Action) -> Tuple[str, Dict[str, str], Optional[bytes]]:
         item = action.item or ''
         if action.verb == Verbs.PUBLISH:
             path = f'create/{action.conv_key}/'
@@ -209,28 +489,33 @@ class Pusher(Actor):
         }
         universal_headers = {k: v for k, v in universal_headers.items() if v is not None}
         data = action.body and action.body.encode()
-        cos = [
-            self._post(node, addresses.pop(), path, universal_headers, data, action, conn)
-            for node, addresses in node_lookup.items()
-        ]
-        # TODO better error checks
-        await asyncio.gather(*cos, loop=self.loop)
+        return path, universal_headers, data
 
     success_action_sql = """
     INSERT INTO action_states (action, node, status)
     VALUES ($1, $2, 'successful')
+    ON CONFLICT (action, node) DO UPDATE SET
+      status = EXCLUDED.status, attempts = action_states.attempts + 1, retry_ts = NULL
     """
 
     failed_action_sql = """
-    INSERT INTO action_states (action, node, status, errors)
-    VALUES ($1, $2, $3, ARRAY[$4::JSONB])
+    INSERT INTO action_states (action, node, status, errors, address, retry_ts)
+    VALUES ($1, $2, $3, ARRAY[$4::JSONB], $5, CURRENT_TIMESTAMP + $6::FLOAT * INTERVAL '1 second')
+    ON CONFLICT (action, node) DO UPDATE SET
+      status = EXCLUDED.status,
+      errors = action_states.errors || EXCLUDED.errors,
+      attempts = action_states.attempts + 1,
+      retry_ts = EXCLUDED.retry_ts
     """
 
-    async def _post(self, node_domain, address, path, universal_headers, data, action: Action, conn):
-        # TODO retry on failure and update state on subsequent tries rather than INSERT
+    async def _post(self, node_domain, address, path, universal_headers, data, action: Action, conn, attempt=1):
+        """
+        Make one attempt to push an action to a node, temporary failures are retried later by retry_pushes rather
+        than sleeping here.
+        """
         stage = 'auth'
         try:
-            token = await self.authenticate(node_domain)
+            token = await self.authenticate(node_domain, attempts=1)
             headers = {
                 'em2-auth': token,
                 'em2-participant': address,
@@ -239,17 +524,110 @@ class Pusher(Actor):
             url = f'{self.settings.COMMS_PROTO}://{node_domain}/{path}'
             logger.info('posting to %s', url)
             stage = 'post'
-            await self._request(METH_POST, url, data=data, headers=headers, expected_statuses={201, 204})
+            await self._request(METH_POST, url, data=data, headers=headers, expected_statuses={201, 204}, attempts=1,
+                                circuit=True)
         except Em2ConnectionError as exc:
-            e = json.dumps({
-                'stage': stage,
-                'error': str(exc),
-                'ts': datetime.utcnow().isoformat(),
-            })
-            await conn.execute(self.failed_action_sql, action.id, node_domain, ActionStatuses.failed, e)
+            await self._record_failure(conn, exc, stage, node_domain, address, action, attempt)
         else:
             await conn.execute(self.success_action_sql, action.id, node_domain)
 
+    async def _record_failure(self, conn, exc: Em2ConnectionError, stage, node_domain, address, action: Action,
+                              attempt=1):
+        e = json.dumps({
+            'stage': stage,
+            'error': str(exc),
+            'ts': datetime.utcnow().isoformat(),
+        })
+        if exc.temporary and attempt < self.settings.COMMS_PUSH_RETRY_ATTEMPTS:
+            status, retry_delay = ActionStatuses.temporary_failure, self._retry_delay(attempt)
+            logger.info('push %d to %s failed, attempt %d, retrying in %0.0fs',
+                        action.id, node_domain, attempt, retry_delay)
+        else:
+            status, retry_delay = ActionStatuses.failed, None
+        await conn.execute(self.failed_action_sql, action.id, node_domain, status, e, address, retry_delay)
+
+    async def _post_batch(self, node_domain, actions: List[Tuple[Action, str]], conn):
+        """
+        Push several actions on one conversation to a node in one request to its batch endpoint.
+        """
+        conv_key = actions[0][0].conv_key
+        data = json.dumps({'actions': [self._batch_action(action) for action, _ in actions]})
+        stage = 'auth'
+        try:
+            token = await self.authenticate(node_domain, attempts=1)
+            headers = {'content-type': 'application/json', 'em2-auth': token}
+            url = f'{self.settings.COMMS_PROTO}://{node_domain}/batch/{conv_key}/'
+            logger.info('posting %d actions to %s', len(actions), url)
+            stage = 'post'
+            await self._request(METH_POST, url, data=data, headers=headers, expected_statuses={201}, attempts=1,
+                                circuit=True)
+        except Em2ConnectionError as exc:
+            if exc.status == 404:
+                # the node doesn't have the conversation yet, eg. it's still fetching it after a participant was
+                # added, retry_pushes sends the actions again alone with their participant
+                exc.temporary = True
+            for action, address in actions:
+                await self._record_failure(conn, exc, stage, node_domain, address, action)
+        else:
+            await conn.executemany(self.success_action_sql, [(action.id, node_domain) for action, _ in actions])
+
+    @staticmethod
+    def _batch_action(action: Action) -> dict:
+        d = {
+            'key': action.key,
+            'actor': action.actor,
+            'timestamp': str(to_unix_ms(action.timestamp)),
+            'component': action.component,
+            'verb': action.verb,
+            'item': action.item,
+            'parent': action.parent,
+            'body': action.body,
+            'relationship': action.relationship,
+            'msg_format': action.msg_format,
+        }
+        return {k: v for k, v in d.items() if v is not None}
+
+    def _retry_delay(self, attempt: int) -> float:
+        delay = min(self.settings.COMMS_PUSH_RETRY_DELAY * 2 ** (attempt - 1), self.settings.COMMS_PUSH_RETRY_MAX_DELAY)
+        # jitter so pushes which failed together, eg. when a node was down, aren't all retried at once
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # claim due retries by pushing back their retry_ts so other workers don't also retry them
+    claim_retries_sql = """
+    UPDATE action_states SET retry_ts = CURRENT_TIMESTAMP + INTERVAL '10 minutes'
+    WHERE (action, node) IN (
+      SELECT action, node FROM action_states
+      WHERE status = 'temporary_failure' AND retry_ts <= CURRENT_TIMESTAMP
+      ORDER BY retry_ts
+      LIMIT $1
+      FOR UPDATE SKIP LOCKED
+    )
+    RETURNING action, node, address, attempts
+    """
+    pending_retries_sql = "SELECT count(*) FROM action_states WHERE status = 'temporary_failure'"
+
+    @cron(dft_queue=Actor.LOW_QUEUE)
+    async def retry_pushes(self):
+        """
+        Retry pushes to other nodes which failed temporarily and are now due.
+        """
+        async with self.db.acquire() as conn:
+            retries = await conn.fetch(self.claim_retries_sql, self.settings.COMMS_PUSH_RETRY_BATCH_SIZE)
+            if retries:
+                actions = {a.id: a for a in await self._get_actions(conn, list({r[0] for r in retries}))}
+                cos = []
+                for action_id, node, address, attempts in retries:
+                    action = actions[action_id]
+                    if await self._circuit_open(node, address, [action], conn, attempts + 1):
+                        continue
+                    path, headers, data = self._push_request(action)
+                    cos.append(self._post(node, address, path, headers, data, action, conn, attempts + 1))
+                await asyncio.gather(*cos, loop=self.loop)
+            pending = await conn.fetchval(self.pending_retries_sql)
+        if retries or pending:
+            logger.info('%d pushes retried, %d waiting to be retried', len(retries), pending)
+        return len(retries)
+
     async def get_node(self, address: str) -> str:
         """
         Find the node for a given participant in a conversation.
@@ -257,52 +635,96 @@ class Pusher(Actor):
         :param address: address to find node for
         :return: node's domain or None if em2 is not enabled for this address
         """
-        logger.info('looking for em2 node for "%s"', address)
-        if await self.check_local(address):
-            logger.info('em2 local node found for "%s"', address)
-            return self.LOCAL
-        domain = get_domain(address)
-        async for host in self.dns.mx_hosts(domain):
-            if await self.dns.is_em2_node(host):
-                try:
-                    await self.authenticate(host)
-                except Em2ConnectionError:
-                    # connection failed domain is probably not em2
-                    # maybe want to fail here instead of falling back to SMTP
-                    pass
-                else:
-                    # TODO query host to find associated node using address
-                    logger.info('em2 node found %s -> %s', domain, host)
-                    return host
+        return (await self.get_nodes([address]))[address]
+
+    async def get_nodes(self, addresses: List[str]) -> Dict[str, str]:
+        """
+        Find nodes for many addresses, local addresses are found with one request to the auth server, then
+        each distinct domain of the other addresses is looked up concurrently.
+
+        :return: dict of address -> node domain, LOCAL or FALLBACK
+        """
+        if not addresses:
+            return {}
+        logger.info('looking for em2 nodes for %d addresses', len(addresses))
+        local = await self.check_local(addresses)
+        if local:
+            logger.info('em2 local node found for %d addresses', len(local))
+        remote = [a for a in addresses if a not in local]
+        nodes = await asyncio.gather(*(self.get_domain_node(get_domain(a)) for a in remote), loop=self.loop)
+        return {**dict.fromkeys(local, self.LOCAL), **dict(zip(remote, nodes))}
+
+    async def get_domain_node(self, domain: str) -> str:
+        """
+        Find the node for a domain, concurrent calls for the same domain share one lookup.
+        """
+        fut = self._domain_lookups.get(domain)
+        if fut is None:
+            fut = asyncio.ensure_future(self._discover_domain_node(domain), loop=self.loop)
+            self._domain_lookups[domain] = fut
+            fut.add_done_callback(lambda f: self._domain_lookups.pop(domain, None))
+        # shield so one caller being cancelled doesn't cancel the lookup for others
+        return await asyncio.shield(fut, loop=self.loop)
+
+    async def _discover_domain_node(self, domain: str) -> str:
+        async with self._discovery_semaphore:
+            async for host in self.dns.mx_hosts(domain):
+                if await self.dns.is_em2_node(host):
+                    try:
+                        # one attempt, discovery runs in push jobs which shouldn't sleep between retries
+                        await self.authenticate(host, attempts=1)
+                    except Em2ConnectionError:
+                        # connection failed domain is probably not em2
+                        # maybe want to fail here instead of falling back to SMTP
+                        pass
+                    else:
+                        # TODO query host to find associated node using address
+                        logger.info('em2 node found %s -> %s', domain, host)
+                        return host
         logger.info('no em2 node found for %s, falling back', domain)
         return self.FALLBACK
 
-    async def categorise_addresses(self, prts: Set[str]) -> Tuple[Dict[str, Set[str]], Set[int], Set[str]]:
+    async def categorise_addresses(self, prts: Set[Tuple[int, str]],
+                                   cached_nodes: Dict[str, Optional[str]] = None
+                                   ) -> Tuple[Dict[str, Set[str]], Set[int], Set[str]]:
+        """
+        Group participants by node, cached_nodes from cached_nodes() may be passed to avoid looking up nodes again.
+        """
+        if cached_nodes is None:
+            cached_nodes = await self.cached_nodes(prts)
         remote_nodes = {}
         local_recipients = set()
         fallback_addresses = set()
-        with await self.redis as redis:
-            # sorted is a bodge to avoid ordering errors in tests, could be removed
-            for recipient_id, address in sorted(prts):
-
-                key = self.address_prefix + address.encode()
-                node_b = await redis.get(key)
-                if node_b:
-                    node = node_b.decode()
-                    logger.info('found cached node %s -> %s', address, node)
-                else:
-                    node = await self.get_node(address)
-                    logger.info('got node for %s -> %s', address, node)
-                    await redis.setex(key, self.settings.COMMS_DNS_CACHE_EXPIRY, node.encode())
-
-                if node == self.LOCAL:
-                    local_recipients.add(recipient_id)
-                elif node == self.FALLBACK:
-                    fallback_addresses.add(address)
-                elif node in remote_nodes:
-                    remote_nodes[node].add(address)
-                else:
-                    remote_nodes[node] = {address}
+        # sorted is a bodge to avoid ordering errors in tests, could be removed
+        prts = sorted(prts)
+
+        # discover nodes for all uncached addresses at once, addresses on the same domain share one lookup
+        new_nodes = await self.get_nodes([address for _, address in prts if not cached_nodes.get(address)])
+
+        for recipient_id, address in prts:
+            node = cached_nodes.get(address)
+            if node:
+                logger.info('found cached node %s -> %s', address, node)
+            else:
+                node = new_nodes[address]
+                logger.info('got node for %s -> %s', address, node)
+
+            if node == self.LOCAL:
+                local_recipients.add(recipient_id)
+            elif node == self.FALLBACK:
+                fallback_addresses.add(address)
+            elif node in remote_nodes:
+                remote_nodes[node].add(address)
+            else:
+                remote_nodes[node] = {address}
+
+        if new_nodes:
+            with await self.redis as redis:
+                pipe = redis.pipeline()
+                for address, node in new_nodes.items():
+                    pipe.setex(self.address_prefix + address.encode(), self.settings.COMMS_DNS_CACHE_EXPIRY,
+                               node.encode())
+                await pipe.execute()
         return remote_nodes, local_recipients, fallback_addresses
 
     @concurrent
@@ -328,38 +750,110 @@ class Pusher(Actor):
         await self.push.direct(action_id, transmit=False)
         return 0
 
-    async def authenticate(self, node_domain: str) -> str:
+    async def authenticate(self, node_domain: str, attempts=5) -> str:
+        """
+        Get a token for a node, tokens are shared between processes in redis and refreshed in the background
+        before they expire.
+        """
         logger.debug('authenticating with %s', node_domain)
         token_key = self.auth_token_prefix + node_domain.encode()
         with await self.redis as redis:
-            token = await redis.get(token_key)
-            if token:
-                token = token.decode()
-            else:
-                token = await self._authenticate_request(node_domain)
-                _, expires_at, _ = token.split(':', 2)
-                expire_token_at = int(expires_at) - self._early_token_expiry
+            token, ttl = await asyncio.gather(redis.get(token_key), redis.ttl(token_key))
+        if token:
+            # ttl is -1 if the token has no expiry
+            if 0 <= ttl < self.settings.COMMS_PUSH_TOKEN_REFRESH and node_domain not in self._token_requests:
+                logger.info('refreshing token for %s in the background', node_domain)
+                self._request_token(node_domain, attempts, refresh=True)
+            return token.decode()
+        token = await asyncio.shield(self._request_token(node_domain, attempts), loop=self.loop)
+        if token is None:
+            # joined a background refresh which left the token to another process
+            token = await asyncio.shield(self._request_token(node_domain, attempts), loop=self.loop)
+        logger.info('successfully authenticated with %s', node_domain)
+        return token
+
+    def _request_token(self, node_domain: str, attempts, refresh=False) -> asyncio.Future:
+        """
+        Request a new token from a node, only one request per node runs in this process at once.
+        """
+        fut = self._token_requests.get(node_domain)
+        if fut is None:
+            fut = asyncio.ensure_future(self._fetch_token(node_domain, attempts, refresh), loop=self.loop)
+            self._token_requests[node_domain] = fut
+
+            def request_done(f):
+                self._token_requests.pop(node_domain, None)
+                if refresh and not f.cancelled() and f.exception():
+                    logger.warning('error refreshing token for %s: %s', node_domain, f.exception())
+            fut.add_done_callback(request_done)
+        return fut
+
+    release_lock_script = RedisScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+    async def _fetch_token(self, node_domain: str, attempts, refresh) -> Optional[str]:
+        """
+        Take a lock so only one process authenticates with the node, if another process has the lock wait for
+        it to save the token.
+        """
+        token_key = self.auth_token_prefix + node_domain.encode()
+        lock_key = self.auth_lock_prefix + node_domain.encode()
+        lock_value = gen_random('lock')
+        lock_timeout = self.settings.COMMS_PUSH_TOKEN_LOCK_TIMEOUT
+        with await self.redis as redis:
+            locked = await redis.set(lock_key, lock_value, expire=lock_timeout, exist=redis.SET_IF_NOT_EXIST)
+        if not locked:
+            if refresh:
+                # another process is already getting a new token
+                return None
+            for _ in range(lock_timeout * 20):
+                token = await self.redis.get(token_key)
+                if token:
+                    return token.decode()
+                await asyncio.sleep(0.05, loop=self.loop)
+            logger.warning('timed out waiting for another process to authenticate with %s', node_domain)
+
+        try:
+            token = await self._authenticate_request(node_domain, attempts)
+            _, expires_at, _ = token.split(':', 2)
+            expire_token_at = int(expires_at) - self._early_token_expiry
+            with await self.redis as redis:
                 await asyncio.gather(
                     redis.set(token_key, token),
                     redis.expireat(token_key, expire_token_at),
                 )
-        logger.info('successfully authenticated with %s', node_domain)
+        finally:
+            if locked:
+                with await self.redis as redis:
+                    await self.release_lock_script(redis, keys=[lock_key], args=[lock_value])
         return token
 
-    async def check_local(self, address: str) -> str:
-        _, data = await self._request(
-            METH_GET,
-            self.auth_check_url,
-            json_data={'address': address, 'domain': self.settings.EXTERNAL_DOMAIN},
-            headers=self.auth_check_headers,
-            retry_delay=0.1,
-        )
-        return data['local']
-
-    async def _authenticate_request(self, node_domain):
+    async def check_local(self, addresses: List[str]) -> Set[str]:
+        """
+        Find which addresses are local to this node, one request to the auth server unless there are more than
+        auth_check_nodes_max_addresses addresses.
+        """
+        local = set()
+        step = self.settings.auth_check_nodes_max_addresses
+        for i in range(0, len(addresses), step):
+            _, data = await self._request(
+                METH_POST,
+                self.auth_check_url,
+                json_data={'addresses': addresses[i:i + step], 'domain': self.settings.EXTERNAL_DOMAIN},
+                headers=self.auth_check_headers,
+                attempts=1,
+            )
+            local.update(address for address, is_local in data['local'].items() if is_local)
+        return local
+
+    async def _authenticate_request(self, node_domain, attempts=5):
         url = f'{self.settings.COMMS_PROTO}://{node_domain}/auth/'
-        headers = {f'em2-{k}': str(v) for k, v in self._auth_data()}
-        r, _ = await self._request(METH_POST, url, headers=headers, expected_statuses={201})
+        headers = {f'em2-{k}': str(v) for k, v in (await self._auth_data()).items()}
+        r, _ = await self._request(METH_POST, url, headers=headers, expected_statuses={201}, attempts=attempts)
         return r.headers['em2-key']
 
     async def _request(self, method, url, *,
@@ -368,32 +862,52 @@ class Pusher(Actor):
                        headers=None,
                        read: Optional[ReadMethod] = None,
                        expected_statuses: Set[int] = {200},
-                       retry_delay=1.0) -> Tuple[Response, Union[str, dict]]:
-        exc = response_data = None
+                       attempts=5,
+                       retry_delay=1.0,
+                       circuit=False) -> Tuple[Response, Union[str, dict]]:
+        """
+        :param circuit: whether to record the outcome in the host's circuit breaker, only set for pushes to other nodes
+        """
+        exc = response_data = status = None
+        temporary = True
         if json_data:
             data = json.dumps(json_data)
             read = read or ReadMethod.json
-        for i in range(5):
+        host = urlparse(url).netloc
+        data, headers = self._encode_request(host, data, headers)
+        for i in range(attempts):
+            start = self.loop.time()
             try:
                 # TODO check timeouts are caught
                 async with self.session.request(method, url, data=data, headers=headers, timeout=5) as r:
                     # always read entire response before closing the connection
-                    if read == ReadMethod.text or r.status not in expected_statuses:
-                        response_data = await r.text()
-                    elif read == ReadMethod.json:
-                        response_data = await r.json()
+                    response_data = await self._read_response(host, r, read, expected_statuses)
+            except UnsupportedEncoding as e:
+                # only registered codings are sent in Accept-Encoding so retrying won't help, the node is up though
+                exc, status = f'bad response: {e}, accepted codings: "{accept_encoding()}"', r.status
+                await self._record_request(circuit, host, True, start)
+                temporary = False
+                break
             except (ClientError, ClientConnectionError, ValueError, asyncio.TimeoutError) as e:
-                exc = f'{e.__class__.__name__}: {e}'
+                exc, status = f'{e.__class__.__name__}: {e}', None
             else:
                 if r.status in expected_statuses:
                     logger.debug('%s %s -> %s', method, url, r.status)
+                    await self._record_request(circuit, host, True, start)
                     return r, response_data
-                exc = f'bad response: {r.status}'
+                exc, status = f'bad response: {r.status}', r.status
                 if r.status <= 500:
-                    # responses greater than 500 might be temporary and should be retried
+                    # responses greater than 500 might be temporary and should be retried, other responses
+                    # mean the node is up so don't count against its circuit
+                    await self._record_request(circuit, host, True, start)
+                    temporary = False
                     break
-            logger.info('%s %s: connection error, retrying...', method, url)
-            await asyncio.sleep(retry_delay)
+            if await self._record_request(circuit, host, False, start) == CircuitStates.open:
+                logger.info('%s %s: circuit open, not retrying', method, url)
+                break
+            if i < attempts - 1:
+                logger.info('%s %s: connection error, retrying...', method, url)
+                await asyncio.sleep(retry_delay)
         logger.warning('error on %s to %s, %s', method, url, exc, extra={'data': {
             'method': method,
             'url': url,
@@ -401,21 +915,80 @@ class Pusher(Actor):
             'headers': headers,
             'response_data': response_data
         }})
-        raise Em2ConnectionError(exc)
+        raise Em2ConnectionError(exc, temporary=temporary, status=status)
 
-    def _auth_data(self):
-        yield 'platform', self.settings.EXTERNAL_DOMAIN
+    async def _record_request(self, circuit, host, ok, start) -> Optional[CircuitStates]:
+        if circuit:
+            with await self.redis as redis:
+                return await self.circuit.record(redis, host, ok, self.loop.time() - start)
 
-        timestamp = self._now_unix()
-        yield 'timestamp', timestamp
+    def _encode_request(self, host, data, headers):
+        """
+        Compress request bodies over COMMS_COMPRESS_MIN_SIZE with a coding the host has said it accepts.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        stats = self.wire_stats[host]
+        stats['requests'] += 1
+        if data:
+            stats['sent_raw'] += len(data)
+            codec = len(data) >= self.settings.COMMS_COMPRESS_MIN_SIZE and choose_codec(self._host_encodings.get(host))
+            if codec:
+                data = codec.compress(data)
+                headers = {**(headers or {}), hdrs.CONTENT_ENCODING: codec.name}
+            stats['sent'] += len(data)
+        return data, headers
+
+    async def _read_response(self, host, r: ClientResponse, read: Optional[ReadMethod], expected_statuses):
+        accept = r.headers.get(hdrs.ACCEPT_ENCODING)
+        if accept is not None:
+            self._host_encodings[host] = accept
+        body = await r.read()
+        stats = self.wire_stats[host]
+        stats['received'] += len(body)
+        body = decode_body(body, r.headers.get(hdrs.CONTENT_ENCODING))
+        stats['received_raw'] += len(body)
+        if read == ReadMethod.text or r.status not in expected_statuses:
+            return body.decode()
+        elif read == ReadMethod.json:
+            return json.loads(body.decode())
+
+    async def _auth_data(self) -> Dict[str, Union[str, int]]:
+        """
+        Platform, timestamp and signature used to authenticate with other nodes.
 
+        Signing is slow so it's done in an executor and signatures are reused while their timestamp is well within
+        the leniency allowed by other nodes, concurrent calls share one signing.
+        """
+        if self._auth_signature and self._now_unix() - self._auth_signature[0] < self._signature_max_age:
+            timestamp, signature = self._auth_signature
+        else:
+            if self._auth_signing is None:
+                self._auth_signing = asyncio.ensure_future(self._sign_auth(), loop=self.loop)
+                self._auth_signing.add_done_callback(lambda f: setattr(self, '_auth_signing', None))
+            timestamp, signature = await asyncio.shield(self._auth_signing, loop=self.loop)
+        return {
+            'platform': self.settings.EXTERNAL_DOMAIN,
+            'timestamp': timestamp,
+            'signature': signature,
+        }
+
+    async def _sign_auth(self) -> Tuple[int, str]:
+        timestamp = self._now_unix()
         msg = '{}:{}'.format(self.settings.EXTERNAL_DOMAIN, timestamp)
-        h = SHA256.new(msg.encode())
+        signature = await self.loop.run_in_executor(None, sign_message, self.settings.PRIVATE_DOMAIN_KEY_FILE, msg)
+        self._auth_signature = timestamp, signature
+        return self._auth_signature
 
-        key = RSA.importKey(self.settings.private_domain_key)
-        signer = PKCS1_v1_5.new(key)
-        signature = base64.urlsafe_b64encode(signer.sign(h)).decode()
-        yield 'signature', signature
+    @cron(minute={0, 10, 20, 30, 40, 50}, dft_queue=Actor.LOW_QUEUE)
+    async def compact_snapshots(self):
+        """
+        Snapshot recently active conversations so they can be read without their full action history.
+        """
+        async with self.db.acquire() as conn:
+            count = await ConvSnapshots(conn, self.settings).run()
+        if count:
+            logger.info('%d conversation snapshots created', count)
 
     @cron(hour=3, minute=0, run_at_startup=True)
     async def setup_check(self, _retry_delay=2):
@@ -427,11 +1000,10 @@ class Pusher(Actor):
         http_pass, dns_pass = False, False
         foreign_app_url = f'{self.settings.COMMS_PROTO}://{self.settings.EXTERNAL_DOMAIN}/'
         try:
-            r, _ = await self._request(METH_GET, foreign_app_url, retry_delay=_retry_delay, read=ReadMethod.json)
+            _, data = await self._request(METH_GET, foreign_app_url, retry_delay=_retry_delay, read=ReadMethod.json)
         except Em2ConnectionError:
             pass
         else:
-            data = await r.json()
             if data['domain'] == self.settings.EXTERNAL_DOMAIN:
                 http_pass = True
             else:
@@ -441,7 +1013,7 @@ class Pusher(Actor):
         authenticator = self.settings.authenticator_cls(self.settings, loop=self.loop)
         try:
             public_key = await authenticator.get_public_key(self.settings.EXTERNAL_DOMAIN)
-            auth_data = dict(self._auth_data())
+            auth_data = await self._auth_data()
             signed_message = '{}:{}'.format(self.settings.EXTERNAL_DOMAIN, auth_data['timestamp'])
             if authenticator.valid_signature(signed_message, auth_data['signature'], public_key):
                 dns_pass = True
@@ -463,3 +1035,6 @@ class Pusher(Actor):
     def __repr__(self):
         ref = 'shadow' if self.is_shadow else 'frontend'
         return f'<{self.__class__.__name__}:{self.settings.EXTERNAL_DOMAIN}:{ref}>'
+
+
+statements.register(Pusher)
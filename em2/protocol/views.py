@@ -1,14 +1,20 @@
 """
 Views dedicated to propagation of data between platforms.
 """
+import json
 import logging
+from datetime import datetime
+from typing import List, Optional
 
 from aiohttp import web
-from aiohttp.web import HTTPBadRequest, HTTPConflict, HTTPForbidden, HTTPNotFound
+from aiohttp.web import HTTPBadRequest, HTTPConflict, HTTPForbidden, HTTPNotFound, HTTPUnsupportedMediaType
+from pydantic import BaseModel, EmailStr, NoneStr, constr
 
-from ..core import ApplyAction, Components, GetConv, Verbs
+from ..core import ApplyAction, ApplyActionBatch, Components, GetConv, MsgFormat, Relationships, Verbs
 from ..utils import get_domain
-from ..utils.web import ViewMain, WebModel, get_ip, raw_json_response
+from ..utils.compression import UnsupportedEncoding, choose_codec, decode_body
+from ..utils.database import statements
+from ..utils.web import JSON_CONTENT_TYPE, JsonError, ViewMain, WebModel, get_ip, raw_json_response
 
 logger = logging.getLogger('em2.f.views')
 
@@ -24,6 +30,41 @@ class View(ViewMain):
         except KeyError:
             raise HTTPBadRequest(text=f'header "{name}" missing')
 
+    async def read_body(self) -> bytes:
+        # gzip and deflate are decoded by aiohttp, other registered codings are decoded here
+        try:
+            return decode_body(await self.request.read(), self.request.headers.get('Content-Encoding'),
+                               native_decoded=True)
+        except UnsupportedEncoding as e:
+            raise HTTPUnsupportedMediaType(text=str(e))
+        except ValueError as e:
+            raise HTTPBadRequest(text=str(e))
+
+    async def request_json(self):
+        try:
+            data = json.loads(await self.read_body())
+        except ValueError as e:
+            raise JsonError.HTTPBadRequest(error=f'invalid request json: {e}')
+        if not isinstance(data, dict):
+            raise JsonError.HTTPBadRequest(error='request json should be a dictionary')
+        return data
+
+    def compressed_json_response(self, json_str: str):
+        """
+        Compress large responses with the first registered coding the client accepts.
+        """
+        body = json_str.encode()
+        codec = len(body) >= self.settings.COMMS_COMPRESS_MIN_SIZE and choose_codec(
+            self.request.headers.get('Accept-Encoding')
+        )
+        if not codec:
+            return raw_json_response(json_str)
+        return web.Response(
+            body=codec.compress(body),
+            content_type=JSON_CONTENT_TYPE,
+            headers={'Content-Encoding': codec.name, 'Vary': 'Accept-Encoding'},
+        )
+
 
 class Authenticate(View):
     class Headers(WebModel):
@@ -57,8 +98,9 @@ class Get(View):
 
         conv_key = request.match_info['conv']
         logger.info('platform %s getting %.6s', platform, conv_key)
-        json_str = await GetConv(self.conn).run(conv_key, prt_address)
-        return raw_json_response(json_str)
+        snapshot = request.query.get('snapshot') in {'1', 'true'}
+        json_str = await GetConv(self.conn).run(conv_key, prt_address, snapshot=snapshot)
+        return self.compressed_json_response(json_str)
 
 
 class Act(View):
@@ -117,12 +159,92 @@ class Act(View):
             verb=verb,
             item=item,
             parent=self.request.headers.get('em2-parent'),
-            body=await request.text(),
+            body=(await self.read_body()).decode(),
             relationship=self.request.headers.get('em2-relationship'),
             msg_format=self.request.headers.get('em2-msg-format'),
         )
         await apply_action.run()
-        await self.pusher.push(apply_action.action_id, transmit=False)
+        if apply_action.duplicate:
+            logger.info('action %.6s from %s already applied', action_key, platform)
+        else:
+            await self.pusher.push_applied(self.conn, [apply_action.action(conv_key, actor_address)], transmit=False)
+        return web.Response(status=201)
+
+
+class _BatchAction(BaseModel):
+    key: constr(min_length=20, max_length=20)
+    actor: EmailStr
+    timestamp: datetime
+    component: Components
+    verb: Verbs
+    item: Optional[constr(max_length=255)] = None
+    parent: Optional[constr(min_length=20, max_length=20)] = None
+    body: NoneStr = None
+    relationship: Optional[Relationships] = None
+    msg_format: Optional[MsgFormat] = None
+
+
+class ActBatch(View):
+    """
+    Apply an ordered list of actions to one conversation, used by nodes to push several actions at once.
+    """
+    get_conv_sql = """
+    SELECT id FROM conversations WHERE key = $1 AND published = TRUE
+    """
+    find_actors_sql = """
+    SELECT r.address, r.id
+    FROM participants AS p
+    JOIN recipients AS r ON p.recipient = r.id
+    WHERE p.conv = $1 AND r.address = any($2)
+    """
+
+    class BatchModel(WebModel):
+        # each action is validated before anything is looked up, ApplyAction checks the rest
+        actions: List[_BatchAction] = ...
+
+    async def call(self, request):
+        platform = await self.auth.validate_platform_token(self.required_header('em2-auth'))
+
+        batch = self.BatchModel(**await self.request_json())
+        if len(batch.actions) > self.settings.max_batch_actions:
+            raise HTTPBadRequest(text=f'batches are limited to {self.settings.max_batch_actions} actions')
+
+        actor_addresses = {action.actor for action in batch.actions}
+        for actor_address in actor_addresses:
+            await self.auth.check_domain_platform(get_domain(actor_address), platform)
+
+        conv_key = request.match_info['conv']
+        logger.info('batch of %d actions from %s', len(batch.actions), platform)
+        conv_id = await self.conn.fetchval(self.get_conv_sql, conv_key)
+        if not conv_id:
+            raise HTTPNotFound(text='conversation not found')
+
+        actor_ids = dict(await self.conn.fetch(self.find_actors_sql, conv_id, actor_addresses))
+        missing_actors = actor_addresses - actor_ids.keys()
+        if missing_actors:
+            raise HTTPForbidden(text=f'"{missing_actors.pop()}" is not a participant in this conversation')
+
+        apply_batch = ApplyActionBatch(
+            self.conn,
+            remote_action=True,
+            actions=[
+                {
+                    **{k: v for k, v in action.dict(exclude={'key', 'actor'}).items() if v is not None},
+                    'action_key': action.key,
+                    'actor': actor_ids[action.actor],
+                }
+                for action in batch.actions
+            ],
+            conv=conv_id,
+        )
+        await apply_batch.run()
+        addresses_by_id = {actor_id: address for address, actor_id in actor_ids.items()}
+        new_actions = [
+            apply_action.action(conv_key, addresses_by_id[apply_action.data.actor])
+            for apply_action in apply_batch.actions if not apply_action.duplicate
+        ]
+        if new_actions:
+            await self.pusher.push_applied(self.conn, new_actions, transmit=False)
         return web.Response(status=201)
 
 
@@ -158,3 +280,6 @@ class FallbackWebhook(View):
     async def call(self, request):
         await self.app['fallback'].process_webhook(request)
         return web.Response(status=204)
+
+
+statements.register(Act, ActBatch, Create)
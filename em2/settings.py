@@ -1,7 +1,7 @@
 from datetime import timedelta
 from enum import Enum
 from pathlib import Path
-from typing import Set
+from typing import Dict, Set
 
 from arq import RedisSettings
 from pydantic import BaseSettings, NoneStr, PyObject
@@ -25,7 +25,30 @@ class Settings(BaseSettings):
     COMMS_PLATFORM_TOKEN_LENGTH = 64
     COMMS_AUTHENTICATION_TS_LENIENCY: list = (-10_000, 2_000)
     COMMS_PUSH_TOKEN_EARLY_EXPIRY = 10
+    # tokens with less than this many seconds until they expire are refreshed in the background
+    COMMS_PUSH_TOKEN_REFRESH = 300
+    # maximum time in seconds one process may hold the lock while requesting a token from a node
+    COMMS_PUSH_TOKEN_LOCK_TIMEOUT = 10
     COMMS_DNS_CACHE_EXPIRY = 7200
+    # failed pushes to other nodes are retried with exponential backoff (plus jitter) starting from
+    # COMMS_PUSH_RETRY_DELAY seconds up to COMMS_PUSH_RETRY_MAX_DELAY, after COMMS_PUSH_RETRY_ATTEMPTS they're failed
+    COMMS_PUSH_RETRY_DELAY = 30
+    COMMS_PUSH_RETRY_MAX_DELAY = 3600
+    COMMS_PUSH_RETRY_ATTEMPTS = 10
+    # maximum number of pushes retried by each run of retry_pushes
+    COMMS_PUSH_RETRY_BATCH_SIZE = 100
+    # request and response bodies between nodes smaller than this many bytes aren't compressed
+    COMMS_COMPRESS_MIN_SIZE = 1024
+    # seconds actions wait so actions on the same conversation can be pushed to each node in one request
+    COMMS_PUSH_COALESCE_WINDOW = 0.05
+    # pushes to a node are skipped for COMMS_CIRCUIT_OPEN_TIME seconds after COMMS_CIRCUIT_FAILURES failed requests
+    # within COMMS_CIRCUIT_WINDOW seconds, requests slower than COMMS_CIRCUIT_SLOW_REQUEST seconds count as failures
+    COMMS_CIRCUIT_FAILURES = 5
+    COMMS_CIRCUIT_WINDOW = 60
+    COMMS_CIRCUIT_OPEN_TIME = 30
+    COMMS_CIRCUIT_SLOW_REQUEST = 3
+    # maximum number of domain node discovery lookups (DNS queries and authentication) run at once
+    COMMS_NODE_DISCOVERY_CONCURRENCY = 20
     COMMS_HTTP_TIMEOUT = 4
     COMMS_PROTO = 'https'  # only ever change these during testing!!!
     COMMS_VERIFY_SSL = True  # only ever change these during testing!!!
@@ -44,6 +67,8 @@ class Settings(BaseSettings):
     auth_bcrypt_work_factor = 13
     # TODO should be unique to each node
     auth_node_secret = 'this should be a random string'
+    # maximum number of addresses nodes may check in one request to check-user-nodes
+    auth_check_nodes_max_addresses = 1000
     # TODO should be obtained from auth server by nodes and unique for each node
     auth_session_secret = b'you need to replace me with a real Fernet keyxxxxxxx='
     auth_invitation_secret = b'you need to replace me with a real Fernet keyxxxxxxx='
@@ -78,6 +103,35 @@ class Settings(BaseSettings):
     pg_pool_minsize = 1
     pg_pool_maxsize = 10
 
+    # maximum number of actions which may be applied in one batch request
+    max_batch_actions = 500
+
+    # relative number of jobs workers take from the high, default and low priority queues while they all have jobs
+    # waiting, high is local delivery, default is pushes to other nodes and low is fallback and maintenance
+    worker_queue_weights: Dict[str, int] = {'high': 6, 'dft': 3, 'low': 1}
+
+    # whether views include the actions they've applied and the conversation's participants in push jobs so
+    # local delivery doesn't need to read them from the database
+    push_snapshots = True
+
+    # number of recipient address -> id lookups to keep in memory in each process
+    recipient_cache_size = 10_000
+    # whether to also share recipient ids between processes via a redis hash
+    recipient_cache_redis = True
+
+    # maximum total length of serialised conversations cached in memory in each process, 0 to disable the cache
+    conv_cache_size = 50_000_000
+    # how long in seconds serialised conversations are cached in redis, 0 to not use redis
+    conv_cache_redis_ttl = 3600
+    # number of conversation key prefix -> id lookups to cache for the ui in each process
+    conv_key_cache_size = 10_000
+
+    # conversations updated within snapshot_max_age with at least snapshot_min_actions actions since their last
+    # snapshot get a new snapshot each time snapshots are compacted, up to snapshot_batch_size at a time
+    snapshot_min_actions = 200
+    snapshot_max_age = timedelta(hours=1)
+    snapshot_batch_size = 100
+
     # the domain at which other platforms connect to this node, eg. the "protocol" app's endpoint
     EXTERNAL_DOMAIN = 'em2-domain-set'
     PRIVATE_DOMAIN_KEY_FILE = 'no-key-file-set'
@@ -97,6 +151,10 @@ class Settings(BaseSettings):
 
     FRONTEND_RECIPIENTS_BASE = 'frontend:recipients:{}'
     FRONTEND_JOBS_BASE = 'frontend:jobs:{}'
+    # sorted set of frontend name -> time of last heartbeat
+    FRONTEND_REGISTRY = 'frontend:registry'
+    # frontends which haven't sent a heartbeat for this many seconds are removed from the registry
+    FRONTEND_HEARTBEAT_TIMEOUT = 60
 
     class Config:
         env_prefix = 'EM2_'
@@ -8,11 +8,12 @@ from aiohttp.web import Application, Response, HTTPTemporaryRedirect
 from cryptography.fernet import Fernet
 
 from em2 import VERSION
-from em2.core import Components, Verbs, gen_random, get_create_recipient
+from em2.core import Components, Verbs, conv_cache, gen_random, get_create_recipient, recipient_cache
+from em2.utils.cache import LRUCache
 from em2.utils.web import (access_control_middleware, auth_middleware, db_conn_middleware, prepare_add_origin,
                            set_anon_views)
 from .background import Background
-from .views import Act, ConvActions, Create, Publish, VList, Websocket
+from .views import Act, ActBatch, ConvActions, Create, Publish, VList, Websocket
 
 logger = logging.getLogger('em2.ui')
 
@@ -29,15 +30,20 @@ async def app_startup(app):
         db=settings.db_cls(settings=settings, loop=loop),
         pusher=settings.pusher_cls(settings=settings, loop=loop),
         background=Background(app, loop),
-        auth_client=ClientSession(loop=loop)
+        auth_client=ClientSession(loop=loop),
+        conv_key_cache=LRUCache(settings.conv_key_cache_size),
     )
     await app['db'].startup()
     await app['pusher'].log_redis_info(logger.debug)
+    recipient_cache.configure(settings, app['pusher'].redis)
+    conv_cache.configure(settings, app['pusher'].redis)
 
 
 async def app_cleanup(app):
     await app['auth_client'].close()
     await app['background'].close()
+    recipient_cache.close()
+    conv_cache.close()
     await app['pusher'].close()
     await app['db'].close()
 
@@ -94,6 +100,7 @@ def create_ui_app(settings, app_name=None):
     verbs = '|'.join(m.value for m in Verbs)
     pattern = '/act/%s/{component:%s}/{verb:%s}/' % (conv_match, components, verbs)
     app.router.add_post(pattern, Act.view(), name='act')
+    app.router.add_post('/act/%s/batch/' % conv_match, ActBatch.view(), name='act-batch')
 
     app.router.add_get(r'/c/%s/' % conv_match, ConvActions.view(), name='get')
     app.router.add_get('/', index, name='index')
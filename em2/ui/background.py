@@ -32,7 +32,9 @@ class Background:
         with await self.redis as r:
             await asyncio.gather(
                 r.sadd(self.recipients_key, id),
-                r.expire(self.recipients_key, 60),
+                r.expire(self.recipients_key, self.settings.FRONTEND_HEARTBEAT_TIMEOUT),
+                # heartbeat so pushers know this frontend is running
+                r.zadd(self.settings.FRONTEND_REGISTRY, time(), self.app['name']),
             )
         self._last_added_recipient = time()
 
@@ -45,7 +47,10 @@ class Background:
     async def close(self):
         logger.info('closing frontend background task, done: %r', self.task.done())
         if self.redis:
-            await self.redis.delete(self.recipients_key)
+            await asyncio.gather(
+                self.redis.zrem(self.settings.FRONTEND_REGISTRY, self.app['name']),
+                self.redis.delete(self.recipients_key),
+            )
         if self.task.done():
             self.task.result()
         self.task.cancel()
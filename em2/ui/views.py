@@ -4,12 +4,15 @@ from datetime import datetime
 from typing import List, NamedTuple
 
 from aiohttp import WSMsgType
-from aiohttp.web import HTTPTemporaryRedirect, WebSocketResponse
+from aiohttp.web import HTTPTemporaryRedirect, StreamResponse, WebSocketResponse
+from asyncpg import UniqueViolationError
 from cryptography.fernet import InvalidToken
 from pydantic import EmailStr, constr, validator
 
-from em2.core import ApplyAction, create_missing_recipients, gen_random, generate_conv_key
-from em2.utils.web import JsonError, ViewMain, WebModel, json_response, raw_json_response
+from em2.core import (CONV_KEY_LENGTH, KEY_PREFIX_MATCH, Action, ApplyAction, ApplyActionBatch, ConvCacheVariants,
+                      Verbs, conv_cache, create_missing_recipients, gen_random, generate_conv_key)
+from em2.utils.database import statements
+from em2.utils.web import JSON_CONTENT_TYPE, JsonError, ViewMain, WebModel, json_response, raw_json_response
 
 logger = logging.getLogger('em2.d.views')
 
@@ -44,24 +47,29 @@ class VList(View):
 
 
 class ConvActions(View):
-    get_conv_sql = """
-    SELECT c.id, c.published, c.creator FROM conversations AS c
+    _get_conv_template = """
+    SELECT c.id, c.published, c.creator, (SELECT max(a.id) FROM actions AS a WHERE a.conv = c.id)
+    FROM conversations AS c
     JOIN participants AS p ON c.id=p.conv
-    WHERE p.recipient=$1 AND c.key LIKE $2
+    WHERE p.recipient=$1 AND {where}
     ORDER BY c.created_ts, c.id DESC
     LIMIT 1
     """
-    deleted_action_sql = """
+    # see KEY_PREFIX_MATCH
+    get_conv_sql = _get_conv_template.format(where=KEY_PREFIX_MATCH.format('$2'))
+    get_conv_exact_sql = _get_conv_template.format(where='c.key=$2')
+    # used to check ids from the key cache still match the prefix, keys change when conversations are published
+    get_conv_by_id_sql = _get_conv_template.format(where='c.id=$2 AND ' + KEY_PREFIX_MATCH.format('$3'))
+
+    deleted_action_sql = f"""
     SELECT c.id, c.published, c.creator, a.id FROM actions AS a
     JOIN conversations c ON a.conv = c.id
-    WHERE a.recipient=$1 AND c.key LIKE $2 AND a.component='participant' AND a.verb='delete'
+    WHERE a.recipient=$1 AND {KEY_PREFIX_MATCH.format('$2')} AND a.component='participant' AND a.verb='delete'
     ORDER BY c.created_ts, c.id DESC, a.id DESC
     LIMIT 1
     """
 
-    actions_sql = """
-    SELECT array_to_json(array_agg(row_to_json(t)), TRUE)
-    FROM (
+    _actions_rows_template = """
       SELECT a.key AS key, a.verb AS verb, a.component AS component, a.body AS body, a.timestamp AS timestamp,
       actor_recipient.address AS actor,
       a_parent.key AS parent,
@@ -75,46 +83,160 @@ class ConvActions(View):
       JOIN recipients AS actor_recipient ON a.actor = actor_recipient.id
 
       LEFT JOIN recipients AS prt_recipient ON a.recipient = prt_recipient.id
-      WHERE {where_clause}
+      WHERE {where}
       ORDER BY a.id
-    ) t;
+      LIMIT {limit}
     """
+    # the final parameter of every variant is the limit, NULL for all actions
+    _rows = _actions_rows_template.format(where='a.conv = $1', limit='$2')
+    _rows_since = _actions_rows_template.format(where='a.conv = $1 AND a.id > $2', limit='$3')
+    _rows_upto = _actions_rows_template.format(where='a.conv = $1 AND a.id <= $2', limit='$3')
+    _rows_since_upto = _actions_rows_template.format(where='a.conv = $1 AND a.id > $2 AND a.id <= $3', limit='$4')
+
+    # fixed variants so each can be prepared, "actions*" return one json array
+    _actions_template = 'SELECT array_to_json(array_agg(row_to_json(t)), TRUE) FROM ({}) t'
+    actions_sql = _actions_template.format(_rows)
+    actions_since_sql = _actions_template.format(_rows_since)
+    actions_upto_sql = _actions_template.format(_rows_upto)
+    actions_since_upto_sql = _actions_template.format(_rows_since_upto)
+
+    # "stream_actions*" return one json object per row to be read with a cursor
+    _stream_template = 'SELECT row_to_json(t)::TEXT FROM ({}) t'
+    stream_actions_sql = _stream_template.format(_rows)
+    stream_actions_since_sql = _stream_template.format(_rows_since)
+    stream_actions_upto_sql = _stream_template.format(_rows_upto)
+    stream_actions_since_upto_sql = _stream_template.format(_rows_since_upto)
+
+    # number of rows fetched from the cursor at a time when streaming
+    stream_prefetch = 500
 
     action_id_sql = 'SELECT id FROM actions WHERE conv=$1 AND key=$2'
 
+    # latest snapshot, if the recipient has been removed from the conversation only up to their removal
+    snapshot_sql = """
+    SELECT s.action, json_build_object('action', a.key, 'state', s.data)::text
+    FROM conv_snapshots AS s
+    JOIN actions AS a ON s.action = a.id
+    WHERE s.conv = $1 AND ($2::INT IS NULL OR s.action <= $2)
+    ORDER BY s.action DESC
+    LIMIT 1
+    """
+
     async def call(self, request):
         conv_key = request.match_info['conv']
-        where_filter = []
-        try:
-            conv_id, published, creator = await self.fetchrow404(
-                self.get_conv_sql,
-                self.session.recipient_id,
-                conv_key + '%',
-                log_warning=False,
-            )
-        except JsonError.HTTPNotFound:
+        last_action = None
+        r = await self._get_conv(conv_key)
+        if r:
+            conv_id, published, creator, latest_action = r
+        else:
             # can happen legitimately when they were deleted from the conversation
+            latest_action = None
             conv_id, published, creator, last_action = await self.fetchrow404(
                 self.deleted_action_sql,
                 self.session.recipient_id,
-                conv_key + '%',
+                conv_key,
                 msg=f'conversation {conv_key} not found'
             )
-            where_filter.append(('a.id <= ${arg}', last_action))
 
         if not published and self.session.recipient_id != creator:
             raise JsonError.HTTPForbidden(error='conversation is unpublished and you are not the creator')
 
         since_action = request.query.get('since')
+        first_action_id, snapshot = None, None
+        stream = self._query_flag('stream')
         if since_action:
             first_action_id = await self.fetchval404(self.action_id_sql, conv_id, since_action)
-            where_filter.append(('a.id > ${arg}', first_action_id))
-        where_filter.append(('a.conv=${arg}', conv_id))
-        where_clause = ' AND '.join(f[0].format(arg=i + 1) for i, f in enumerate(where_filter))
-        args = [f[1] for f in where_filter]
-        json_str = await self.conn.fetchval(self.actions_sql.format(where_clause=where_clause), *args)
+        elif self._query_flag('snapshot'):
+            if stream:
+                raise JsonError.HTTPBadRequest(error='snapshot and stream may not be combined')
+            r = await self.conn.fetchrow(self.snapshot_sql, conv_id, last_action)
+            first_action_id, snapshot = r or (None, 'null')
+
+        limit = self._get_limit()
+        query = self._actions_query(conv_id, first_action_id, last_action, limit)
+        if stream:
+            return await self._stream_actions(request, 'stream_' + query[0], *query[1:])
+
+        # only the full list of actions is cached
+        if first_action_id is not None or limit:
+            latest_action = None
+        json_str = await conv_cache.get(conv_id, latest_action, ConvCacheVariants.ui_actions)
+        if json_str is None:
+            json_str = await self.conn.fetchval(getattr(self, query[0]), *query[1:])
+            await conv_cache.set(conv_id, latest_action, ConvCacheVariants.ui_actions, json_str)
+        if snapshot:
+            return raw_json_response(f'{{"snapshot":{snapshot},"actions":{json_str or "[]"}}}')
         return raw_json_response(json_str or '[]')
 
+    async def _get_conv(self, conv_key):
+        """
+        Find the conversation by key, full keys are matched exactly while prefixes are cached for each recipient.
+        """
+        recipient_id = self.session.recipient_id
+        if len(conv_key) == CONV_KEY_LENGTH:
+            return await self.conn.fetchrow(self.get_conv_exact_sql, recipient_id, conv_key)
+
+        key_cache = self.app['conv_key_cache']
+        cache_key = recipient_id, conv_key
+        conv_id = key_cache.get(cache_key)
+        if conv_id is not None:
+            r = await self.conn.fetchrow(self.get_conv_by_id_sql, recipient_id, conv_id, conv_key)
+            if r:
+                return r
+            key_cache.pop(cache_key)
+
+        r = await self.conn.fetchrow(self.get_conv_sql, recipient_id, conv_key)
+        if r:
+            key_cache.set(cache_key, r[0])
+        return r
+
+    def _query_flag(self, name):
+        return self.request.query.get(name) in {'1', 'true'}
+
+    def _get_limit(self):
+        limit = self.request.query.get('limit')
+        if limit is None:
+            return
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise JsonError.HTTPBadRequest(error='limit must be a positive integer')
+        return limit
+
+    def _actions_query(self, conv_id, first_action_id, last_action, limit):
+        """
+        :return: tuple (name of the sql attribute, *args)
+        """
+        name, args = 'actions', [conv_id]
+        if first_action_id is not None:
+            name += '_since'
+            args.append(first_action_id)
+        if last_action is not None:
+            name += '_upto'
+            args.append(last_action)
+        return (name + '_sql', *args, limit)
+
+    async def _stream_actions(self, request, sql_name, *args):
+        """
+        Write actions as a chunked json array read from a server side cursor so memory use doesn't depend
+        on the number of actions.
+        """
+        response = StreamResponse()
+        response.content_type = JSON_CONTENT_TYPE
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        prefix = b'['
+        # cursors require a transaction
+        async with self.conn.transaction():
+            async for (json_str,) in self.conn.cursor(getattr(self, sql_name), *args, prefetch=self.stream_prefetch):
+                await response.write(prefix + json_str.encode())
+                prefix = b','
+        await response.write(b'[]' if prefix == b'[' else b']')
+        await response.write_eof()
+        return response
+
 
 class _PublishCreateView(View):
     create_msg_action_sql = """
@@ -133,35 +255,40 @@ class _PublishCreateView(View):
     create_action_sql = """
     INSERT INTO actions (key, conv, actor, body, parent, verb)
     VALUES              ($1,  $2,   $3,    $4,   $5,     $6  )
-    RETURNING id
+    RETURNING id, timestamp
     """
 
-    async def publish_create(self, conv_id, subject, recip_ids, publish):
+    async def publish_create(self, conv_id, conv_key, subject, recip_ids, publish) -> Action:
+        parent_key = gen_random('act')
         parent_id = await self.conn.fetchval(
             self.create_msg_action_sql,
-            gen_random('act'),
+            parent_key,
             conv_id,
             self.session.recipient_id,
         )
         for recipient in recip_ids:
+            parent_key = gen_random('act')
             parent_id = await self.conn.fetchval(
                 self.create_prt_action_sql,
-                gen_random('act'),
+                parent_key,
                 conv_id,
                 self.session.recipient_id,
                 recipient,
                 parent_id,
             )
-        verb = 'publish' if publish else 'create'
-        return await self.conn.fetchval(
+        verb = Verbs.PUBLISH if publish else Verbs.CREATE
+        key = gen_random(verb[:3])
+        action_id, timestamp = await self.conn.fetchrow(
             self.create_action_sql,
-            gen_random(verb[:3]),
+            key,
             conv_id,
             self.session.recipient_id,
             subject,
             parent_id,
             verb,
         )
+        return Action(action_id, key, conv_key, conv_id, verb, None, self.session.address, timestamp,
+                      parent_id and parent_key, subject, None, None, None)
 
 
 class Create(_PublishCreateView):
@@ -215,9 +342,10 @@ class Create(_PublishCreateView):
             await self.conn.executemany(self.add_participants_sql, {(conv_id, rid) for rid in recip_ids})
             await self.conn.execute(self.add_message_sql, conv_id, conv.msg_key, conv.message)
 
-            create_action_id = await self.publish_create(conv_id, conv.subject, recip_ids, conv.publish)
+            create_action = await self.publish_create(conv_id, conv.conv_key, conv.subject, recip_ids, conv.publish)
 
-        await self.pusher.push(create_action_id, actor_only=True)
+        await self.pusher.push_applied(self.conn, [create_action], actor_id=self.session.recipient_id,
+                                       actor_only=True)
         return json_response(key=conv.conv_key, status_=201)
 
 
@@ -253,7 +381,8 @@ class Act(View):
         )
         await apply_action.run()
 
-        await self.pusher.push(apply_action.action_id, actor_only=not conv_published)
+        await self.pusher.push_applied(self.conn, [apply_action.action(conv_key, self.session.address)],
+                                       actor_id=self.session.recipient_id, actor_only=not conv_published)
         return json_response(
             key=apply_action.data.action_key,
             conv_key=conv_key,
@@ -267,15 +396,78 @@ class Act(View):
         )
 
 
+class ActBatch(Act):
+    class BatchModel(WebModel):
+        actions: List[dict] = ...
+
+        @validator('actions')
+        def validate_actions(cls, v):
+            for action in v:
+                action_key = action.get('action_key')
+                if action_key is not None and (not isinstance(action_key, str) or not action_key.startswith('act-') or
+                                               len(action_key) != 20 or action_key != action_key.lower()):
+                    raise ValueError(f'invalid action key "{action_key}"')
+            return v
+
+    async def call(self, request):
+        conv_key = request.match_info['conv']
+        conv_id, conv_published = await self.fetchrow404(
+            self.get_conv_part_sql,
+            conv_key,
+            self.session.recipient_id,
+            msg=f'conversation {conv_key} not found'
+        )
+        batch = self.BatchModel(**await self.request_json())
+        if len(batch.actions) > self.settings.max_batch_actions:
+            raise JsonError.HTTPBadRequest(error=f'batches are limited to {self.settings.max_batch_actions} actions')
+
+        # action keys may be set by the client so actions later in the batch can reference them as parents
+        apply_batch = ApplyActionBatch(
+            self.conn,
+            remote_action=False,
+            actions=[{'action_key': gen_random('act'), **action} for action in batch.actions],
+            conv=conv_id,
+            published=conv_published,
+            actor=self.session.recipient_id,
+        )
+        try:
+            await apply_batch.run()
+        except UniqueViolationError as e:
+            if e.constraint_name != 'actions_conv_key_key':
+                raise
+            raise JsonError.HTTPConflict(error='action key conflicts with an existing action')
+
+        await self.pusher.push_applied(
+            self.conn,
+            [apply_action.action(conv_key, self.session.address) for apply_action in apply_batch.actions],
+            actor_id=self.session.recipient_id,
+            actor_only=not conv_published,
+        )
+        return json_response(list_=[
+            dict(
+                key=apply_action.data.action_key,
+                conv_key=conv_key,
+                component=apply_action.data.component,
+                verb=apply_action.data.verb,
+                ts=apply_action.action_timestamp,
+                parent=apply_action.data.parent,
+                relationship=apply_action.data.relationship,
+                body=apply_action.data.body,
+                item=apply_action.item_key,
+            )
+            for apply_action in apply_batch.actions
+        ])
+
+
 class Publish(_PublishCreateView):
     get_conv_sql = """
     SELECT c.id, c.subject
     FROM conversations AS c
     JOIN participants AS p ON c.id = p.conv
-    WHERE c.published = False AND c.key LIKE $1 AND c.creator=$2 AND p.recipient=$2
+    WHERE c.published = False AND {key_match} AND c.creator=$2 AND p.recipient=$2
     ORDER BY c.created_ts, c.id DESC
     LIMIT 1
-    """
+    """.format(key_match=KEY_PREFIX_MATCH.format('$1'))
     update_conv_sql = """
     UPDATE conversations SET key=$1, created_ts=$2, updated_ts=$2, published = True
     WHERE id=$3
@@ -287,7 +479,7 @@ class Publish(_PublishCreateView):
         old_conv_key = request.match_info['conv']
         conv_id, subject = await self.fetchrow404(
             self.get_conv_sql,
-            old_conv_key + '%',
+            old_conv_key,
             self.session.recipient_id
         )
         new_ts = datetime.utcnow()
@@ -301,10 +493,10 @@ class Publish(_PublishCreateView):
             )
             await self.conn.execute(self.delete_actions_sql, conv_id)
             recip_ids = [r[0] for r in await self.conn.fetch(self.get_recipients_sql, conv_id)]
-            pub_action_id = await self.publish_create(conv_id, subject, recip_ids, True)
+            pub_action = await self.publish_create(conv_id, conv_key, subject, recip_ids, True)
 
         logger.info('published %s, old key %s', conv_key, old_conv_key)
-        await self.pusher.push(pub_action_id)
+        await self.pusher.push_applied(self.conn, [pub_action])
         return json_response(key=conv_key)
 
 
@@ -339,3 +531,6 @@ class Websocket(ViewMain):
             logger.info('ws disconnection %s', session)
             await self.app['background'].remove_recipient(session.recipient_id)
         return ws
+
+
+statements.register(VList, ConvActions, _PublishCreateView, Create, Act, ActBatch, Publish)
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache with hit and miss counters.
+
+    By default max_size is the number of entries, size_func may be used to give each value a different size,
+    eg. its length in bytes.
+    """
+    def __init__(self, max_size: int, size_func=None):
+        self.max_size = max_size
+        self._size_func = size_func or (lambda v: 1)
+        self._data = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        else:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        self.pop(key)
+        self._data[key] = value
+        self._size += self._size_func(value)
+        while self._size > self.max_size:
+            _, old_value = self._data.popitem(last=False)
+            self._size -= self._size_func(old_value)
+
+    def pop(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        else:
+            self._size -= self._size_func(value)
+            return value
+
+    def clear(self):
+        self._data.clear()
+        self._size = 0
+
+    def stats(self):
+        return dict(size=self._size, hits=self.hits, misses=self.misses)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
@@ -0,0 +1,90 @@
+"""
+Content codings used to compress bodies sent between nodes.
+
+Codecs are registered by name in order of preference, the name is used in Content-Encoding and Accept-Encoding
+headers. Nodes advertise the codings they accept with Accept-Encoding on protocol responses, see RFC 7694.
+"""
+import gzip
+import zlib
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# codings aiohttp's server decodes itself before request bodies are read
+NATIVE_ENCODINGS = {'gzip', 'deflate', 'br'}
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class Codec:
+    name: str = None
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError()
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return gzip.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+codecs: Dict[str, Codec] = OrderedDict()
+
+
+def register_codec(codec: Codec):
+    codecs[codec.name] = codec
+
+
+register_codec(GzipCodec())
+
+
+def accept_encoding() -> str:
+    return ', '.join(codecs)
+
+
+def choose_codec(accept: Optional[str]) -> Optional[Codec]:
+    """
+    Choose the first registered codec listed in an Accept-Encoding header, codings with "q=0" are ignored.
+    """
+    accepted = set()
+    for coding in (accept or '').lower().split(','):
+        name, *params = [p.strip() for p in coding.split(';')]
+        q = next((p[2:] for p in params if p.startswith('q=')), '1')
+        try:
+            if float(q) > 0:
+                accepted.add(name)
+        except ValueError:
+            pass
+    return next((c for name, c in codecs.items() if name in accepted), None)
+
+
+def decode_body(data: bytes, encoding: Optional[str], *, native_decoded=False) -> bytes:
+    """
+    Decode a body using its Content-Encoding, raises UnsupportedEncoding if the coding isn't registered or
+    ValueError if the body is invalid.
+
+    :param native_decoded: whether codings in NATIVE_ENCODINGS have already been decoded, eg. by aiohttp's server
+    """
+    encoding = (encoding or 'identity').lower()
+    if encoding == 'identity' or (native_decoded and encoding in NATIVE_ENCODINGS):
+        return data
+    try:
+        codec = codecs[encoding]
+    except KeyError:
+        raise UnsupportedEncoding(f'unsupported content encoding "{encoding}"')
+    try:
+        return codec.decompress(data)
+    except (OSError, EOFError, zlib.error) as e:
+        raise ValueError(f'invalid {encoding} body: {e}') from e
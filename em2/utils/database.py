@@ -1,14 +1,116 @@
 import asyncio
 import logging
+from time import perf_counter
+from typing import Dict, List, Tuple
 
 import asyncpg
 from async_timeout import timeout
+from asyncpg.prepared_stmt import PreparedStatement
 
 from em2.settings import Settings
 
 logger = logging.getLogger('em2.database')
 
 
+class PreparedStatements:
+    """
+    Registry of frequently used SQL statements, each statement is prepared when a pool connection is created
+    and the number of times it's run and the total time taken are recorded.
+    """
+    def __init__(self):
+        # sql -> name
+        self._names: Dict[str, str] = {}
+        # name -> [calls, total time]
+        self._stats: Dict[str, List] = {}
+
+    def add(self, name: str, sql: str):
+        self._names[sql] = name
+        self._stats[name] = [0, 0.0]
+        return sql
+
+    def register(self, *classes):
+        """
+        Add all string attributes of the given classes whose names end in "sql".
+        """
+        for cls in classes:
+            for attr, value in vars(cls).items():
+                if attr.lower().endswith('sql') and isinstance(value, str):
+                    self.add(f'{cls.__name__}.{attr}', value)
+
+    def names(self):
+        return set(self._names.values())
+
+    async def prepare(self, conn: 'Connection'):
+        """
+        Prepare all statements on a connection, used as the "init" hook when creating the pool.
+        """
+        for sql, name in self._names.items():
+            try:
+                conn.prepared[sql] = await conn.prepare(sql)
+            except asyncpg.PostgresError as e:
+                logger.warning('error preparing statement %s: %s %s', name, e.__class__.__name__, e)
+
+    def record(self, sql: str, duration: float):
+        stats = self._stats[self._names[sql]]
+        stats[0] += 1
+        stats[1] += duration
+
+    def stats(self) -> List[Tuple[str, int, float]]:
+        """
+        :return: list of (name, calls, total time in seconds), most time consuming first
+        """
+        return sorted(((n, c, t) for n, (c, t) in self._stats.items() if c), key=lambda s: s[2], reverse=True)
+
+    def log_stats(self, log_func):
+        for name, calls, total_time in self.stats():
+            log_func('%s: %d calls, %0.2fms total, %0.3fms mean', name, calls, total_time * 1000,
+                     total_time * 1000 / calls)
+
+
+statements = PreparedStatements()
+
+
+class Connection(asyncpg.connection.Connection):
+    """
+    asyncpg connection which executes statements prepared by the registry rather than sending their text.
+
+    Statements which aren't in the registry are executed as normal.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: Dict[str, PreparedStatement] = {}
+
+    async def _run_prepared(self, method, query, args, kwargs):
+        stmt = self.prepared.get(query)
+        if stmt is None:
+            return await getattr(super(), method)(query, *args, **kwargs)
+        start = perf_counter()
+        try:
+            return await getattr(stmt, method)(*args, **kwargs)
+        finally:
+            statements.record(query, perf_counter() - start)
+
+    async def fetch(self, query, *args, timeout=None):
+        return await self._run_prepared('fetch', query, args, {'timeout': timeout})
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        return await self._run_prepared('fetchval', query, args, {'column': column, 'timeout': timeout})
+
+    async def fetchrow(self, query, *args, timeout=None):
+        return await self._run_prepared('fetchrow', query, args, {'timeout': timeout})
+
+    async def execute(self, query, *args, timeout=None):
+        stmt = self.prepared.get(query)
+        if stmt is None or not args:
+            return await super().execute(query, *args, timeout=timeout)
+        start = perf_counter()
+        try:
+            await stmt.fetch(*args, timeout=timeout)
+            return stmt.get_statusmsg()
+        finally:
+            statements.record(query, perf_counter() - start)
+
+
 async def lenient_pg_connection(settings, _retry=0):
     no_db_dsn, _ = settings.pg_dsn.rsplit('/', 1)
 
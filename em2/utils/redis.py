@@ -0,0 +1,20 @@
+from hashlib import sha1
+
+from aioredis.errors import ReplyError
+
+
+class RedisScript:
+    """
+    Lua script run with EVALSHA, falling back to EVAL (which also loads the script) if redis doesn't know it yet.
+    """
+    def __init__(self, script: str):
+        self.script = script
+        self.sha = sha1(script.encode()).hexdigest()
+
+    async def __call__(self, redis, keys=(), args=()):
+        try:
+            return await redis.evalsha(self.sha, keys=list(keys), args=list(args))
+        except ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        return await redis.eval(self.script, keys=list(keys), args=list(args))
@@ -0,0 +1,102 @@
+"""
+Fast path validation for pydantic models which are built for every action.
+
+Each field gets a check which either returns the final value or INVALID, checks only accept values which
+are unambiguously valid (eg. an int not a numeric string) so the model is built with construct() and pydantic's
+own validation is skipped. Anything else returns None so the caller can fall back to full validation and get
+the normal errors.
+"""
+from datetime import datetime
+from enum import Enum
+from typing import Callable, Dict, Optional, Tuple, Type
+
+from pydantic import BaseModel
+from pydantic.datetime_parse import parse_datetime
+
+INVALID = object()
+REQUIRED = object()
+
+
+def strict(type_):
+    def check(v):
+        return v if type(v) is type_ else INVALID
+    return check
+
+
+def str_length(min_length=0, max_length=2 ** 16):
+    def check(v):
+        return v if type(v) is str and min_length <= len(v) <= max_length else INVALID
+    return check
+
+
+def enum_member(enum: Type[Enum]):
+    # the same lookup finds members from either their value or the member itself, members are singletons so
+    # all validated actions share the same objects
+    lookup = {m.value: m for m in enum}
+
+    def check(v):
+        try:
+            return lookup.get(v, INVALID)
+        except TypeError:
+            # unhashable
+            return INVALID
+    return check
+
+
+def datetime_value(v):
+    if type(v) is datetime:
+        return v
+    elif type(v) is str:
+        try:
+            return parse_datetime(v)
+        except (ValueError, TypeError):
+            return INVALID
+    return INVALID
+
+
+def optional(check):
+    def optional_check(v):
+        return None if v is None else check(v)
+    return optional_check
+
+
+class FastValidator:
+    """
+    Validate dicts against a table of field checks and build the model without running pydantic validation.
+
+    fields maps field names to (check, default), use REQUIRED as the default for required fields.
+    """
+    def __init__(self, model: Type[BaseModel], fields: Dict[str, Tuple[Callable, object]]):
+        missing = set(model.__fields__) ^ set(fields)
+        assert not missing, f'fields differ from {model.__name__}: {", ".join(sorted(missing))}'
+        self.model = model
+        self.fields = fields
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, data: dict) -> Optional[BaseModel]:
+        values = self.validate(data)
+        if values is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.model.construct(**values)
+
+    def validate(self, data: dict) -> Optional[dict]:
+        fields = self.fields
+        if not data.keys() <= fields.keys():
+            # extra fields, let the model raise an error
+            return None
+        values = {}
+        for name, (check, default) in fields.items():
+            v = data.get(name, REQUIRED)
+            if v is REQUIRED:
+                if default is REQUIRED:
+                    return None
+                values[name] = default
+            else:
+                v = check(v)
+                if v is INVALID:
+                    return None
+                values[name] = v
+        return values
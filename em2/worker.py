@@ -1,10 +1,71 @@
-from arq import BaseWorker
+import asyncio
+from functools import partial
+from typing import Dict
+
+from arq import BaseWorker, Drain
+from arq.drain import work_logger
+from arq.utils import gen_random
+from async_timeout import timeout
 
 from em2 import setup_logging
 from em2.protocol.push import Pusher
 from em2.settings import Settings
 
 
+class WeightedDrain(Drain):
+    """
+    Drain which takes jobs from queues in proportion to their weights while more than one queue has jobs waiting,
+    rather than always emptying higher priority queues first. Queues are ordered for each BLPOP using smooth weighted
+    round robin, so an empty queue never delays jobs in the others.
+    """
+    def __init__(self, *, queue_weights: Dict[bytes, int], **kwargs):
+        super().__init__(**kwargs)
+        self.queue_weights = queue_weights
+        self._current_weights = dict.fromkeys(queue_weights, 0)
+
+    def queue_order(self, raw_queues):
+        total = 0
+        for q in raw_queues:
+            weight = self.queue_weights.get(q, 1)
+            self._current_weights[q] = self._current_weights.get(q, 0) + weight
+            total += weight
+        first = max(raw_queues, key=self._current_weights.__getitem__)
+        self._current_weights[first] -= total
+        return (first,) + tuple(q for q in raw_queues if q != first)
+
+    async def iter(self, *raw_queues: bytes, pop_timeout=1):
+        work_logger.debug('starting weighted blpop loop')
+        quit_queue = None
+        assert self.running, 'drain iter will only work when the drain is running'
+        if self.burst_mode:
+            quit_queue = b'arq:quit-' + gen_random()
+            await self.redis.rpush(quit_queue, b'1')
+        while True:
+            try:
+                with timeout(self.semaphore_timeout):
+                    await self.task_semaphore.acquire()
+            except asyncio.TimeoutError:
+                work_logger.warning('task semaphore acquisition timed after %0.1fs', self.semaphore_timeout)
+                continue
+
+            if not self.running:
+                break
+            queues = self.queue_order(raw_queues)
+            if quit_queue:
+                queues += quit_queue,
+            with await self.redis as r:
+                msg = await r.blpop(*queues, timeout=pop_timeout)
+            if msg is None:
+                yield None, None
+                self.task_semaphore.release()
+                continue
+            raw_queue, raw_data = msg
+            if raw_queue == quit_queue:
+                work_logger.debug('got job from the quit queue, stopping')
+                break
+            yield raw_queue, raw_data
+
+
 class Worker(BaseWorker):
     """
     arq worker used to execute jobs
@@ -16,6 +77,8 @@ class Worker(BaseWorker):
         setup_logging(self.settings)
         kwargs['redis_settings'] = self.settings.redis
         super().__init__(**kwargs)
+        queue_weights = {Pusher.QUEUE_PREFIX + q.encode(): w for q, w in self.settings.worker_queue_weights.items()}
+        self.drain_class = partial(WeightedDrain, queue_weights=queue_weights)
 
     async def shadow_kwargs(self):
         return dict(
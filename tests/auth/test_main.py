@@ -310,6 +310,35 @@ async def test_check_user_node_missing(cli, url, user, settings):
     assert {'local': False} == await r.json()
 
 
+async def test_check_user_nodes(cli, url, user, settings):
+    r = await cli.post(
+        url('check-user-nodes'),
+        headers={'Authorization': settings.auth_node_secret},
+        json={'addresses': [TEST_ADDRESS, 'foobar@other.com'], 'domain': settings.EXTERNAL_DOMAIN},
+    )
+    assert r.status == 200, await r.text()
+    assert {'local': {TEST_ADDRESS: True, 'foobar@other.com': False}} == await r.json()
+
+
+async def test_check_user_nodes_too_many(cli, url, user, settings):
+    cli.server.app['settings'].auth_check_nodes_max_addresses = 2
+    r = await cli.post(
+        url('check-user-nodes'),
+        headers={'Authorization': settings.auth_node_secret},
+        json={'addresses': ['a@other.com', 'b@other.com', 'c@other.com'], 'domain': settings.EXTERNAL_DOMAIN},
+    )
+    assert r.status == 400, await r.text()
+
+
+async def test_check_user_nodes_bad_auth(cli, url, user, settings):
+    r = await cli.post(
+        url('check-user-nodes'),
+        headers={'Authorization': 'xxx'},
+        json={'addresses': [TEST_ADDRESS], 'domain': settings.EXTERNAL_DOMAIN},
+    )
+    assert r.status == 403, await r.text()
+
+
 async def test_check_user_node_bad_auth(cli, url, user, settings):
     r = await cli.get(
         url('check-user-node'),
@@ -75,16 +75,38 @@ async def act(request):
         return Response(status=201)
 
 
+async def batch(request):
+    if request.match_info['conv'] not in request.app['convs']:
+        raise HTTPNotFound(text='conversation not found')
+    data = await request.json()
+    # like ApplyActionBatch, parents within the batch must come before their children
+    positions = {action['key']: i for i, action in enumerate(data['actions'])}
+    if any(positions.get(action.get('parent'), -1) >= i for i, action in enumerate(data['actions'])):
+        return Response(text='parent must come before its child in batch', status=400)
+    request.app['batches'].append(data)
+    return Response(status=201)
+
+
 async def status(request):
     return Response(status=int(request.match_info['status']))
 
 
+async def encoded(request):
+    # body claiming to use a coding which wasn't asked for
+    return Response(body=b'xxx', headers={'Content-Encoding': request.match_info['coding']})
+
+
 async def check_user_node(request):
     d = await request.json()
     domain = d['address'].split('@', 1)[-1]
     return json_response({'local': domain in {'example.com'}})
 
 
+async def check_user_nodes(request):
+    d = await request.json()
+    return json_response({'local': {a: a.split('@', 1)[-1] in {'example.com'} for a in d['addresses']}})
+
+
 @middleware
 async def logging_middleware(request, handler):
     try:
@@ -105,8 +127,14 @@ def create_test_app():
     app.router.add_get('/get/{conv:[a-z0-9]+}/', get)
     app.router.add_post('/{conv:[a-z0-9]+}/{component:[a-z]+}/{verb:[a-z]+}/{item:.*}', act)
     app.router.add_post('/create/{conv:[a-z0-9]+}/', create)
+    app.router.add_post('/batch/{conv:[a-z0-9]+}/', batch)
     app.router.add_route('*', r'/status/{status:\d+}/', status)
+    app.router.add_get('/encoded/{coding}/', encoded)
     app.router.add_get('/check-user-node/', check_user_node)
+    app.router.add_post('/check-user-nodes/', check_user_nodes)
 
     app['request_log'] = []
+    app['batches'] = []
+    # conversations the node has, batches for other conversations get a 404
+    app['convs'] = {'key12345678'}
     return app
@@ -35,6 +35,8 @@ def mocked_pusher(loop, settings, db_conn, foreign_server):
     async def _init():
         _pusher = DNSMockedPusher(settings, loop=loop, worker=True)
         await _pusher.startup()
+        # push_remote and push_fallback jobs run directly
+        _pusher._concurrency_enabled = False
         _pusher.db.conn = db_conn
 
         _pusher.set_foreign_port(foreign_server.port)
@@ -1,7 +1,16 @@
+import asyncio
 import json
+from time import time
 
-from em2.core import ApplyAction, GetConv
+import pytest
+from aiohttp.hdrs import METH_GET
+from arq.jobs import DatetimeJob
+
+from em2.core import Action, ApplyAction, GetConv
+from em2.exceptions import Em2ConnectionError
 from em2.protocol.fallback import get_email_body
+from em2.protocol.push import load_private_key
+from em2.utils.encoding import msg_decode
 from tests.conftest import CloseToNow, RegexStr
 
 
@@ -20,11 +29,155 @@ async def test_add_participant_foreign(mocked_pusher, db_conn, conv, foreign_ser
     await mocked_pusher.push.direct(apply_action.action_id)
 
     assert foreign_server.app['request_log'] == [
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
+        'POST /auth/ > 201',
+        RegexStr('POST /key12345678/participant/add/testing@foreign.com > 201'),
+    ]
+
+
+async def test_push_snapshot(mocked_pusher, db_conn, conv, foreign_server):
+    apply_action = ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-testing-add--prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    )
+    await apply_action.run()
+    action = apply_action.action(conv.key, conv.creator_address)
+    assert [action] == await mocked_pusher._get_actions(db_conn, [apply_action.action_id])
+
+    await mocked_pusher.push_applied(db_conn, [action])
+    assert foreign_server.app['request_log'] == [
+        'POST /check-user-nodes/ > 200',
         'POST /auth/ > 201',
         RegexStr('POST /key12345678/participant/add/testing@foreign.com > 201'),
     ]
+    assert ['successful'] == [r[0] for r in await db_conn.fetch('SELECT status FROM action_states')]
+
+
+async def test_cached_nodes(mocked_pusher, db_conn, conv, foreign_server):
+    apply_action = ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-testing-add--prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    )
+    await apply_action.run()
+    prts = set(await db_conn.fetch(mocked_pusher.prts_sql, conv.id))
+    assert await mocked_pusher.cached_nodes(prts) == {'testing@example.com': None, 'testing@foreign.com': None}
+
+    await mocked_pusher.push.direct(apply_action.action_id)
+    assert await mocked_pusher.cached_nodes(prts) == {
+        'testing@example.com': 'L',
+        'testing@foreign.com': f'em2.platform.foreign.com:{foreign_server.port}',
+    }
+    assert len(foreign_server.app['request_log']) == 3
+
+    # nodes are now all cached so categorise_addresses doesn't need to check the auth server
+    remote_nodes, local_recipients, fallback_addresses = await mocked_pusher.categorise_addresses(prts)
+    assert remote_nodes == {f'em2.platform.foreign.com:{foreign_server.port}': {'testing@foreign.com'}}
+    assert len(local_recipients) == 1
+    assert fallback_addresses == set()
+    assert len(foreign_server.app['request_log']) == 3
+
+
+async def test_categorise_addresses_shared_domain(mocked_pusher, foreign_server):
+    prts = {(1, 'testing@example.com'), (2, 'a@foreign.com'), (3, 'b@foreign.com'), (4, 'c@foreign.com')}
+    remote_nodes, local_recipients, fallback_addresses = await mocked_pusher.categorise_addresses(prts)
+    assert remote_nodes == {
+        f'em2.platform.foreign.com:{foreign_server.port}': {'a@foreign.com', 'b@foreign.com', 'c@foreign.com'},
+    }
+    assert local_recipients == {1}
+    assert fallback_addresses == set()
+    # all addresses are checked with the auth server at once and foreign.com is only discovered once
+    assert foreign_server.app['request_log'] == ['POST /check-user-nodes/ > 200', 'POST /auth/ > 201']
+    assert mocked_pusher._domain_lookups == {}
+
+
+async def test_push_queues(mocked_pusher, db_conn, conv, foreign_server):
+    apply_action = ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-testing-add--prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    )
+    await apply_action.run()
+    redis = await mocked_pusher.get_redis()
+    await redis.set(b'an:testing@example.com', b'L')
+    mocked_pusher._concurrency_enabled = True
+
+    await mocked_pusher.push.direct(apply_action.action_id)
+    # local delivery is done, the foreign participant is left to a job on the default queue
+    assert foreign_server.app['request_log'] == []
+    assert await redis.llen(mocked_pusher.queue_lookup['high']) == 0
+    jobs = [DatetimeJob.decode(j) for j in await redis.lrange(mocked_pusher.queue_lookup['dft'], 0, -1)]
+    assert [(j.func_name, j.args) for j in jobs] == [('push_remote', [[apply_action.action_id], True])]
+
+
+async def test_internal_push_frontends(mocked_pusher, settings):
+    redis = await mocked_pusher.get_redis()
+    await redis.sadd(settings.FRONTEND_RECIPIENTS_BASE.format('live'), 0, 1, 2)
+    await redis.sadd(settings.FRONTEND_RECIPIENTS_BASE.format('other'), 0, 9)
+    await redis.sadd(settings.FRONTEND_RECIPIENTS_BASE.format('dead'), 0, 1)
+    await redis.zadd(settings.FRONTEND_REGISTRY, time(), 'live')
+    await redis.zadd(settings.FRONTEND_REGISTRY, time(), 'other')
+    await redis.zadd(settings.FRONTEND_REGISTRY, time() - 120, 'dead')
+
+    action = Action(123, 'a' * 20, 'key12345678', 1, 'add', 'message', 'testing@example.com', None, None,
+                    'hello', None, None, 'm' * 20)
+    await mocked_pusher.internal_push({1, 2, 3}, action)
+
+    assert await redis.zrange(settings.FRONTEND_REGISTRY, encoding='utf8') == ['live', 'other']
+    assert await redis.llen(settings.FRONTEND_JOBS_BASE.format('other')) == 0
+    assert await redis.llen(settings.FRONTEND_JOBS_BASE.format('dead')) == 0
+    job = msg_decode(await redis.lpop(settings.FRONTEND_JOBS_BASE.format('live')))
+    assert sorted(job['recipients']) == [1, 2]
+    assert job['action']['key'] == 'a' * 20
+    assert job['action']['body'] == 'hello'
+    assert 'conv_id' not in job['action']
+
+
+async def test_auth_data_reused(mocked_pusher, settings):
+    auth_data1, auth_data2 = await asyncio.gather(mocked_pusher._auth_data(), mocked_pusher._auth_data())
+    assert auth_data1 == auth_data2
+    assert auth_data1['platform'] == mocked_pusher.settings.EXTERNAL_DOMAIN
+    assert await mocked_pusher._auth_data() == auth_data1
+    assert load_private_key.cache_info().currsize == 1
+
+    mocked_pusher._auth_signature = auth_data1['timestamp'] - 60_000, 'old-signature'
+    auth_data3 = await mocked_pusher._auth_data()
+    assert auth_data3['signature'] != 'old-signature'
+    assert auth_data3['timestamp'] >= auth_data1['timestamp']
+
+
+async def test_authenticate_single_flight(mocked_pusher, foreign_server):
+    node = f'em2.platform.foreign.com:{foreign_server.port}'
+    tokens = await asyncio.gather(*[mocked_pusher.authenticate(node) for _ in range(5)])
+    assert set(tokens) == {f'foobar:{int(2e12)}:xyz'}
+    assert foreign_server.app['request_log'] == ['POST /auth/ > 201']
+    assert mocked_pusher._token_requests == {}
+
+    redis = await mocked_pusher.get_redis()
+    assert not await redis.exists(mocked_pusher.auth_lock_prefix + node.encode())
+
+    # token close to expiring, it's returned and refreshed in the background
+    await redis.expire(mocked_pusher.auth_token_prefix + node.encode(), 60)
+    assert await mocked_pusher.authenticate(node) == tokens[0]
+    await mocked_pusher._token_requests[node]
+    assert foreign_server.app['request_log'] == ['POST /auth/ > 201'] * 2
+    assert await redis.ttl(mocked_pusher.auth_token_prefix + node.encode()) > 60
 
 
 async def test_push_failure(mocked_pusher, db_conn, conv, foreign_server):
@@ -42,8 +195,7 @@ async def test_push_failure(mocked_pusher, db_conn, conv, foreign_server):
     await mocked_pusher.push.direct(apply_action.action_id)
 
     assert foreign_server.app['request_log'] == [
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
         'POST /auth/ > 201',
         RegexStr('POST /key12345678/participant/add/testing@foreign.com > 500'),
     ]
@@ -66,6 +218,205 @@ async def test_push_failure(mocked_pusher, db_conn, conv, foreign_server):
     ] == conv_data['action_states']
 
 
+async def test_push_temporary_failure_retry(mocked_pusher, db_conn, conv, foreign_server):
+    apply_action = ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-error502-add-prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    )
+    await apply_action.run()
+    await mocked_pusher.push.direct(apply_action.action_id)
+
+    post = RegexStr('POST /key12345678/participant/add/testing@foreign.com > 502')
+    # the request isn't retried inline
+    assert foreign_server.app['request_log'][-2:] == ['POST /auth/ > 201', post]
+    states_sql = 'SELECT status, address, attempts, array_length(errors, 1), retry_ts > now() FROM action_states'
+    assert [tuple(r) for r in await db_conn.fetch(states_sql)] == [
+        ('temporary_failure', 'testing@foreign.com', 1, 1, True),
+    ]
+
+    # not due yet
+    assert await mocked_pusher.retry_pushes.direct() == 0
+
+    await db_conn.execute("UPDATE action_states SET retry_ts = now() - INTERVAL '1 second'")
+    assert await mocked_pusher.retry_pushes.direct() == 1
+    assert foreign_server.app['request_log'][-2:] == [post, post]
+    assert [tuple(r) for r in await db_conn.fetch(states_sql)] == [
+        ('temporary_failure', 'testing@foreign.com', 2, 2, True),
+    ]
+
+    # the last attempt is marked as failed and not retried again
+    mocked_pusher.settings.COMMS_PUSH_RETRY_ATTEMPTS = 3
+    await db_conn.execute("UPDATE action_states SET retry_ts = now() - INTERVAL '1 second'")
+    assert await mocked_pusher.retry_pushes.direct() == 1
+    assert [tuple(r) for r in await db_conn.fetch(states_sql)] == [('failed', 'testing@foreign.com', 3, 3, None)]
+
+
+async def test_push_circuit_open(mocked_pusher, db_conn, conv, foreign_server):
+    mocked_pusher.settings.COMMS_CIRCUIT_FAILURES = 1
+    apply_action = ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-error502-add-prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    )
+    await apply_action.run()
+    await mocked_pusher.push.direct(apply_action.action_id)
+
+    node = f'em2.platform.foreign.com:{foreign_server.port}'
+    post = RegexStr('POST /key12345678/participant/add/testing@foreign.com > 502')
+    assert foreign_server.app['request_log'][-1] == post
+    request_count = len(foreign_server.app['request_log'])
+    states = await mocked_pusher.circuit_states()
+    # only the push is recorded, not requests to the auth server or for the node's token
+    assert list(states) == [node]
+    assert states[node]['state'] == 'open'
+    assert states[node]['failures'] == 1
+
+    # the circuit is open so the retry is skipped without contacting the node
+    await db_conn.execute("UPDATE action_states SET retry_ts = now() - INTERVAL '1 second'")
+    assert await mocked_pusher.retry_pushes.direct() == 1
+    assert len(foreign_server.app['request_log']) == request_count
+    errors = await db_conn.fetchval('SELECT errors FROM action_states')
+    assert [json.loads(e)['stage'] for e in errors] == ['post', 'circuit']
+
+    # after the open time one probe is allowed, it fails so the circuit opens again
+    redis = await mocked_pusher.get_redis()
+    await redis.hset(mocked_pusher.circuit.key(node), 'opened_at', 0)
+    await db_conn.execute("UPDATE action_states SET retry_ts = now() - INTERVAL '1 second'")
+    assert await mocked_pusher.retry_pushes.direct() == 1
+    assert foreign_server.app['request_log'][request_count:] == [post]
+    assert (await mocked_pusher.circuit.state(redis, node))['state'] == 'open'
+
+
+async def test_push_coalesced(mocked_pusher, db_conn, conv, foreign_server):
+    apply_action = ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-testing-add--prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    )
+    await apply_action.run()
+    action_ids = [apply_action.action_id]
+    for key in ('subject-modify-1----', 'subject-modify-2----', 'subject-modify-3----'):
+        action_ids.append(await db_conn.fetchval(
+            "INSERT INTO actions (key, conv, verb, component, actor, body, parent) "
+            "SELECT $1, $2, 'modify', 'subject', creator, 'new subject', $3 FROM conversations WHERE id = $2 "
+            "RETURNING id",
+            key, conv.id, action_ids[-1] if len(action_ids) > 1 else None,
+        ))
+    await mocked_pusher.push_batch.direct(action_ids)
+
+    # adding the participant is sent alone so the node can fetch the conversation if it doesn't have it
+    assert foreign_server.app['request_log'][-2:] == [
+        RegexStr('POST /key12345678/participant/add/testing@foreign.com > 201'),
+        'POST /batch/key12345678/ > 201',
+    ]
+    assert len([r for r in foreign_server.app['request_log'] if r.startswith('POST /batch/')]) == 1
+    assert [
+        {'key': 'subject-modify-1----', 'component': 'subject', 'verb': 'modify', 'body': 'new subject'},
+        {'key': 'subject-modify-2----', 'component': 'subject', 'verb': 'modify', 'body': 'new subject',
+         'parent': 'subject-modify-1----'},
+        {'key': 'subject-modify-3----', 'component': 'subject', 'verb': 'modify', 'body': 'new subject',
+         'parent': 'subject-modify-2----'},
+    ] == [
+        {k: v for k, v in a.items() if k in {'key', 'component', 'verb', 'item', 'body', 'parent'}}
+        for a in foreign_server.app['batches'][0]['actions']
+    ]
+    assert ['successful'] * 4 == [r[0] for r in await db_conn.fetch('SELECT status FROM action_states')]
+    assert mocked_pusher._push_buffers == {}
+
+
+async def test_push_coalesced_unknown_conv(mocked_pusher, db_conn, conv, foreign_server):
+    await ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-testing-add--prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    ).run()
+    action_ids = []
+    for key in ('subject-modify-1----', 'subject-modify-2----'):
+        action_ids.append(await db_conn.fetchval(
+            "INSERT INTO actions (key, conv, verb, component, actor, body) "
+            "SELECT $1, $2, 'modify', 'subject', creator, 'new subject' FROM conversations WHERE id = $2 RETURNING id",
+            key, conv.id,
+        ))
+    # the node hasn't got the conversation yet, eg. it's still fetching it
+    foreign_server.app['convs'].clear()
+    await mocked_pusher.push_batch.direct(action_ids)
+
+    assert foreign_server.app['request_log'][-1] == 'POST /batch/key12345678/ > 404'
+    states_sql = 'SELECT status, attempts FROM action_states ORDER BY action'
+    assert [tuple(r) for r in await db_conn.fetch(states_sql)] == [('temporary_failure', 1)] * 2
+
+    # retries are sent alone with the participant
+    await db_conn.execute("UPDATE action_states SET retry_ts = now() - INTERVAL '1 second'")
+    assert await mocked_pusher.retry_pushes.direct() == 2
+    assert sorted(foreign_server.app['request_log'][-2:]) == ['POST /key12345678/subject/modify/ > 201'] * 2
+    assert [tuple(r) for r in await db_conn.fetch(states_sql)] == [('successful', 2)] * 2
+    assert foreign_server.app['batches'] == []
+
+
+class SinglePoolAcquire:
+    """
+    Acquire the test connection from a pool of one connection.
+    """
+    def __init__(self, conn, semaphore):
+        self.conn = conn
+        self.semaphore = semaphore
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.semaphore.release()
+
+
+async def test_push_remote_pool_exhausted(mocked_pusher, db_conn, conv, foreign_server):
+    await ApplyAction(
+        db_conn,
+        remote_action=False,
+        action_key='act-testing-add--prt',
+        conv=conv.id,
+        actor=await db_conn.fetchval('SELECT id FROM recipients'),
+        component='participant',
+        verb='add',
+        item='testing@foreign.com',
+    ).run()
+    action_ids = []
+    for key in ('subject-modify-1----', 'subject-modify-2----', 'subject-modify-3----'):
+        action_ids.append(await db_conn.fetchval(
+            "INSERT INTO actions (key, conv, verb, component, actor, body) "
+            "SELECT $1, $2, 'modify', 'subject', creator, 'new subject' FROM conversations WHERE id = $2 RETURNING id",
+            key, conv.id,
+        ))
+    # more push jobs than connections, jobs mustn't wait for buffered pushes while holding a connection
+    semaphore = asyncio.Semaphore(1, loop=mocked_pusher.loop)
+    mocked_pusher.db.acquire = lambda timeout=None: SinglePoolAcquire(db_conn, semaphore)
+    pushes = [mocked_pusher.push_remote.direct([action_id]) for action_id in action_ids]
+    await asyncio.wait_for(asyncio.gather(*pushes, loop=mocked_pusher.loop), timeout=5, loop=mocked_pusher.loop)
+
+    assert ['successful'] * 3 == [r[0] for r in await db_conn.fetch('SELECT status FROM action_states')]
+
+
 async def add_prt(db_conn, conv):
     apply_action = ApplyAction(
         db_conn,
@@ -166,3 +517,13 @@ async def test_reply_fallback(mocked_pusher, db_conn, conv):
     assert email_msg['Subject'] == 'Test Conversation'
     assert email_msg['In-Reply-To'] == '<testing-in-reply-to@other.com>'
     assert email_msg['References'] == '<testing-in-reply-to@other.com> <testing-references@other.com>'
+
+
+async def test_response_unsupported_encoding(mocked_pusher, foreign_server):
+    node = f'em2.platform.foreign.com:{foreign_server.port}'
+    with pytest.raises(Em2ConnectionError) as exc_info:
+        await mocked_pusher._request(METH_GET, f'http://{node}/encoded/br/')
+    assert str(exc_info.value) == 'bad response: unsupported content encoding "br", accepted codings: "gzip"'
+    assert exc_info.value.temporary is False
+    # not retried
+    assert foreign_server.app['request_log'] == ['GET /encoded/br/ > 200']
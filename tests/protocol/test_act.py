@@ -1,5 +1,9 @@
+import gzip
+
 import pytest
 
+from em2.core import ApplyAction
+
 from ..conftest import CloseToNow
 
 
@@ -28,6 +32,49 @@ class TestAct:
         assert len(obj['actions']) == 3
         assert obj['messages'][1]['body'] == 'different content'
 
+    async def test_compressed_body(self):
+        body = 'this is a long message. ' * 100
+        url_ = self.url('act', conv=self.conv.key, component='message', verb='add', item='msg-secondmessagekey')
+        headers = self.act_headers(parent='pub-add-message-1234')
+        headers['Content-Encoding'] = 'gzip'
+        r = await self.cli.post(url_, data=gzip.compress(body.encode()), headers=headers)
+        assert r.status == 201, await r.text()
+        assert r.headers['Accept-Encoding'] == 'gzip'
+
+        r = await self.cli.get(self.url('get', conv=self.conv.key), headers={
+            'em2-auth': 'already-authenticated.com:123:whatever',
+            'em2-participant': self.conv.creator_address,
+            'Accept-Encoding': 'gzip',
+        })
+        assert r.status == 200, await r.text()
+        assert r.headers['Content-Encoding'] == 'gzip'
+        obj = await r.json()
+        assert obj['messages'][1]['body'] == body
+
+    async def test_unsupported_encoding(self):
+        url_ = self.url('act', conv=self.conv.key, component='message', verb='add', item='msg-secondmessagekey')
+        headers = self.act_headers(parent='pub-add-message-1234')
+        headers['Content-Encoding'] = 'zstd'
+        r = await self.cli.post(url_, data=b'foobar', headers=headers)
+        assert r.status == 415, await r.text()
+        assert 'unsupported content encoding "zstd"' == await r.text()
+
+    async def test_duplicate_action(self, db_conn):
+        url_ = self.url('act', conv=self.conv.key, component='message', verb='add', item='msg-secondmessagekey')
+        headers = self.act_headers(parent='pub-add-message-1234')
+        r = await self.cli.post(url_, data='foobar', headers=headers)
+        assert r.status == 201, await r.text()
+
+        # the node resends the action, eg. after a timeout
+        r = await self.cli.post(url_, data='foobar', headers=headers)
+        assert r.status == 201, await r.text()
+        assert 2 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+        assert 2 == await db_conn.fetchval('SELECT COUNT(*) FROM messages')
+
+        r = await self.cli.post(url_, data='different', headers=headers)
+        assert r.status == 409, await r.text()
+        assert f'action "{headers["em2-action-key"]}" already exists with different content' == await r.text()
+
     async def test_no_parent(self):
         url_ = self.url('act', conv=self.conv.key, component='message', verb='add', item='msg-secondmessagekey')
         r = await self.cli.post(url_, data='foobar', headers=self.act_headers())
@@ -258,3 +305,196 @@ class TestAct:
         updated_ts2 = await db_conn.fetchval('SELECT updated_ts FROM conversations')
         assert updated_ts1 < updated_ts2
         assert updated_ts2.year == 2033
+
+    async def test_batch(self):
+        actor = self.conv.creator_address
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [
+            {
+                'key': 'batch-msg-add-------',
+                'actor': actor,
+                'timestamp': '2000000000',
+                'component': 'message',
+                'verb': 'add',
+                'item': 'msg-secondmessagekey',
+                'parent': 'pub-add-message-1234',
+                'body': 'foobar',
+            },
+            {
+                'key': 'batch-msg-modify----',
+                'actor': actor,
+                'timestamp': '2000000000',
+                'component': 'message',
+                'verb': 'modify',
+                'item': 'msg-secondmessagekey',
+                'parent': 'batch-msg-add-------',
+                'body': 'different content',
+            },
+        ]}, headers={'em2-auth': 'already-authenticated.com:123:whatever'})
+        assert r.status == 201, await r.text()
+        obj = await self.get_conv(self.conv)
+        assert [
+            'pub-add-message-1234',
+            'batch-msg-add-------',
+            'batch-msg-modify----',
+        ] == [a['key'] for a in obj['actions']]
+        assert obj['messages'][1]['body'] == 'different content'
+
+    async def test_batch_resent(self, db_conn):
+        actor = self.conv.creator_address
+        msg_add = {
+            'key': 'batch-msg-add-------',
+            'actor': actor,
+            'timestamp': '2000000000',
+            'component': 'message',
+            'verb': 'add',
+            'item': 'msg-secondmessagekey',
+            'parent': 'pub-add-message-1234',
+            'body': 'foobar',
+        }
+        headers = {'em2-auth': 'already-authenticated.com:123:whatever'}
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [msg_add]},
+                                headers=headers)
+        assert r.status == 201, await r.text()
+
+        # the first action was already applied so only the second is new
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [
+            msg_add,
+            {
+                'key': 'batch-msg-modify----',
+                'actor': actor,
+                'timestamp': '2000000000',
+                'component': 'message',
+                'verb': 'modify',
+                'item': 'msg-secondmessagekey',
+                'parent': 'batch-msg-add-------',
+                'body': 'different content',
+            },
+        ]}, headers=headers)
+        assert r.status == 201, await r.text()
+        obj = await self.get_conv(self.conv)
+        assert [
+            'pub-add-message-1234',
+            'batch-msg-add-------',
+            'batch-msg-modify----',
+        ] == [a['key'] for a in obj['actions']]
+        assert obj['messages'][1]['body'] == 'different content'
+
+    async def test_batch_applied_concurrently(self, db_conn, mocker):
+        actor = self.conv.creator_address
+        msg_add = {
+            'key': 'batch-msg-add-------',
+            'actor': actor,
+            'timestamp': '2000000000',
+            'component': 'message',
+            'verb': 'add',
+            'item': 'msg-secondmessagekey',
+            'parent': 'pub-add-message-1234',
+            'body': 'foobar',
+        }
+        headers = {'em2-auth': 'already-authenticated.com:123:whatever'}
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [msg_add]},
+                                headers=headers)
+        assert r.status == 201, await r.text()
+
+        find_duplicates = ApplyAction.find_duplicates
+        lookups = []
+
+        async def racing_find_duplicates(conn, apply_actions):
+            # the first lookup happens before the concurrent request commits so finds nothing
+            lookups.append([a.data.action_key for a in apply_actions])
+            if len(lookups) > 1:
+                await find_duplicates(conn, apply_actions)
+
+        mocker.patch.object(ApplyAction, 'find_duplicates', side_effect=racing_find_duplicates)
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [
+            msg_add,
+            {
+                'key': 'batch-msg-modify----',
+                'actor': actor,
+                'timestamp': '2000000000',
+                'component': 'message',
+                'verb': 'modify',
+                'item': 'msg-secondmessagekey',
+                'parent': 'batch-msg-add-------',
+                'body': 'different content',
+            },
+        ]}, headers=headers)
+        assert r.status == 201, await r.text()
+        assert len(lookups) == 2
+        obj = await self.get_conv(self.conv)
+        assert [
+            'pub-add-message-1234',
+            'batch-msg-add-------',
+            'batch-msg-modify----',
+        ] == [a['key'] for a in obj['actions']]
+        assert obj['messages'][1]['body'] == 'different content'
+
+    async def test_batch_missing_timestamp(self, db_conn):
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [
+            {
+                'key': 'batch-msg-add-------',
+                'actor': self.conv.creator_address,
+                'component': 'message',
+                'verb': 'add',
+                'item': 'msg-secondmessagekey',
+                'parent': 'pub-add-message-1234',
+                'body': 'foobar',
+            },
+        ]}, headers={'em2-auth': 'already-authenticated.com:123:whatever'})
+        assert r.status == 400, await r.text()
+        assert [
+            {'loc': ['actions', 0, 'timestamp'], 'msg': 'field required', 'type': 'value_error.missing'},
+        ] == await r.json()
+        assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+    @pytest.mark.parametrize('actor', [['test@already-authenticated.com'], {'x': 1}, 'not an address', None])
+    async def test_batch_invalid_actor(self, db_conn, actor):
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [
+            {
+                'key': 'batch-msg-add-------',
+                'actor': actor,
+                'timestamp': '2000000000',
+                'component': 'message',
+                'verb': 'add',
+                'item': 'msg-secondmessagekey',
+                'parent': 'pub-add-message-1234',
+                'body': 'foobar',
+            },
+        ]}, headers={'em2-auth': 'already-authenticated.com:123:whatever'})
+        assert r.status == 400, await r.text()
+        assert [e['loc'] for e in await r.json()] == [['actions', 0, 'actor']]
+        assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+    async def test_batch_action_not_dict(self, db_conn):
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': ['foobar']},
+                                headers={'em2-auth': 'already-authenticated.com:123:whatever'})
+        assert r.status == 400, await r.text()
+        assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+    async def test_batch_parent_order(self, db_conn):
+        actor = self.conv.creator_address
+        r = await self.cli.post(self.url('act-batch', conv=self.conv.key), json={'actions': [
+            {
+                'key': 'batch-msg-modify----',
+                'actor': actor,
+                'timestamp': '2000000000',
+                'component': 'message',
+                'verb': 'modify',
+                'item': 'msg-secondmessagekey',
+                'parent': 'batch-msg-add-------',
+                'body': 'different content',
+            },
+            {
+                'key': 'batch-msg-add-------',
+                'actor': actor,
+                'timestamp': '2000000000',
+                'component': 'message',
+                'verb': 'add',
+                'item': 'msg-secondmessagekey',
+                'parent': 'pub-add-message-1234',
+                'body': 'foobar',
+            },
+        ]}, headers={'em2-auth': 'already-authenticated.com:123:whatever'})
+        assert r.status == 400, await r.text()
+        assert 'parent "batch-msg-add-------" must come before its child in batch' == await r.text()
+        assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
@@ -16,8 +16,7 @@ async def test_publish(cli, url, foreign_server, get_conv):
     assert foreign_server.app['request_log'] == [
         'POST /auth/ > 201',
         'GET /get/key12345678/ > 200',
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
     ]
 
 
@@ -72,8 +71,7 @@ async def test_add_participant(cli, url, foreign_server, get_conv, db_conn):
     assert foreign_server.app['request_log'] == [
         'POST /auth/ > 201',
         'GET /get/key12345678/ > 200',
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
     ]
     updated_ts = await db_conn.fetchval('SELECT to_json(updated_ts) FROM conversations')
     assert updated_ts == '"2032-06-01T13:00:00.12345"'
@@ -138,8 +136,7 @@ async def test_publish_conv_exists(cli, url, foreign_server, get_conv):
     assert foreign_server.app['request_log'] == [
         'POST /auth/ > 201',
         'GET /get/key12345678/ > 200',
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
     ]
 
 
@@ -1,11 +1,19 @@
+import gzip
 from datetime import datetime, timedelta, timezone
 
+import asyncpg
 import pytest
+from aiohttp.web import HTTPBadRequest
 
 from em2 import Settings, create_app
+from em2.core import GET_RECIPIENT_ID_SQL, ApplyAction, MsgFormat, Verbs, get_create_recipient, recipient_cache
 from em2.exceptions import StartupException
 from em2.utils import to_utc_naive
+from em2.utils.cache import LRUCache
+from em2.utils.compression import UnsupportedEncoding, choose_codec, decode_body
+from em2.utils.database import Connection, statements
 from em2.utils.network import _wait_port_open, wait_for_services
+from em2.worker import WeightedDrain
 
 
 def test_wait_for_services(loop):
@@ -37,3 +45,132 @@ async def test_create_app(settings, aiohttp_client):
     r = await cli.get('/d/')
     assert r.status == 200, await r.text()
     assert 'UI interface' in await r.text()
+
+
+async def test_prepared_statements(settings, clean_db):
+    assert {'get_recipient_id', 'GetConv.conv_sql', 'ConvActions.actions_since_sql', 'Pusher.prts_sql'} <= \
+        statements.names()
+    conn = await asyncpg.connect(dsn=settings.pg_dsn, connection_class=Connection)
+    try:
+        await statements.prepare(conn)
+        assert GET_RECIPIENT_ID_SQL in conn.prepared
+        calls = dict((n, c) for n, c, t in statements.stats()).get('get_recipient_id', 0)
+        assert await conn.fetchval(GET_RECIPIENT_ID_SQL, 'missing@example.com') is None
+        assert dict((n, c) for n, c, t in statements.stats())['get_recipient_id'] == calls + 1
+        # statements not in the registry are executed as normal
+        assert await conn.fetchval('SELECT 42') == 42
+    finally:
+        await conn.close()
+
+
+async def test_recipient_cache_after_commit(settings, clean_db):
+    address = 'recipient-cache@example.com'
+    conn = await asyncpg.connect(dsn=settings.pg_dsn, connection_class=Connection)
+    try:
+        await statements.prepare(conn)
+        with pytest.raises(RuntimeError):
+            async with recipient_cache.transaction(conn):
+                await get_create_recipient(conn, address)
+                raise RuntimeError('rolled back')
+        assert await recipient_cache.get_many([address]) == ({}, {address})
+
+        async with recipient_cache.transaction(conn):
+            recipient_id = await get_create_recipient(conn, address)
+            # not cached until the transaction commits
+            assert await recipient_cache.get_many([address]) == ({}, {address})
+
+        calls = dict((n, c) for n, c, t in statements.stats()).get('get_recipient_id', 0)
+        hits = recipient_cache.stats()['hits']
+        assert await get_create_recipient(conn, address) == recipient_id
+        assert dict((n, c) for n, c, t in statements.stats()).get('get_recipient_id', 0) == calls
+        assert recipient_cache.stats()['hits'] == hits + 1
+    finally:
+        recipient_cache.local.pop(address)
+        await conn.execute('DELETE FROM recipients WHERE address = $1', address)
+        await conn.close()
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 1}
+
+
+VALID_ACTION = dict(action_key='a' * 20, conv=1, verb='modify', component='message', actor=2, item='m' * 20)
+
+
+@pytest.mark.parametrize('data', [
+    VALID_ACTION,
+    dict(VALID_ACTION, timestamp='2032-06-01T12:00:00', body='foobar', parent='p' * 20, msg_format='plain'),
+    dict(VALID_ACTION, verb=Verbs.ADD, published=False, relationship='child', msg_format=None),
+])
+def test_validate_action_fast(data):
+    validator = ApplyAction._validate_fast
+    hits = validator.hits
+    m = ApplyAction.validate_data(data)
+    assert validator.hits == hits + 1
+    assert m == ApplyAction.Data(**data)
+    assert isinstance(m.verb, Verbs)
+
+
+@pytest.mark.parametrize('data', [
+    dict(VALID_ACTION, conv='1'),
+    dict(VALID_ACTION, timestamp=1_900_000_000),
+])
+def test_validate_action_coerce(data):
+    validator = ApplyAction._validate_fast
+    misses = validator.misses
+    m = ApplyAction.validate_data(data)
+    assert validator.misses == misses + 1
+    assert m == ApplyAction.Data(**data)
+    assert m.msg_format == MsgFormat.markdown
+
+
+@pytest.mark.parametrize('data', [
+    dict(VALID_ACTION, action_key='short'),
+    dict(VALID_ACTION, verb='foobar'),
+    dict(VALID_ACTION, extra=1),
+    {k: v for k, v in VALID_ACTION.items() if k != 'actor'},
+])
+def test_validate_action_invalid(data):
+    with pytest.raises(HTTPBadRequest):
+        ApplyAction.validate_data(data)
+
+
+@pytest.mark.parametrize('accept,codec', [
+    ('gzip, deflate', 'gzip'),
+    ('deflate;q=1.0, GZIP;q=0.5', 'gzip'),
+    ('gzip;q=0', None),
+    ('br', None),
+    (None, None),
+])
+def test_choose_codec(accept, codec):
+    c = choose_codec(accept)
+    assert (c and c.name) == codec
+
+
+def test_decode_body():
+    assert decode_body(gzip.compress(b'foobar'), 'gzip') == b'foobar'
+    assert decode_body(b'foobar', None) == b'foobar'
+    assert decode_body(b'foobar', 'gzip', native_decoded=True) == b'foobar'
+    with pytest.raises(UnsupportedEncoding):
+        decode_body(b'foobar', 'zstd')
+    with pytest.raises(ValueError):
+        decode_body(b'foobar', 'gzip')
+
+
+async def test_weighted_drain_order(redis):
+    drain = WeightedDrain(redis=redis, queue_weights={b'high': 2, b'dft': 1})
+    assert [drain.queue_order((b'high', b'dft', b'low')) for _ in range(4)] == [
+        (b'high', b'dft', b'low'),
+        (b'dft', b'high', b'low'),
+        (b'low', b'high', b'dft'),
+        (b'high', b'dft', b'low'),
+    ]
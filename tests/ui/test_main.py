@@ -9,7 +9,7 @@ from async_timeout import timeout
 from cryptography.fernet import Fernet
 
 from em2 import VERSION
-from em2.core import Components, Verbs
+from em2.core import Components, ConvSnapshots, Verbs, conv_cache
 
 from ..conftest import AnyInt, CloseToNow, RegexStr
 
@@ -292,6 +292,24 @@ async def test_get_draft_conv(cli, url, db_conn):
     assert actions == actions2
 
 
+async def test_get_conv_prefix_cache(cli, conv, url):
+    r = await cli.get(url('get', conv=conv.key[:6]))
+    assert r.status == 200, await r.text()
+    assert len(cli.server.app['conv_key_cache']) == 1
+
+    r = await cli.post(url('publish', conv=conv.key))
+    assert r.status == 200, await r.text()
+    new_conv_key = (await r.json())['key']
+
+    # the cached id no longer matches the old key prefix
+    r = await cli.get(url('get', conv=conv.key[:6]))
+    assert r.status == 404, await r.text()
+    r = await cli.get(url('get', conv=new_conv_key[:6]))
+    assert r.status == 200, await r.text()
+    r = await cli.get(url('get', conv=new_conv_key))
+    assert r.status == 200, await r.text()
+
+
 async def test_add_message_not_published(cli, conv, url):
     data = {'body': 'hello'}
     url_ = url('act', conv=conv.key, component=Components.MESSAGE, verb=Verbs.ADD)
@@ -632,6 +650,156 @@ async def test_get_conv_actions(cli, conv, url, db_conn):
     ] == [(a['key'], a['verb'], a['component'], a['body']) for a in await r.json()], actions
 
 
+async def test_get_conv_actions_cached(cli, conv, url, db_conn):
+    r = await cli.post(url('publish', conv=conv.key))
+    assert r.status == 200, await r.text()
+    new_conv_key = (await r.json())['key']
+
+    r = await cli.get(url('get', conv=new_conv_key))
+    assert r.status == 200, await r.text()
+    actions = await r.json()
+    assert len(actions) == 3
+
+    hits = conv_cache.hits
+    r = await cli.get(url('get', conv=new_conv_key))
+    assert r.status == 200, await r.text()
+    assert actions == await r.json()
+    assert conv_cache.hits == hits + 1
+
+    add_url = url('act', conv=new_conv_key, component=Components.MESSAGE, verb=Verbs.ADD)
+    r = await cli.post(add_url, json={'body': 'hello', 'parent': actions[0]['key']})
+    assert r.status == 200, await r.text()
+    msg2_act_key = (await r.json())['key']
+
+    r = await cli.get(url('get', conv=new_conv_key))
+    assert r.status == 200, await r.text()
+    assert [a['key'] for a in actions] + [msg2_act_key] == [a['key'] for a in await r.json()]
+    assert conv_cache.hits == hits + 1
+
+
+async def test_get_conv_actions_limit_stream(cli, conv, url, db_conn):
+    r = await cli.post(url('publish', conv=conv.key))
+    assert r.status == 200, await r.text()
+    new_conv_key = (await r.json())['key']
+
+    r = await cli.get(url('get', conv=new_conv_key))
+    assert r.status == 200, await r.text()
+    all_keys = [a['key'] for a in await r.json()]
+    assert len(all_keys) == 3
+
+    r = await cli.get(url('get', conv=new_conv_key, query={'limit': '2'}))
+    assert r.status == 200, await r.text()
+    assert all_keys[:2] == [a['key'] for a in await r.json()]
+
+    r = await cli.get(url('get', conv=new_conv_key, query={'limit': '2', 'since': all_keys[1]}))
+    assert r.status == 200, await r.text()
+    assert all_keys[2:] == [a['key'] for a in await r.json()]
+
+    r = await cli.get(url('get', conv=new_conv_key, query={'stream': 'true'}))
+    assert r.status == 200, await r.text()
+    assert r.headers['Transfer-Encoding'] == 'chunked'
+    assert all_keys == [a['key'] for a in await r.json()]
+
+    r = await cli.get(url('get', conv=new_conv_key, query={'stream': 'true', 'since': all_keys[2]}))
+    assert r.status == 200, await r.text()
+    assert [] == await r.json()
+
+    r = await cli.get(url('get', conv=new_conv_key, query={'limit': '0'}))
+    assert r.status == 400, await r.text()
+    assert {'error': 'limit must be a positive integer'} == await r.json()
+
+
+async def test_get_conv_actions_snapshot(cli, conv, url, db_conn, settings):
+    r = await cli.post(url('publish', conv=conv.key))
+    assert r.status == 200, await r.text()
+    new_conv_key = (await r.json())['key']
+
+    r = await cli.get(url('get', conv=new_conv_key, query={'snapshot': 'true'}))
+    assert r.status == 200, await r.text()
+    obj = await r.json()
+    assert obj['snapshot'] is None
+    assert len(obj['actions']) == 3
+    pub_act_key = obj['actions'][2]['key']
+
+    assert 1 == await ConvSnapshots(db_conn, settings.copy(update={'snapshot_min_actions': 3})).run()
+    # no new actions so no new snapshot
+    assert 0 == await ConvSnapshots(db_conn, settings.copy(update={'snapshot_min_actions': 1})).run()
+
+    add_url = url('act', conv=new_conv_key, component=Components.MESSAGE, verb=Verbs.ADD)
+    r = await cli.post(add_url, json={'body': 'hello', 'parent': obj['actions'][0]['key']})
+    assert r.status == 200, await r.text()
+    msg2_act_key = (await r.json())['key']
+
+    r = await cli.get(url('get', conv=new_conv_key, query={'snapshot': 'true'}))
+    assert r.status == 200, await r.text()
+    obj = await r.json()
+    assert obj['snapshot']['action'] == pub_act_key
+    assert obj['snapshot']['state']['subject'] == 'Test Conversation'
+    assert [m['body'] for m in obj['snapshot']['state']['messages']] == ['this is the message']
+    assert [p['address'] for p in obj['snapshot']['state']['participants']] == ['testing@example.com']
+    assert [a['key'] for a in obj['actions']] == [msg2_act_key]
+
+    assert 1 == await ConvSnapshots(db_conn, settings.copy(update={'snapshot_min_actions': 1})).run()
+    assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM conv_snapshots')
+
+
+async def test_act_batch(cli, conv, url, db_conn):
+    r = await cli.post(url('publish', conv=conv.key))
+    assert r.status == 200, await r.text()
+    new_conv_key = (await r.json())['key']
+    parent_key = await db_conn.fetchval("SELECT key FROM actions where component='message'")
+
+    r = await cli.post(url('act-batch', conv=new_conv_key), json={'actions': [
+        {'component': 'message', 'verb': 'add', 'body': 'hello', 'parent': parent_key,
+         'action_key': 'act-batch-add-hellox'},
+        {'component': 'message', 'verb': 'add', 'body': 'hello again', 'parent': 'act-batch-add-hellox'},
+        {'component': 'participant', 'verb': 'add', 'item': 'other@example.com'},
+    ]})
+    assert r.status == 200, await r.text()
+    assert [
+        ('act-batch-add-hellox', 'message', 'add', 'hello'),
+        (RegexStr('act-.*'), 'message', 'add', 'hello again'),
+        (RegexStr('act-.*'), 'participant', 'add', None),
+    ] == [(a['key'], a['component'], a['verb'], a['body']) for a in await r.json()]
+
+    snippet = json.loads(await db_conn.fetchval('SELECT snippet FROM conversations'))
+    assert snippet['msgs'] == 3
+    assert snippet['prts'] == 2
+    prt_count, msg_count, last_msg = await db_conn.fetchrow('SELECT prt_count, msg_count, last_msg FROM conversations')
+    assert (prt_count, msg_count) == (2, 3)
+    assert last_msg == await db_conn.fetchval('SELECT max(id) FROM messages')
+
+
+async def test_act_batch_invalid_key(cli, conv, url, db_conn):
+    r = await cli.post(url('act-batch', conv=conv.key), json={'actions': [
+        {'component': 'participant', 'verb': 'add', 'item': 'other@example.com', 'action_key': 'foobar'},
+    ]})
+    assert r.status == 400, await r.text()
+    assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+
+async def test_act_batch_key_not_str(cli, conv, url, db_conn):
+    r = await cli.post(url('act-batch', conv=conv.key), json={'actions': [
+        {'component': 'participant', 'verb': 'add', 'item': 'other@example.com', 'action_key': 123},
+    ]})
+    assert r.status == 400, await r.text()
+    assert 0 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+
+async def test_act_batch_existing_key(cli, conv, url, db_conn):
+    r = await cli.post(url('act-batch', conv=conv.key), json={'actions': [
+        {'component': 'participant', 'verb': 'add', 'item': 'other@example.com', 'action_key': 'act-batch-prt-addxxx'},
+    ]})
+    assert r.status == 200, await r.text()
+
+    r = await cli.post(url('act-batch', conv=conv.key), json={'actions': [
+        {'component': 'participant', 'verb': 'add', 'item': 'third@example.com', 'action_key': 'act-batch-prt-addxxx'},
+    ]})
+    assert r.status == 409, await r.text()
+    assert {'error': 'action key conflicts with an existing action'} == await r.json()
+    assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM actions')
+
+
 async def test_publish_conv_foreign_part(cli, conv, url, db_conn, foreign_server):
     url_ = url('act', conv=conv.key, component=Components.PARTICIPANT, verb=Verbs.ADD)
     r = await cli.post(url_, json={'item': 'other@foreign.com'})
@@ -645,8 +813,7 @@ async def test_publish_conv_foreign_part(cli, conv, url, db_conn, foreign_server
     assert await db_conn.fetchval('SELECT published FROM conversations')
 
     assert foreign_server.app['request_log'] == [
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
         'POST /auth/ > 201',
         RegexStr('POST /create/[0-9a-f]+/ > 204'),
     ], foreign_server.app['request_log']
@@ -661,8 +828,7 @@ async def test_publish_add_msg_conv(cli, conv, url, db_conn, foreign_server):
     assert r.status == 200, await r.text()
 
     assert foreign_server.app['request_log'] == [
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
         'POST /auth/ > 201',
         RegexStr('POST /create/[0-9a-f]+/ > 204'),
     ], foreign_server.app['request_log']
@@ -674,8 +840,7 @@ async def test_publish_add_msg_conv(cli, conv, url, db_conn, foreign_server):
     assert r.status == 200, await r.text()
 
     assert foreign_server.app['request_log'] == [
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
         'POST /auth/ > 201',
         RegexStr(f'POST /create/{new_conv_key}/ > 204'),
         RegexStr(f'POST /{new_conv_key}/message/add/msg-[0-9a-z]+ > 201'),
@@ -691,8 +856,7 @@ async def test_publish_update_add_part(cli, conv, url, db_conn, foreign_server):
     assert r.status == 200, await r.text()
 
     assert foreign_server.app['request_log'] == [
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
         'POST /auth/ > 201',
         RegexStr('POST /create/[0-9a-f]+/ > 204'),
     ], foreign_server.app['request_log']
@@ -702,11 +866,10 @@ async def test_publish_update_add_part(cli, conv, url, db_conn, foreign_server):
     r = await cli.post(url_, json={'item': 'new@foreign.com'})
     assert r.status == 200, await r.text()
     assert foreign_server.app['request_log'] == [
-        'GET /check-user-node/ > 200',
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
         'POST /auth/ > 201',
         RegexStr(f'POST /create/{new_conv_key}/ > 204'),
-        'GET /check-user-node/ > 200',
+        'POST /check-user-nodes/ > 200',
         RegexStr(f'POST /{new_conv_key}/participant/add/new@foreign.com > 201'),
     ], foreign_server.app['request_log']
 